@@ -4,13 +4,14 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from datetime import timedelta
-from decimal import Decimal
 
-from .models import DriverLocation, Booking, RouteSnapshot, BookingStop
-from .services import RoutingService
-from .utils import build_driver_itinerary, ensure_booking_stops, plan_driver_stops, calculate_distance
+from .models import Booking, RouteSnapshot, BookingStop
+from .services import RoutingService, check_and_reroute
+from .utils import calculate_distance
 from user.models import Driver, Rider
+from .tasks import schedule_reroute
+from .location_buffer import record_fix, buffer_stats
+from . import geocoding, itinerary, location_store, polyline, quotes
 
 
 @api_view(['POST'])
@@ -29,37 +30,85 @@ def update_driver_location(request):
     if not latitude or not longitude:
         return Response({'error': 'Latitude and longitude required'}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Update or create driver location
-    location, created = DriverLocation.objects.update_or_create(
-        driver=request.user,
-        defaults={
-            'latitude': Decimal(str(latitude)),
-            'longitude': Decimal(str(longitude)),
-            'heading': Decimal(str(heading)) if heading else None,
-            'speed': Decimal(str(speed)) if speed else None,
-            'accuracy': Decimal(str(accuracy)) if accuracy else None,
-        }
-    )
+    # Buffer the fix; it's readable from the cache at once and reaches the
+    # database with the next batched flush.
+    fix = record_fix(request.user.id, latitude, longitude, heading=heading, speed=speed, accuracy=accuracy)
     
-    # Check for active bookings and reroute if needed
-    active_bookings = Booking.objects.filter(
+    # Hand rerouting to the background pipeline: only the latest ping per
+    # booking is kept, and at most one reroute task per booking is pending.
+    active_booking_ids = Booking.objects.filter(
         driver=request.user,
         status__in=['accepted', 'on_the_way', 'started']
-    )
+    ).values_list('id', flat=True)
 
-    for active_booking in active_bookings:
-        check_and_reroute(active_booking, location)
+    for booking_id in active_booking_ids:
+        schedule_reroute(booking_id, fix['latitude'], fix['longitude'])
     
     return Response({
         'status': 'success',
         'location': {
-            'latitude': float(location.latitude),
-            'longitude': float(location.longitude),
-            'timestamp': location.timestamp.isoformat()
+            'latitude': float(fix['latitude']),
+            'longitude': float(fix['longitude']),
+            'timestamp': fix['timestamp']
         }
     })
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def location_buffer_stats(request):
+    """Backlog and flush counters for the driver location buffer (admins only)"""
+    if request.user.trikego_user != 'A' and not request.user.is_staff:
+        return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+    return Response(buffer_stats())
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def create_quote(request):
+    """Route and price a trip before it is booked; the booking form sends back the quote_id"""
+    if request.user.trikego_user != 'R':
+        return Response({'error': 'Only riders can request quotes'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        pickup = (float(request.data['pickup_longitude']), float(request.data['pickup_latitude']))
+        destination = (float(request.data['destination_longitude']), float(request.data['destination_latitude']))
+    except (KeyError, TypeError, ValueError):
+        return Response({'error': 'Pickup and destination coordinates required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    quote = quotes.create_quote(request.user.id, pickup, destination)
+    if quote is None:
+        return Response({'error': 'Could not find a route'}, status=status.HTTP_502_BAD_GATEWAY)
+    quote.pop('rider_id', None)
+    return Response(quote)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def geocode(request):
+    """Address autocomplete for the booking forms; ?q=<text>, optionally &lat=&lon= to rank by distance"""
+    query = (request.GET.get('q') or '')[:200]
+    try:
+        near = (float(request.GET['lat']), float(request.GET['lon']))
+    except (KeyError, TypeError, ValueError):
+        near = None
+    results, source = geocoding.autocomplete(query, near=near)
+    return Response({'results': results, 'source': source})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def reverse_geocode(request):
+    """Address at a map position for the booking forms; ?lat=&lon="""
+    try:
+        lat, lon = float(request.GET['lat']), float(request.GET['lon'])
+    except (KeyError, TypeError, ValueError):
+        return Response({'error': 'lat and lon are required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return Response({'error': 'lat and lon are out of range'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'result': geocoding.reverse(lat, lon)})
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_driver_location(request, booking_id):
@@ -73,33 +122,32 @@ def get_driver_location(request, booking_id):
     if not booking.driver:
         return Response({'error': 'No driver assigned'}, status=status.HTTP_404_NOT_FOUND)
     
-    try:
-        location = DriverLocation.objects.get(driver=booking.driver)
+    location = location_store.get_driver_location(booking.driver_id)
+    if location is None:
+        return Response({'error': 'Driver location not available'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Calculate ETA if rider is requesting
+    eta_seconds = None
+    if request.user == booking.rider:
+        routing_service = RoutingService()
         
-        # Calculate ETA if rider is requesting
-        eta_seconds = None
-        if request.user == booking.rider:
-            routing_service = RoutingService()
-            
-            if booking.status == 'accepted' or booking.status == 'on_the_way':
-                # ETA to pickup
-                destination = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-            else:
-                # ETA to destination
-                destination = (float(booking.destination_longitude), float(booking.destination_latitude))
-            
-            eta_seconds = routing_service.get_eta(location, destination)
+        if booking.status == 'accepted' or booking.status == 'on_the_way':
+            # ETA to pickup
+            destination = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+        else:
+            # ETA to destination
+            destination = (float(booking.destination_longitude), float(booking.destination_latitude))
         
-        return Response({
-            'latitude': float(location.latitude),
-            'longitude': float(location.longitude),
-            'heading': float(location.heading) if location.heading else None,
-            'speed': float(location.speed) if location.speed else None,
-            'timestamp': location.timestamp.isoformat(),
-            'eta_seconds': eta_seconds
-        })
-    except DriverLocation.DoesNotExist:
-        return Response({'error': 'Driver location not available'}, status=status.HTTP_404_NOT_FOUND)
+        eta_seconds = routing_service.get_eta(location, destination)
+    
+    return Response({
+        'latitude': location.latitude,
+        'longitude': location.longitude,
+        'heading': location.heading,
+        'speed': location.speed,
+        'timestamp': location.timestamp,
+        'eta_seconds': eta_seconds
+    })
 
 
 @api_view(['GET'])
@@ -117,46 +165,24 @@ def get_current_route(request, booking_id):
     if not route:
         return Response({'error': 'No active route found'}, status=status.HTTP_404_NOT_FOUND)
     
-    return Response({
-        'route_data': route.route_data,
+    if request.GET.get('format') == 'geojson':
+        return Response({
+            'route_data': route.as_geojson(),
+            'distance': float(route.distance),
+            'duration': route.duration,
+            'created_at': route.created_at.isoformat()
+        })
+
+    # Encoded polyline by default; turn-by-turn steps only when asked for
+    payload = {
+        'geometry': route.geometry or polyline.encode(route.coordinates),
         'distance': float(route.distance),
         'duration': route.duration,
         'created_at': route.created_at.isoformat()
-    })
-
-
-def check_and_reroute(booking, driver_location):
-    """Check if rerouting is needed and perform reroute"""
-    routing_service = RoutingService()
-    
-    # Get current active route
-    current_route = RouteSnapshot.objects.filter(booking=booking, is_active=True).first()
-    
-    # Check if rerouting is needed
-    if routing_service.should_reroute(driver_location, current_route):
-        print(f"Rerouting needed for booking {booking.id}")
-        
-        # Determine destination based on status
-        if booking.status in ['accepted', 'on_the_way']:
-            destination = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-        else:
-            destination = (float(booking.destination_longitude), float(booking.destination_latitude))
-        
-        # Calculate new route
-        start = (float(driver_location.longitude), float(driver_location.latitude))
-        new_route = routing_service.calculate_route(start, destination)
-        
-        if new_route:
-            # Save new route
-            routing_service.save_route_snapshot(booking, new_route)
-            
-            # Update booking estimates
-            booking.estimated_distance = Decimal(str(new_route['distance']))
-            booking.estimated_duration = new_route['duration'] // 60  # Convert to minutes
-            booking.estimated_arrival = timezone.now() + timedelta(seconds=new_route['duration'])
-            booking.save()
-            
-            print(f"New route saved. Distance: {new_route['distance']}km, Duration: {new_route['duration']}s")
+    }
+    if 'steps' in request.GET.get('include', '').split(','):
+        payload['steps'] = route.steps or []
+    return Response(payload)
 
 
 @api_view(['POST'])
@@ -168,14 +194,13 @@ def manual_reroute(request, booking_id):
     if request.user != booking.driver:
         return Response({'error': 'Only the assigned driver can reroute'}, status=status.HTTP_403_FORBIDDEN)
     
-    try:
-        location = DriverLocation.objects.get(driver=request.user)
-        check_and_reroute(booking, location)
-        
-        return Response({'status': 'success', 'message': 'Route recalculated'})
-    except DriverLocation.DoesNotExist:
+    location = location_store.get_driver_location(request.user.id)
+    if location is None:
         return Response({'error': 'Driver location not available'}, status=status.HTTP_404_NOT_FOUND)
 
+    check_and_reroute(booking, location)
+    return Response({'status': 'success', 'message': 'Route recalculated'})
+
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
@@ -184,16 +209,9 @@ def driver_itinerary(request):
     if request.user.trikego_user != 'D':
         return Response({'error': 'Only drivers can access the itinerary.'}, status=status.HTTP_403_FORBIDDEN)
 
-    active_bookings = Booking.objects.filter(
-        driver=request.user,
-        status__in=['accepted', 'on_the_way', 'started']
-    )
-
-    for booking in active_bookings:
-        ensure_booking_stops(booking)
-
-    payload = build_driver_itinerary(request.user)
-    return Response(payload)
+    # Served from the cache; bookings and location events keep it current, and
+    # a miss queues a rebuild instead of planning inside this request
+    return Response(itinerary.get_itinerary(request.user))
 
 
 @api_view(['POST'])
@@ -217,13 +235,13 @@ def complete_itinerary_stop(request):
         return Response({'error': 'Stop not found or already completed.'}, status=status.HTTP_404_NOT_FOUND)
 
     if stop.status == 'COMPLETED':
-        return Response({'status': 'success', 'message': 'Stop already completed.', 'itinerary': build_driver_itinerary(request.user)['itinerary']})
+        return Response({'status': 'success', 'message': 'Stop already completed.', 'itinerary': itinerary.get_itinerary(request.user)['itinerary']})
 
     # Check if driver is within 10 meters of the stop location
     try:
-        driver_profile = Driver.objects.get(user=request.user)
-        driver_lat = driver_profile.current_latitude
-        driver_lon = driver_profile.current_longitude
+        location = location_store.get_driver_location(request.user.id)
+        driver_lat = location.latitude if location else None
+        driver_lon = location.longitude if location else None
         stop_lat = stop.latitude
         stop_lon = stop.longitude
         
@@ -240,8 +258,6 @@ def complete_itinerary_stop(request):
                     'distance': distance_meters,
                     'required': 10
                 }, status=status.HTTP_400_BAD_REQUEST)
-    except Driver.DoesNotExist:
-        pass  # If driver profile doesn't exist, skip proximity check
     except Exception as e:
         print(f"Proximity check error: {e}")
         pass  # Don't block on proximity check errors
@@ -277,9 +293,8 @@ def complete_itinerary_stop(request):
     else:
         Driver.objects.filter(user=request.user).update(status='Online')
 
-    # Ensure pick/drop pair consistency – if dropoff completed, mark booking rider status handled above
-    plan_driver_stops(request.user)
-
-    payload = build_driver_itinerary(request.user)
+    # Re-plan now so the response reflects the completed stop
+    itinerary.invalidate(request.user.id)
+    payload = itinerary.refresh_itinerary(request.user)
     return Response(payload)
     
@@ -0,0 +1,76 @@
+"""
+Versioned cache namespaces for payloads built from booking and driver state.
+
+Each booking and each driver has a version counter in the cache. Payloads
+that depend on them (route_info) put the current versions in their key, and
+writers bump a version instead of deleting keys: booking, stop and route
+snapshot saves (booking.signals, after commit), driver and tricycle saves
+and itinerary rebuilds. Driver location fixes don't bump anything: they are
+far too frequent, so payloads leave the position out and readers add it
+from booking.location_store. Everything cached under an older version becomes
+unreachable at once and simply expires, so nothing has to guess which keys
+exist.
+"""
+from typing import Tuple
+
+from django.core.cache import cache
+
+BOOKING = 'booking'
+DRIVER = 'driver'
+
+
+def version_key(namespace: str, object_id) -> str:
+    return f'cache_version:{namespace}:{object_id}'
+
+
+def bump(namespace: str, object_id) -> None:
+    if object_id is None:
+        return
+    key = version_key(namespace, object_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Unknown counters read as 0, so starting at 1 still moves readers on
+        cache.add(key, 1, timeout=None)
+    except Exception as e:
+        print(f"Cache version bump failed for {key}: {e}")
+
+
+def bump_booking(booking_id) -> None:
+    bump(BOOKING, booking_id)
+
+
+def bump_driver(driver_id) -> None:
+    bump(DRIVER, driver_id)
+
+
+def versions(*pairs: Tuple[str, object]) -> Tuple[int, ...]:
+    """Current versions of several namespaces in one cache round trip."""
+    keys = [version_key(namespace, object_id) for namespace, object_id in pairs]
+    try:
+        found = cache.get_many(keys)
+    except Exception:
+        found = {}
+    return tuple(int(found.get(key) or 0) for key in keys)
+
+
+def route_info_keys(booking, viewer=None) -> Tuple[str, str]:
+    """
+    Key of the route_info payload for ``booking`` and its stale key (see
+    booking.swr_cache). ``viewer`` separates payloads that depend on who asks
+    (a driver previewing someone else's booking sees their own tricycle).
+
+    The stale key is shared by every driver version of one booking version:
+    after a driver or itinerary change the previous payload is served while
+    it is rebuilt, but a change to the booking itself never serves what was
+    cached before it.
+    """
+    booking_version, driver_version = versions((BOOKING, booking.id), (DRIVER, booking.driver_id or 0))
+    suffix = f':{viewer}' if viewer else ''
+    base = f'route_info:{booking.id}:b{booking_version}'
+    return f'{base}:d{driver_version}{suffix}', f'{base}:latest{suffix}'
+
+
+def route_info_key(booking, viewer=None) -> str:
+    """Key of the route_info payload for ``booking`` (see route_info_keys)."""
+    return route_info_keys(booking, viewer)[0]
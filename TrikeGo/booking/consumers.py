@@ -0,0 +1,138 @@
+from channels.generic.websocket import AsyncWebsocketConsumer
+import json
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from django.db.models import Q
+
+from . import itinerary, location_store, tracking, tracking_protocol
+from .models import Booking, RouteSnapshot
+
+
+class TrackingConsumer(AsyncWebsocketConsumer):
+    """
+    Live tracking for one booking (``ws/tracking/booking/<id>/``, rider or
+    driver of that booking) or for the connected driver (``ws/tracking/driver/``).
+
+    Frames use booking.tracking_protocol: a keyframe with the current status,
+    driver position and ETA (plus the itinerary version on the driver's own
+    socket) on connect, then deltas as tracking
+    events are published (see booking.tracking). ``?format=msgpack`` selects
+    binary frames.
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if not user or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.joined = set()
+        self.driver_id = None
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.binary = query.get('format') == ['msgpack'] and tracking_protocol.binary_available()
+        self.stream = tracking_protocol.TrackingStream()
+        self.booking_id = self.scope['url_route']['kwargs'].get('booking_id')
+
+        if self.booking_id is None:
+            if getattr(user, 'trikego_user', None) != 'D':
+                await self.close()
+                return
+            await self._follow_driver(user.id)
+            await self._join(tracking.itinerary_group(user.id))
+            self.booking = None
+        else:
+            self.booking = await database_sync_to_async(self._load_booking)(self.booking_id, user.id)
+            if self.booking is None:
+                await self.close()
+                return
+            await self._join(tracking.booking_group(self.booking_id))
+            if self.booking['status'] in tracking.ACTIVE_STATUSES:
+                await self._follow_driver(self.booking['driver_id'])
+
+        await self.accept()
+        await database_sync_to_async(self._load_state)()
+        await self._send_frame(self.stream.keyframe())
+
+    async def disconnect(self, close_code):
+        for group in getattr(self, 'joined', ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            payload = tracking_protocol.decode(bytes_data if text_data is None else text_data)
+        except Exception:
+            return
+        if not isinstance(payload, dict):
+            return
+        if payload.get('t') == tracking_protocol.RESYNC:
+            await self._send_frame(self.stream.keyframe())
+        elif payload.get('type') == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+
+    async def tracking_event(self, event):
+        data = event.get('data') or {}
+        name = event.get('event')
+        if name == 'status' and self.booking_id is not None:
+            # Follow the assigned driver's stream only while the trip is active
+            active = data.get('status') in tracking.ACTIVE_STATUSES
+            await self._follow_driver(data.get('driver_id') if active else None)
+        if name == 'location' and data.get('driver_id') != self.driver_id:
+            return  # late fix from a driver we just stopped following
+        frame = self.stream.push(name, data)
+        if frame is not None:
+            await self._send_frame(frame)
+
+    async def _send_frame(self, frame):
+        message = tracking_protocol.encode(frame, binary=self.binary)
+        if isinstance(message, bytes):
+            await self.send(bytes_data=message)
+        else:
+            await self.send(text_data=message)
+
+    async def _join(self, group):
+        if group not in self.joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.joined.add(group)
+
+    async def _follow_driver(self, driver_id):
+        if driver_id == self.driver_id:
+            return
+        if self.driver_id is not None:
+            group = tracking.driver_group(self.driver_id)
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.joined.discard(group)
+            self.stream.forget('p', 'h', 'v')
+        self.driver_id = driver_id
+        if driver_id is not None:
+            await self._join(tracking.driver_group(driver_id))
+
+    def _load_booking(self, booking_id, user_id):
+        return (
+            Booking.objects.filter(id=booking_id)
+            .filter(Q(rider_id=user_id) | Q(driver_id=user_id))
+            .values('id', 'status', 'driver_id')
+            .first()
+        )
+
+    def _load_state(self):
+        stream = self.stream
+        if self.booking is not None:
+            stream.apply('status', {
+                'booking_id': self.booking['id'],
+                'status': self.booking['status'],
+                'driver_id': self.booking['driver_id'],
+            })
+            route = (
+                RouteSnapshot.objects.filter(booking_id=self.booking['id'], is_active=True)
+                .values('distance', 'duration')
+                .first()
+            )
+            if route:
+                stream.apply('eta', route)
+        if self.driver_id is not None:
+            fix = location_store.get_driver_location(self.driver_id)
+            if fix is not None:
+                stream.apply('location', {'lat': fix.latitude, 'lon': fix.longitude,
+                                          'heading': fix.heading, 'speed': fix.speed})
+        if self.booking is None:
+            stream.apply('itinerary', {'version': itinerary.current_version(self.driver_id)})
@@ -1,6 +1,6 @@
 from django import forms
 from .models import Booking
-import math
+from .geometry import haversine_m
 from .models import RatingAndFeedback
 
 class BookingForm(forms.ModelForm):
@@ -16,6 +16,8 @@ class BookingForm(forms.ModelForm):
             'id': 'id_passengers'
         })
     )
+    # Set by the dashboard from /booking/api/quote/ (booking.quotes)
+    quote_id = forms.CharField(required=False, max_length=64, widget=forms.HiddenInput(attrs={'id': 'id_quote_id'}))
     class Meta:
         model = Booking
         fields = [
@@ -83,17 +85,7 @@ class BookingForm(forms.ModelForm):
     
     def _calculate_distance(self, lat1, lon1, lat2, lon2):
         """Calculate distance between two points in meters using Haversine formula"""
-        R = 6371000  # Earth's radius in meters
-        
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        delta_phi = math.radians(lat2 - lat1)
-        delta_lambda = math.radians(lon2 - lon1)
-        
-        a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        
-        return R * c
+        return haversine_m(lat1, lon1, lat2, lon2)
 
     def clean_passengers(self):
         val = self.cleaned_data.get('passengers')
@@ -0,0 +1,293 @@
+"""
+Server-side address autocomplete for the booking forms.
+
+Browsers used to call ORS /geocode/search on every debounced keystroke,
+with the API key in the page. They now call /booking/api/geocode/, which
+answers from, in order:
+
+1. a prefix trie of places already resolved inside the service area
+   (GEOCODE_SERVICE_AREA), when it has GEOCODE_LOCAL_MIN_RESULTS matches;
+2. cached ORS results for the same normalized query;
+3. RoutingService.geocode_address, whose in-area results are added to the
+   trie.
+
+Map clicks are reverse geocoded through /booking/api/geocode/reverse/, cached
+per ~10 m cell.
+
+Results are ranked by distance from the caller when a position is given.
+Known places are kept in the shared cache; each worker builds its own trie
+from them and rebuilds it when another worker learns new places (a shared
+version counter, as in booking.spatial_index).
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.core.cache import cache
+
+from . import geometry
+
+# min_lon,min_lat,max_lon,max_lat of the area whose places are indexed.
+GEOCODE_SERVICE_AREA = tuple(
+    float(v) for v in os.environ.get('GEOCODE_SERVICE_AREA', '123.80,10.20,124.00,10.45').split(',')
+)
+GEOCODE_MIN_QUERY = int(os.environ.get('GEOCODE_MIN_QUERY', 3))
+GEOCODE_RESULT_LIMIT = int(os.environ.get('GEOCODE_RESULT_LIMIT', 10))
+# Local matches needed to answer without ORS.
+GEOCODE_LOCAL_MIN_RESULTS = int(os.environ.get('GEOCODE_LOCAL_MIN_RESULTS', 3))
+GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', 24 * 60 * 60))
+# Empty answers may be an ORS error, so they are only cached briefly.
+GEOCODE_EMPTY_CACHE_TTL = int(os.environ.get('GEOCODE_EMPTY_CACHE_TTL', 60))
+GEOCODE_INDEX_MAX_PLACES = int(os.environ.get('GEOCODE_INDEX_MAX_PLACES', 5000))
+# How often a worker checks whether others have learned new places.
+GEOCODE_INDEX_CHECK_SECONDS = float(os.environ.get('GEOCODE_INDEX_CHECK_SECONDS', 5))
+# How long a worker waits for another one to finish updating the shared places.
+GEOCODE_INDEX_LOCK_WAIT = float(os.environ.get('GEOCODE_INDEX_LOCK_WAIT', 0.5))
+
+PLACES_KEY = 'geocode:places'
+VERSION_KEY = 'geocode:places:version'
+PLACES_LOCK_KEY = 'geocode:places:lock'
+
+
+def normalize(text: str) -> str:
+    """Lowercase, accents and punctuation stripped, whitespace collapsed."""
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+
+def in_service_area(lat: float, lon: float) -> bool:
+    min_lon, min_lat, max_lon, max_lat = GEOCODE_SERVICE_AREA
+    return min_lon <= lon <= max_lon and min_lat <= lat <= max_lat
+
+
+def place_key(place: Dict[str, object]) -> str:
+    return f"{float(place['lat']):.5f},{float(place['lon']):.5f}|{normalize(place.get('formatted') or '')}"
+
+
+class PlaceTrie:
+    """Token prefix trie: every node holds the ids of places with a token starting with its prefix."""
+
+    def __init__(self):
+        self._root: Dict[str, object] = {'ids': set(), 'children': {}}
+        self.places: Dict[str, Dict[str, object]] = {}
+
+    def __len__(self) -> int:
+        return len(self.places)
+
+    def add(self, key: str, place: Dict[str, object]) -> None:
+        if key in self.places:
+            return
+        self.places[key] = place
+        text = f"{place.get('formatted') or ''} {place.get('name') or ''}"
+        for token in set(normalize(text).split()):
+            node = self._root
+            for char in token:
+                node = node['children'].setdefault(char, {'ids': set(), 'children': {}})
+                node['ids'].add(key)
+
+    def _prefix(self, token: str) -> Set[str]:
+        node = self._root
+        for char in token:
+            node = node['children'].get(char)
+            if node is None:
+                return set()
+        return node['ids']
+
+    def search(self, query: str) -> List[Dict[str, object]]:
+        """Places with a token starting with each word of the (normalized) query."""
+        tokens = query.split()
+        if not tokens:
+            return []
+        # Narrowest set first keeps the intersections small
+        sets = sorted((self._prefix(token) for token in tokens), key=len)
+        found = set(sets[0])
+        for ids in sets[1:]:
+            found &= ids
+            if not found:
+                break
+        return [self.places[key] for key in found]
+
+
+class PlaceIndex:
+    """This worker's trie over the shared set of known places."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trie = PlaceTrie()
+        self._version = None
+        self._checked_at = None
+
+    def _shared_version(self):
+        try:
+            return cache.get(VERSION_KEY)
+        except Exception:
+            return None
+
+    def _ensure_fresh(self) -> None:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < GEOCODE_INDEX_CHECK_SECONDS:
+            return
+        self._checked_at = now
+        version = self._shared_version()
+        if self._version is not None and version == self._version:
+            return
+        try:
+            places = cache.get(PLACES_KEY) or {}
+        except Exception:
+            return
+        trie = PlaceTrie()
+        for key, place in places.items():
+            trie.add(key, place)
+        with self._lock:
+            self._trie = trie
+            self._version = version
+
+    def search(self, query: str) -> List[Dict[str, object]]:
+        self._ensure_fresh()
+        with self._lock:
+            return self._trie.search(query)
+
+    def learn(self, results: Iterable[Dict[str, object]]) -> int:
+        """Add in-area results to the shared places and this worker's trie; returns how many were new."""
+        new = {}
+        for place in results:
+            try:
+                lat, lon = float(place['lat']), float(place['lon'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if in_service_area(lat, lon):
+                new[place_key(place)] = {
+                    'formatted': place.get('formatted') or '',
+                    'name': place.get('name') or '',
+                    'lat': lat,
+                    'lon': lon,
+                }
+        with self._lock:
+            new = {key: place for key, place in new.items() if key not in self._trie.places}
+            for key, place in new.items():
+                self._trie.add(key, place)
+        if not new:
+            return 0
+        try:
+            if not self._acquire_shared():
+                print("Geocode place index busy; new places kept in this worker only")
+                return len(new)
+            try:
+                places = cache.get(PLACES_KEY) or {}
+                places.update(new)
+                # Oldest places go first once the index is full
+                for key in list(places)[:max(len(places) - GEOCODE_INDEX_MAX_PLACES, 0)]:
+                    del places[key]
+                cache.set(PLACES_KEY, places, timeout=None)
+                try:
+                    cache.incr(VERSION_KEY)
+                except ValueError:
+                    cache.add(VERSION_KEY, 1, timeout=None)
+            finally:
+                cache.delete(PLACES_LOCK_KEY)
+        except Exception as e:
+            print(f"Geocode place index update failed: {e}")
+        return len(new)
+
+    def _acquire_shared(self) -> bool:
+        """Take the lock on the shared places so concurrent learns don't overwrite each other."""
+        deadline = time.monotonic() + GEOCODE_INDEX_LOCK_WAIT
+        while not cache.add(PLACES_LOCK_KEY, 1, timeout=10):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+        return True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._trie = PlaceTrie()
+            self._version = None
+            self._checked_at = None
+
+
+index = PlaceIndex()
+
+
+def _query_key(query: str) -> str:
+    return f"geocode:q:{hashlib.sha1(query.encode('utf-8')).hexdigest()}"
+
+
+def _rank(places: List[Dict[str, object]], near: Optional[Tuple[float, float]], limit: int):
+    results = []
+    seen = set()
+    for place in places:
+        key = place_key(place)
+        if key in seen:
+            continue
+        seen.add(key)
+        result = {
+            'label': place.get('formatted') or place.get('name') or '',
+            'name': place.get('name') or '',
+            'lat': float(place['lat']),
+            'lon': float(place['lon']),
+        }
+        if near is not None:
+            result['distance_m'] = round(geometry.haversine_m(near[0], near[1], result['lat'], result['lon']))
+        results.append(result)
+    if near is not None:
+        results.sort(key=lambda r: r['distance_m'])
+    return results[:limit]
+
+
+def autocomplete(query: str, near: Optional[Tuple[float, float]] = None,
+                 limit: int = GEOCODE_RESULT_LIMIT) -> Tuple[List[Dict[str, object]], str]:
+    """
+    Places matching ``query``, nearest to ``near`` (lat, lon) first, and where
+    the answer came from: 'local', 'cache' or 'ors'.
+    """
+    normalized = normalize(query)
+    if len(normalized) < GEOCODE_MIN_QUERY:
+        return [], 'local'
+
+    # Shortest labels first when there is no position to rank by
+    local = sorted(index.search(normalized), key=lambda p: (len(p['formatted']), p['formatted']))
+    if len(local) >= GEOCODE_LOCAL_MIN_RESULTS:
+        return _rank(local, near, limit), 'local'
+
+    key = _query_key(normalized)
+    try:
+        remote = cache.get(key)
+    except Exception as e:
+        print(f"Geocode cache read failed: {e}")
+        remote = None
+    source = 'cache'
+    if remote is None:
+        from .services import RoutingService
+        remote = RoutingService().geocode_address(normalized) or []
+        source = 'ors'
+        try:
+            cache.set(key, remote, timeout=GEOCODE_CACHE_TTL if remote else GEOCODE_EMPTY_CACHE_TTL)
+        except Exception as e:
+            print(f"Geocode cache write failed: {e}")
+        index.learn(remote)
+    return _rank(local + remote, near, limit), source
+
+
+def reverse(lat: float, lon: float) -> Optional[Dict[str, object]]:
+    """Address at (lat, lon), cached per ~10 m cell; None when ORS has nothing."""
+    key = f'geocode:r:{lat:.4f},{lon:.4f}'
+    try:
+        cached = cache.get(key)
+    except Exception as e:
+        print(f"Geocode cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        return cached or None
+    from .services import RoutingService
+    place = RoutingService().reverse_geocode(lat, lon)
+    try:
+        # An empty dict marks a miss, cached briefly like empty searches
+        cache.set(key, place or {}, timeout=GEOCODE_CACHE_TTL if place else GEOCODE_EMPTY_CACHE_TTL)
+    except Exception as e:
+        print(f"Geocode cache write failed: {e}")
+    return place
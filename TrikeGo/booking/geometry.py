@@ -0,0 +1,152 @@
+"""
+Great-circle geometry helpers shared by routing, planning and form validation.
+
+Single source of the haversine formula. Scalar calls take a pure-math fast path;
+array inputs are evaluated with NumPy so batched point-to-points, pairwise
+matrix and point-to-polyline checks run as a handful of vector operations
+instead of Python loops.
+
+All coordinates are (lat, lon) in decimal degrees unless a function says
+otherwise. Distances are returned in meters (``*_m``) or kilometers (``*_km``).
+"""
+import math
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def _is_scalar(*values) -> bool:
+    return all(isinstance(v, (int, float)) for v in values)
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Haversine distance in meters. Accepts scalars or broadcastable arrays."""
+    if _is_scalar(lat1, lon1, lat2, lon2):
+        phi1 = math.radians(lat1)
+        phi2 = math.radians(lat2)
+        d_phi = math.radians(lat2 - lat1)
+        d_lambda = math.radians(lon2 - lon1)
+        a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+        return EARTH_RADIUS_M * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    lat1 = np.radians(np.asarray(lat1, dtype=float))
+    lon1 = np.radians(np.asarray(lon1, dtype=float))
+    lat2 = np.radians(np.asarray(lat2, dtype=float))
+    lon2 = np.radians(np.asarray(lon2, dtype=float))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_M * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Haversine distance in kilometers. Accepts scalars or broadcastable arrays."""
+    return haversine_m(lat1, lon1, lat2, lon2) / 1000.0
+
+
+def as_points(points: Iterable[Sequence[float]]) -> np.ndarray:
+    """Coerce an iterable of (lat, lon) pairs (floats or Decimals) into an (N, 2) float array."""
+    arr = np.asarray([(float(p[0]), float(p[1])) for p in points], dtype=float)
+    return arr.reshape(-1, 2)
+
+
+def point_to_points_m(lat: float, lon: float, points) -> np.ndarray:
+    """Distances in meters from one point to each of N (lat, lon) points."""
+    pts = points if isinstance(points, np.ndarray) else as_points(points)
+    if pts.size == 0:
+        return np.empty(0)
+    return haversine_m(float(lat), float(lon), pts[:, 0], pts[:, 1])
+
+
+def pairwise_matrix_m(points_a, points_b=None) -> np.ndarray:
+    """(N, M) matrix of distances in meters between two point sets (or one set with itself)."""
+    a = points_a if isinstance(points_a, np.ndarray) else as_points(points_a)
+    b = a if points_b is None else (points_b if isinstance(points_b, np.ndarray) else as_points(points_b))
+    if a.size == 0 or b.size == 0:
+        return np.empty((len(a), len(b)))
+    return haversine_m(a[:, 0][:, None], a[:, 1][:, None], b[:, 0][None, :], b[:, 1][None, :])
+
+
+def pairwise_matrix_km(points_a, points_b=None) -> np.ndarray:
+    return pairwise_matrix_m(points_a, points_b) / 1000.0
+
+
+def project_local(points: np.ndarray, origin_lat: float, origin_lon: float) -> np.ndarray:
+    """Equirectangular projection of (lat, lon) points to (x, y) meters around an origin.
+
+    Accurate to well under a meter over the few-kilometer extents of a city
+    route, which is all the deviation checks need.
+    """
+    k = math.radians(1.0) * EARTH_RADIUS_M
+    x = (points[:, 1] - origin_lon) * k * math.cos(math.radians(origin_lat))
+    y = (points[:, 0] - origin_lat) * k
+    return np.column_stack((x, y))
+
+
+def point_to_segments_m(px: float, py: float, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Planar distances from (px, py) to each segment starts[i] -> ends[i] (projected meters)."""
+    seg = ends - starts
+    length_sq = np.einsum('ij,ij->i', seg, seg)
+    rel = np.column_stack((px - starts[:, 0], py - starts[:, 1]))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(length_sq > 0, np.einsum('ij,ij->i', rel, seg) / length_sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    closest = starts + seg * t[:, None]
+    return np.hypot(px - closest[:, 0], py - closest[:, 1])
+
+
+def point_to_polyline_m(lat: float, lon: float, polyline, lonlat: bool = False) -> Tuple[float, Optional[int]]:
+    """Minimum distance in meters from a point to a polyline, measured to its segments.
+
+    ``polyline`` is a sequence of (lat, lon) vertices, or (lon, lat) when
+    ``lonlat`` is True (GeoJSON order). Returns (distance, segment_index);
+    the index is None for an empty polyline.
+    """
+    pts = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    if lonlat:
+        pts = pts[:, ::-1]
+    if len(pts) == 0:
+        return float('inf'), None
+    lat = float(lat)
+    lon = float(lon)
+    if len(pts) == 1:
+        return float(haversine_m(lat, lon, float(pts[0, 0]), float(pts[0, 1]))), 0
+
+    xy = project_local(pts, lat, lon)
+    distances = point_to_segments_m(0.0, 0.0, xy[:-1], xy[1:])
+    idx = int(np.argmin(distances))
+    return float(distances[idx]), idx
+
+
+def simplify_polyline(points, tolerance_m: float) -> np.ndarray:
+    """Douglas-Peucker simplification of (lat, lon) vertices.
+
+    Keeps the endpoints and every vertex needed so that the simplified line
+    stays within ``tolerance_m`` of the original.
+    """
+    pts = as_points(points)
+    n = len(pts)
+    if n <= 2:
+        return pts
+    xy = project_local(pts, float(pts[:, 0].mean()), float(pts[:, 1].mean()))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        # distance of each inner vertex to the chord first -> last
+        seg = xy[last] - xy[first]
+        rel = xy[first + 1:last] - xy[first]
+        length_sq = float(seg @ seg)
+        t = np.clip(rel @ seg / length_sq, 0.0, 1.0) if length_sq > 0 else np.zeros(len(rel))
+        offset = rel - t[:, None] * seg
+        distances = np.hypot(offset[:, 0], offset[:, 1])
+        idx = int(np.argmax(distances))
+        if distances[idx] > tolerance_m:
+            split = first + 1 + idx
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return pts[keep]
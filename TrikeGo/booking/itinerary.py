@@ -0,0 +1,146 @@
+"""
+Cached, versioned driver itineraries.
+
+Planning and routing a driver's itinerary is expensive, so it is done when
+something changes rather than on every dashboard poll:
+
+* booking events (accept, cancel, completion) and stop completion;
+* the driver moving more than ITINERARY_REFRESH_DISTANCE_M from where the
+  cached itinerary was planned.
+
+Each event bumps the driver's itinerary version and queues a rebuild. Reads
+serve the payload stored under the current version, so a poll is a couple of
+cache reads. Reads never rebuild while a Celery worker is available: on a
+miss they queue the rebuild and serve the last itinerary built for the
+driver, marked ``stale``, until the new version lands (and is pushed over
+booking.tracking). Only without a worker does a read build it inline.
+"""
+import os
+from typing import Dict, Optional
+
+from django.core.cache import cache
+
+from . import cache_keys, geometry, tracking
+
+ITINERARY_CACHE_TTL = int(os.environ.get('ITINERARY_CACHE_TTL', 60 * 60))
+# Driver movement that makes the cached route worth rebuilding.
+ITINERARY_REFRESH_DISTANCE_M = float(os.environ.get('ITINERARY_REFRESH_DISTANCE_M', 150))
+
+ACTIVE_STATUSES = ['accepted', 'on_the_way', 'started']
+
+
+def _version_key(driver_id) -> str:
+    return f'itinerary_version_{driver_id}'
+
+
+def _payload_key(driver_id, version) -> str:
+    return f'itinerary_{driver_id}_v{version}'
+
+
+def _latest_key(driver_id) -> str:
+    return f'itinerary_{driver_id}_latest'
+
+
+def _anchor_key(driver_id) -> str:
+    return f'itinerary_anchor_{driver_id}'
+
+
+def current_version(driver_id) -> int:
+    version = cache.get(_version_key(driver_id))
+    if version is None:
+        cache.add(_version_key(driver_id), 1, timeout=None)
+        version = cache.get(_version_key(driver_id)) or 1
+    return int(version)
+
+
+def invalidate(driver_id) -> int:
+    """Bump the driver's itinerary version; older payloads are only served as stale copies until a rebuild."""
+    cache_keys.bump_driver(driver_id)
+    try:
+        return int(cache.incr(_version_key(driver_id)))
+    except ValueError:
+        cache.add(_version_key(driver_id), 2, timeout=None)
+        return current_version(driver_id)
+
+
+def refresh_itinerary(driver_user) -> Dict[str, object]:
+    """Re-plan and re-route the driver's itinerary and store it under the current version."""
+    from .models import Booking
+    from .utils import build_driver_itinerary, ensure_booking_stops
+
+    version = current_version(driver_user.id)
+
+    for booking in Booking.objects.filter(driver=driver_user, status__in=ACTIVE_STATUSES):
+        ensure_booking_stops(booking)
+
+    payload = build_driver_itinerary(driver_user)
+    itinerary = payload.get('itinerary') or {}
+    itinerary['version'] = version
+    cache.set_many({
+        _payload_key(driver_user.id, version): payload,
+        _latest_key(driver_user.id): payload,
+    }, timeout=ITINERARY_CACHE_TTL)
+
+    start = itinerary.get('driverStartCoordinate')
+    if start and itinerary.get('stops'):
+        cache.set(_anchor_key(driver_user.id), (float(start[0]), float(start[1])), timeout=ITINERARY_CACHE_TTL)
+    else:
+        cache.delete(_anchor_key(driver_user.id))
+    # route_info payloads cached while this version was being built carry no itinerary
+    cache_keys.bump_driver(driver_user.id)
+    stops = {str(s.get('stopId')): s.get('status') for s in itinerary.get('stops') or [] if s.get('stopId')}
+    tracking.publish_itinerary_version(driver_user.id, version, stops)
+    return payload
+
+
+def get_itinerary(driver_user) -> Dict[str, object]:
+    """
+    Itinerary for the driver's dashboard: the current version, else the last
+    one built marked ``stale`` while a rebuild is queued, else a ``pending``
+    payload with no itinerary yet.
+    """
+    payload = get_itinerary_nowait(driver_user)
+    if payload is not None:
+        return payload
+    stale = cache.get(_latest_key(driver_user.id))
+    if stale is not None:
+        return dict(stale, stale=True)
+    return {'status': 'pending', 'itinerary': None}
+
+
+def get_itinerary_nowait(driver_user) -> Optional[Dict[str, object]]:
+    """
+    Cached itinerary of the current version. On a miss a rebuild is queued
+    (once per version) and None is returned; without a worker it is built
+    inline.
+    """
+    version = current_version(driver_user.id)
+    payload = cache.get(_payload_key(driver_user.id, version))
+    if payload is not None:
+        return payload
+    from .tasks import enqueue, refresh_driver_itinerary
+    if not cache.add(f'itinerary_queued_{driver_user.id}_v{version}', 1, timeout=60):
+        return None
+    if enqueue(refresh_driver_itinerary, driver_user.id):
+        return None
+    return refresh_itinerary(driver_user)
+
+
+def schedule_refresh(driver_id) -> None:
+    """Invalidate now and rebuild in the background (or on the next read if no worker is available)."""
+    invalidate(driver_id)
+    from .tasks import enqueue, refresh_driver_itinerary
+    enqueue(refresh_driver_itinerary, driver_id)
+
+
+def note_driver_moved(driver_id, latitude, longitude) -> bool:
+    """Schedule a rebuild if the driver has moved far from where the itinerary was planned."""
+    anchor = cache.get(_anchor_key(driver_id))
+    if not anchor:
+        return False
+    moved = geometry.haversine_m(float(latitude), float(longitude), anchor[0], anchor[1])
+    if moved < ITINERARY_REFRESH_DISTANCE_M:
+        return False
+    cache.delete(_anchor_key(driver_id))
+    schedule_refresh(driver_id)
+    return True
@@ -0,0 +1,270 @@
+"""
+Buffered ingestion of driver GPS fixes.
+
+Each ping is written straight into the cache (the "hot" latest fix per driver)
+and the driver is marked dirty. Dirty drivers are flushed to the database in
+one bulk upsert every LOCATION_FLUSH_INTERVAL seconds, and sooner when the
+backlog passes LOCATION_BUFFER_MAX_PENDING, so database write load follows
+the flush frequency rather than drivers x ping rate. Each row keeps the time
+its fix was taken.
+
+The dirty set lives in Redis when django-redis is the cache backend, so every
+worker and the Celery flush_driver_locations task share it, and pings only
+queue that task. Otherwise it falls back to a per-process set that a worker
+can't see, so the ping that finds a flush due writes the batch itself (as it
+does when no broker is reachable).
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import tracking
+
+# Seconds between database flushes.
+LOCATION_FLUSH_INTERVAL = float(os.environ.get('LOCATION_FLUSH_INTERVAL', 5))
+# Drivers written per flush; anything beyond stays queued for the next one.
+LOCATION_FLUSH_BATCH_SIZE = int(os.environ.get('LOCATION_FLUSH_BATCH_SIZE', 500))
+# Backpressure: once this many drivers are waiting, queue a flush right away.
+LOCATION_BUFFER_MAX_PENDING = int(os.environ.get('LOCATION_BUFFER_MAX_PENDING', 2000))
+# How long a hot fix stays readable from the cache.
+LOCATION_FIX_TTL = int(os.environ.get('LOCATION_FIX_TTL', 60 * 60))
+
+DIRTY_SET_KEY = 'location_buffer:dirty'
+FLUSH_LOCK_KEY = 'location_buffer:flush_lock'
+FORCED_FLUSH_KEY = 'location_buffer:forced_flush'
+STATS_KEYS = ('received', 'flushed', 'flushes', 'forced_flushes', 'flush_errors')
+
+
+def fix_key(driver_id) -> str:
+    return f'driver_fix_{driver_id}'
+
+
+class _LocalDirtySet:
+    shared = False
+
+    def __init__(self):
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def add(self, *driver_ids) -> None:
+        with self._lock:
+            self._ids.update(driver_ids)
+
+    def pop(self, count: int) -> List[int]:
+        with self._lock:
+            taken = []
+            while self._ids and len(taken) < count:
+                taken.append(self._ids.pop())
+            return taken
+
+    def size(self) -> int:
+        return len(self._ids)
+
+
+class _RedisDirtySet:
+    shared = True
+
+    def __init__(self, connection):
+        self._conn = connection
+
+    def add(self, *driver_ids) -> None:
+        if driver_ids:
+            self._conn.sadd(DIRTY_SET_KEY, *driver_ids)
+
+    def pop(self, count: int) -> List[int]:
+        return [int(v) for v in (self._conn.spop(DIRTY_SET_KEY, count) or [])]
+
+    def size(self) -> int:
+        return int(self._conn.scard(DIRTY_SET_KEY))
+
+
+def _make_dirty_set():
+    try:
+        from django_redis import get_redis_connection
+        return _RedisDirtySet(get_redis_connection('default'))
+    except Exception:
+        # django-redis not installed or the default cache isn't Redis
+        return _LocalDirtySet()
+
+
+_dirty = None
+_dirty_lock = threading.Lock()
+
+
+def _dirty_set():
+    global _dirty
+    if _dirty is None:
+        with _dirty_lock:
+            if _dirty is None:
+                _dirty = _make_dirty_set()
+    return _dirty
+
+
+def _incr(name: str, delta: int = 1) -> None:
+    key = f'location_buffer:stat:{name}'
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, delta, timeout=None)
+    except Exception:
+        pass
+
+
+def _to_str(value) -> Optional[str]:
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def record_fix(driver_id, latitude, longitude, heading=None, speed=None, accuracy=None) -> Dict[str, object]:
+    """Store a driver's latest fix in the hot cache and queue it for the next flush.
+
+    The cached entry is what booking.location_store serves to readers.
+    """
+    fix = {
+        'driver_id': driver_id,
+        'latitude': _to_str(latitude),
+        'longitude': _to_str(longitude),
+        'heading': _to_str(heading),
+        'speed': _to_str(speed),
+        'accuracy': _to_str(accuracy),
+        'timestamp': timezone.now().isoformat(),
+    }
+    cache.set(fix_key(driver_id), fix, timeout=LOCATION_FIX_TTL)
+
+    dirty = _dirty_set()
+    dirty.add(driver_id)
+    _incr('received')
+
+    try:
+        from .spatial_index import registry
+        registry.update_driver(driver_id, latitude, longitude)
+    except Exception:
+        pass
+
+    try:
+        from .itinerary import note_driver_moved
+        note_driver_moved(driver_id, latitude, longitude)
+    except Exception as e:
+        print(f"Itinerary refresh check failed: {e}")
+
+    tracking.publish_location(driver_id, latitude, longitude, heading, speed, fix['timestamp'])
+
+    maybe_flush(dirty)
+    return fix
+
+
+def maybe_flush(dirty=None) -> bool:
+    """
+    Flush if the interval elapsed (cluster-wide) or the backlog is over the
+    limit. A shared dirty set is flushed by a queued task; a per-process one,
+    or any set when the broker is down, is flushed here under the flush
+    lock. Returns True when a flush was queued or ran.
+    """
+    dirty = dirty or _dirty_set()
+    try:
+        due = cache.add(FLUSH_LOCK_KEY, 1, timeout=max(int(LOCATION_FLUSH_INTERVAL), 1))
+        # One forced flush a second at most, however many pings see the backlog
+        forced = not due and dirty.size() >= LOCATION_BUFFER_MAX_PENDING \
+            and cache.add(FORCED_FLUSH_KEY, 1, timeout=1)
+        if not (due or forced):
+            return False
+        if forced:
+            _incr('forced_flushes')
+        if dirty.shared:
+            from .tasks import enqueue, flush_driver_locations
+            if enqueue(flush_driver_locations):
+                return True
+        flush_all()
+        return True
+    except Exception as e:
+        print(f"Location buffer flush check failed: {e}")
+    return False
+
+
+def _decimal(value) -> Optional[Decimal]:
+    return Decimal(value) if value not in (None, '') else None
+
+
+def flush(batch_size: int = LOCATION_FLUSH_BATCH_SIZE) -> int:
+    """Write one batch of buffered fixes to the database. Returns the number of drivers written."""
+    from .models import DriverLocation
+
+    dirty = _dirty_set()
+    driver_ids = dirty.pop(batch_size)
+    if not driver_ids:
+        return 0
+
+    started = time.monotonic()
+    fixes = cache.get_many([fix_key(driver_id) for driver_id in driver_ids])
+    by_driver = {}
+    for fix in fixes.values():
+        if fix and fix.get('latitude') is not None and fix.get('longitude') is not None:
+            by_driver[fix['driver_id']] = fix
+
+    if not by_driver:
+        return 0
+
+    try:
+        DriverLocation.objects.bulk_create(
+            [
+                DriverLocation(
+                    driver_id=driver_id,
+                    latitude=_decimal(fix['latitude']),
+                    longitude=_decimal(fix['longitude']),
+                    heading=_decimal(fix['heading']),
+                    speed=_decimal(fix['speed']),
+                    accuracy=_decimal(fix['accuracy']),
+                    timestamp=datetime.fromisoformat(fix['timestamp']),
+                )
+                for driver_id, fix in by_driver.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['driver'],
+            update_fields=['latitude', 'longitude', 'heading', 'speed', 'accuracy', 'timestamp'],
+        )
+    except Exception as e:
+        # Put the drivers back so the next flush retries them
+        dirty.add(*by_driver.keys())
+        _incr('flush_errors')
+        print(f"Location buffer flush failed: {e}")
+        return 0
+
+    _incr('flushed', len(by_driver))
+    _incr('flushes')
+    cache.set('location_buffer:last_flush', {
+        'at': timezone.now().isoformat(),
+        'drivers': len(by_driver),
+        'duration_ms': round((time.monotonic() - started) * 1000, 2),
+    }, timeout=None)
+    return len(by_driver)
+
+
+def flush_all() -> int:
+    """Drain the whole backlog in batches (used by the periodic task)."""
+    total = 0
+    while True:
+        written = flush()
+        if not written:
+            return total
+        total += written
+
+
+def buffer_stats() -> Dict[str, object]:
+    """Counters and backlog size for monitoring the ingestion buffer."""
+    stats = cache.get_many([f'location_buffer:stat:{name}' for name in STATS_KEYS])
+    result = {name: stats.get(f'location_buffer:stat:{name}', 0) for name in STATS_KEYS}
+    try:
+        result['pending'] = _dirty_set().size()
+    except Exception:
+        result['pending'] = None
+    result['last_flush'] = cache.get('location_buffer:last_flush')
+    result['flush_interval'] = LOCATION_FLUSH_INTERVAL
+    result['max_pending'] = LOCATION_BUFFER_MAX_PENDING
+    return result
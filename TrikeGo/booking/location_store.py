@@ -0,0 +1,121 @@
+"""
+Single read path for driver positions.
+
+The latest fix for each driver lives in the cache under the key written by
+``location_buffer.record_fix``; DriverLocation is its durable copy. Readers go
+through ``get_driver_location`` / ``get_driver_locations``, which serve the
+cache and fall back to one DriverLocation query for whatever is missing,
+caching the result (or the absence of one) on the way out. The backfill
+only adds keys that are still missing, so it never overwrites a newer fix
+record_fix wrote while the query ran.
+"""
+import os
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from django.core.cache import cache
+
+from .location_buffer import LOCATION_FIX_TTL, fix_key
+
+# How long "this driver has no known position" is remembered.
+LOCATION_MISS_TTL = int(os.environ.get('LOCATION_MISS_TTL', 15))
+
+
+class DriverFix(NamedTuple):
+    driver_id: int
+    latitude: float
+    longitude: float
+    heading: Optional[float]
+    speed: Optional[float]
+    accuracy: Optional[float]
+    timestamp: Optional[str]
+
+    @property
+    def latlon(self) -> Tuple[float, float]:
+        return (self.latitude, self.longitude)
+
+    @property
+    def lonlat(self) -> Tuple[float, float]:
+        return (self.longitude, self.latitude)
+
+
+def _float(value) -> Optional[float]:
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def _from_cached(entry) -> Optional[DriverFix]:
+    if not entry or entry.get('latitude') is None or entry.get('longitude') is None:
+        return None
+    return DriverFix(
+        driver_id=entry['driver_id'],
+        latitude=float(entry['latitude']),
+        longitude=float(entry['longitude']),
+        heading=_float(entry.get('heading')),
+        speed=_float(entry.get('speed')),
+        accuracy=_float(entry.get('accuracy')),
+        timestamp=entry.get('timestamp'),
+    )
+
+
+def _to_cached(driver_id, latitude, longitude, heading, speed, accuracy, timestamp) -> Dict[str, object]:
+    return {
+        'driver_id': driver_id,
+        'latitude': str(latitude),
+        'longitude': str(longitude),
+        'heading': str(heading) if heading is not None else None,
+        'speed': str(speed) if speed is not None else None,
+        'accuracy': str(accuracy) if accuracy is not None else None,
+        'timestamp': timestamp.isoformat() if timestamp else None,
+    }
+
+
+def get_driver_locations(driver_ids: Iterable[int]) -> Dict[int, DriverFix]:
+    """Latest fix for each driver that has one, in at most one cache and one database round trip."""
+    from .models import DriverLocation
+
+    driver_ids = list(dict.fromkeys(d for d in driver_ids if d is not None))
+    if not driver_ids:
+        return {}
+
+    cached = cache.get_many([fix_key(driver_id) for driver_id in driver_ids])
+    result = {}
+    missing = []
+    for driver_id in driver_ids:
+        key = fix_key(driver_id)
+        if key not in cached:
+            missing.append(driver_id)
+            continue
+        fix = _from_cached(cached[key])
+        if fix is not None:
+            result[driver_id] = fix
+
+    if missing:
+        rows = DriverLocation.objects.filter(driver_id__in=missing).values_list(
+            'driver_id', 'latitude', 'longitude', 'heading', 'speed', 'accuracy', 'timestamp'
+        )
+        loaded = {row[0]: _to_cached(*row) for row in rows}
+        for driver_id in missing:
+            entry = loaded.get(driver_id)
+            if entry is None:
+                cache.add(fix_key(driver_id), {}, timeout=LOCATION_MISS_TTL)
+            elif not cache.add(fix_key(driver_id), entry, timeout=LOCATION_FIX_TTL):
+                # A ping landed since the cache read; it is newer than the row
+                entry = cache.get(fix_key(driver_id)) or entry
+            fix = _from_cached(entry)
+            if fix is not None:
+                result[driver_id] = fix
+
+    return result
+
+
+def get_driver_location(driver_id) -> Optional[DriverFix]:
+    """Latest fix for one driver (a user id), or None when the position is unknown."""
+    if driver_id is None:
+        return None
+    return get_driver_locations([driver_id]).get(driver_id)
+
+
+def invalidate(driver_id) -> None:
+    """Drop the cached fix so the next read goes to DriverLocation."""
+    cache.delete(fix_key(driver_id))
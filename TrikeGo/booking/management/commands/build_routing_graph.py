@@ -0,0 +1,106 @@
+"""
+Build the offline routing graph from an OSM XML extract.
+
+    python manage.py build_routing_graph cebu.osm routing_graph.npz --bbox 123.80,10.20,124.00,10.45
+
+Only ways with a routable ``highway`` tag are kept. Edge travel times come
+from the way's ``maxspeed`` when present, otherwise from a per-highway-class
+default tuned for tricycle traffic. Point ROUTING_GRAPH_PATH at the output and
+set ROUTING_BACKEND to ``fallback`` or ``offline`` to use it.
+"""
+import xml.etree.ElementTree as ET
+
+from django.core.management.base import BaseCommand, CommandError
+
+from booking import geometry
+from booking.offline_routing import RoadGraph
+
+# km/h by OSM highway class
+DEFAULT_SPEEDS_KMH = {
+    'motorway': 60, 'trunk': 50, 'primary': 40, 'secondary': 35, 'tertiary': 30,
+    'motorway_link': 40, 'trunk_link': 35, 'primary_link': 30, 'secondary_link': 30, 'tertiary_link': 25,
+    'unclassified': 25, 'residential': 20, 'living_street': 10, 'service': 15, 'road': 20,
+}
+
+
+def _parse_speed(value):
+    if not value:
+        return None
+    try:
+        number = float(value.split()[0])
+    except (ValueError, IndexError):
+        return None
+    return number * 1.609 if 'mph' in value else number
+
+
+class Command(BaseCommand):
+    help = 'Convert an OSM XML extract into the compact .npz road graph used by offline routing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='OSM XML file (.osm)')
+        parser.add_argument('output', help='Destination .npz file')
+        parser.add_argument('--bbox', help='min_lon,min_lat,max_lon,max_lat to keep', default=None)
+
+    def handle(self, *args, **options):
+        bbox = None
+        if options['bbox']:
+            try:
+                bbox = [float(v) for v in options['bbox'].split(',')]
+                assert len(bbox) == 4
+            except (ValueError, AssertionError):
+                raise CommandError('--bbox must be min_lon,min_lat,max_lon,max_lat')
+
+        nodes = {}
+        ways = []
+        try:
+            for _, elem in ET.iterparse(options['source'], events=('end',)):
+                if elem.tag == 'node':
+                    lat, lon = float(elem.get('lat')), float(elem.get('lon'))
+                    if bbox is None or (bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                        nodes[elem.get('id')] = (lat, lon)
+                    elem.clear()
+                elif elem.tag == 'way':
+                    tags = {t.get('k'): t.get('v') for t in elem.findall('tag')}
+                    highway = tags.get('highway')
+                    if highway in DEFAULT_SPEEDS_KMH:
+                        refs = [nd.get('ref') for nd in elem.findall('nd')]
+                        speed = _parse_speed(tags.get('maxspeed')) or DEFAULT_SPEEDS_KMH[highway]
+                        ways.append((refs, speed, tags.get('oneway'), tags.get('junction')))
+                    elem.clear()
+        except (OSError, ET.ParseError) as e:
+            raise CommandError(f'Could not read {options["source"]}: {e}')
+
+        index = {}
+        lat, lon, edges = [], [], []
+
+        def node_index(ref):
+            if ref not in index:
+                index[ref] = len(lat)
+                lat.append(nodes[ref][0])
+                lon.append(nodes[ref][1])
+            return index[ref]
+
+        for refs, speed_kmh, oneway, junction in ways:
+            speed_mps = speed_kmh / 3.6
+            forward = oneway != '-1'
+            backward = oneway not in ('yes', 'true', '1', '-1') and junction != 'roundabout'
+            if oneway == '-1':
+                backward = True
+            for a, b in zip(refs, refs[1:]):
+                if a not in nodes or b not in nodes:
+                    continue
+                u, v = node_index(a), node_index(b)
+                length = geometry.haversine_m(nodes[a][0], nodes[a][1], nodes[b][0], nodes[b][1])
+                if forward:
+                    edges.append((u, v, length, length / speed_mps))
+                if backward:
+                    edges.append((v, u, length, length / speed_mps))
+
+        if not edges:
+            raise CommandError('No routable roads found in the extract.')
+
+        graph = RoadGraph.from_edges(lat, lon, edges)
+        graph.save(options['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(graph)} nodes and {len(edges)} edges to {options["output"]}'
+        ))
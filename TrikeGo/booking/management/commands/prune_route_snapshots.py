@@ -0,0 +1,27 @@
+"""
+Run route snapshot retention once, outside the Celery beat schedule.
+
+    python manage.py prune_route_snapshots --dry-run
+
+``--dry-run`` applies the policies inside a transaction that is rolled back,
+so it reports what a real run would reclaim without changing anything.
+"""
+from django.core.management.base import BaseCommand
+
+from booking import route_retention
+
+
+class Command(BaseCommand):
+    help = 'Trim live route histories and compact finished trips into one simplified snapshot.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report without deleting or rewriting anything')
+        parser.add_argument('--batch-size', type=int, default=route_retention.ROUTE_RETENTION_BATCH)
+
+    def handle(self, *args, **options):
+        report = route_retention.prune(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        prefix = 'Would reclaim' if options['dry_run'] else 'Reclaimed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} ~{report['bytes_reclaimed']} bytes: {report['deleted']} snapshots deleted, "
+            f"{report['rewritten']} rewritten across {report['bookings']} bookings"
+        ))
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.6 on 2026-10-18 08:29
+
+from django.db import migrations, models
+
+# Frozen copy of booking.polyline.compact_route as of this migration, so later
+# changes to that module can't change what the migration writes.
+STEP_FIELDS = ('instruction', 'name', 'type', 'distance', 'duration', 'way_points')
+
+
+def _encode_value(value, out):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_lonlat(coordinates):
+    out = []
+    prev_lat = prev_lon = 0
+    for c in coordinates:
+        lat = int(round(float(c[1]) * 100000))
+        lon = int(round(float(c[0]) * 100000))
+        _encode_value(lat - prev_lat, out)
+        _encode_value(lon - prev_lon, out)
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+
+def compact_route(route_data):
+    try:
+        feature = route_data['features'][0]
+    except (KeyError, IndexError, TypeError):
+        return {'geometry': '', 'steps': []}
+    coordinates = (feature.get('geometry') or {}).get('coordinates') or []
+    steps = []
+    for segment in (feature.get('properties') or {}).get('segments') or []:
+        for step in segment.get('steps') or []:
+            steps.append({field: step[field] for field in STEP_FIELDS if field in step})
+    return {'geometry': encode_lonlat(coordinates), 'steps': steps}
+
+
+def compact_snapshots(apps, schema_editor):
+    RouteSnapshot = apps.get_model('booking', 'RouteSnapshot')
+    pending = RouteSnapshot.objects.filter(geometry='', route_data__isnull=False)
+    batch = []
+    for snapshot in pending.iterator(chunk_size=500):
+        compact = compact_route(snapshot.route_data)
+        if not compact['geometry']:
+            continue
+        snapshot.geometry = compact['geometry']
+        snapshot.steps = compact['steps']
+        snapshot.route_data = None
+        batch.append(snapshot)
+        if len(batch) >= 500:
+            RouteSnapshot.objects.bulk_update(batch, ['geometry', 'steps', 'route_data'])
+            batch = []
+    if batch:
+        RouteSnapshot.objects.bulk_update(batch, ['geometry', 'steps', 'route_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0009_ratingandfeedback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routesnapshot',
+            name='geometry',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='routesnapshot',
+            name='steps',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='routesnapshot',
+            name='route_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(compact_snapshots, migrations.RunPython.noop),
+    ]
@@ -157,7 +157,8 @@ class DriverLocation(models.Model):
     heading = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)  # Direction in degrees
     speed = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)  # Speed in km/h
     accuracy = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)  # in meters
-    timestamp = models.DateTimeField(auto_now=True)
+    # When the fix was taken; booking.location_buffer writes it in batches later
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
         verbose_name = "Driver Location"
@@ -170,7 +171,10 @@ class DriverLocation(models.Model):
 class RouteSnapshot(models.Model):
     """Store route snapshots for rerouting and history"""
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='routes')
-    route_data = models.JSONField()  # Store GeoJSON route data
+    # Legacy full GeoJSON response; new snapshots store geometry/steps instead
+    route_data = models.JSONField(null=True, blank=True)
+    geometry = models.TextField(blank=True, default='')  # Encoded polyline, precision 5
+    steps = models.JSONField(null=True, blank=True)  # Compact turn-by-turn metadata
     distance = models.DecimalField(max_digits=10, decimal_places=2)  # in km
     duration = models.IntegerField()  # in seconds
     created_at = models.DateTimeField(auto_now_add=True)
@@ -181,6 +185,44 @@ class RouteSnapshot(models.Model):
     
     def __str__(self):
         return f"Route for Booking {self.booking.id} at {self.created_at}"
+
+    @property
+    def coordinates(self):
+        """Route vertices as (lat, lon) pairs, decoded on first access."""
+        cached = self.__dict__.get('_coordinates')
+        if cached is None:
+            from .polyline import decode
+            if self.geometry:
+                cached = decode(self.geometry)
+            else:
+                try:
+                    lonlat = self.route_data['features'][0]['geometry']['coordinates']
+                    cached = [(float(c[1]), float(c[0])) for c in lonlat]
+                except (KeyError, IndexError, TypeError):
+                    cached = []
+            self.__dict__['_coordinates'] = cached
+        return cached
+
+    def as_geojson(self):
+        """GeoJSON FeatureCollection equivalent, for clients that still expect ORS output."""
+        if self.route_data and not self.geometry:
+            return self.route_data
+        return {
+            'type': 'FeatureCollection',
+            'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat, lon in self.coordinates]},
+                'properties': {
+                    'summary': {'distance': float(self.distance) * 1000, 'duration': self.duration},
+                    # ORS nests steps in segments; one segment covers the whole route
+                    'segments': [{
+                        'distance': float(self.distance) * 1000,
+                        'duration': self.duration,
+                        'steps': self.steps or [],
+                    }],
+                },
+            }],
+        }
     
 class RatingAndFeedback(models.Model):
     """Stores the rider's rating and feedback for a specific booking."""
@@ -0,0 +1,265 @@
+"""
+In-process routing over a preprocessed road graph.
+
+The graph is a directed CSR adjacency (``indptr``/``indices``) with per-edge
+length and travel time, plus node coordinates, stored as one ``.npz`` file
+built from an OSM extract by ``manage.py build_routing_graph``. Queries snap
+the endpoints to the nearest graph nodes and run A* on travel time with a
+straight-line / top-speed heuristic, so answers are exact shortest-time
+paths.
+
+RoutingService uses it according to ROUTING_BACKEND:
+
+* ``ors`` (default) - ORS only;
+* ``fallback`` - ORS first, this graph when ORS fails or is rate limited;
+* ``offline`` - this graph first, ORS only when the graph can't answer.
+
+Results have the same shape as ``RoutingService.calculate_route`` (a GeoJSON
+FeatureCollection in ``route_data``), so snapshots, deviation checks and the
+frontend don't care which engine produced them.
+"""
+import heapq
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import geometry
+
+ROUTING_BACKEND = os.environ.get('ROUTING_BACKEND', 'ors')
+ROUTING_GRAPH_PATH = os.environ.get('ROUTING_GRAPH_PATH', '')
+# Endpoints further than this from the road network are not routed offline.
+OFFLINE_SNAP_MAX_M = float(os.environ.get('OFFLINE_SNAP_MAX_M', 500))
+# Speed assumed for the stretch between an endpoint and its snapped node.
+SNAP_SPEED_MPS = 5.0
+
+
+class RoadGraph:
+    """Directed road graph in CSR form: the edges leaving node ``u`` are ``indptr[u]:indptr[u + 1]``."""
+
+    def __init__(self, lat, lon, indptr, indices, length_m, duration_s):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.length_m = np.asarray(length_m, dtype=np.float32)
+        self.duration_s = np.asarray(duration_s, dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speeds = self.length_m / self.duration_s
+        finite = speeds[np.isfinite(speeds)]
+        self.max_speed_mps = float(finite.max()) if finite.size else 1.0
+        # Plain lists make the A* inner loop much faster than NumPy scalar indexing
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._length = self.length_m.tolist()
+        self._duration = self.duration_s.tolist()
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    @classmethod
+    def from_edges(cls, lat, lon, edges: Iterable[Tuple[int, int, float, float]]) -> 'RoadGraph':
+        """Build from directed (u, v, length_m, duration_s) edges."""
+        edges = np.asarray(list(edges), dtype=np.float64).reshape(-1, 4)
+        n = len(lat)
+        order = np.lexsort((edges[:, 1], edges[:, 0]))
+        edges = edges[order]
+        sources = edges[:, 0].astype(np.int64)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(indptr, sources + 1, 1)
+        indptr = np.cumsum(indptr)
+        return cls(lat, lon, indptr, edges[:, 1].astype(np.int32), edges[:, 2], edges[:, 3])
+
+    @classmethod
+    def load(cls, path: str) -> 'RoadGraph':
+        with np.load(path) as data:
+            return cls(data['lat'], data['lon'], data['indptr'], data['indices'], data['length_m'], data['duration_s'])
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path,
+            lat=self.lat, lon=self.lon,
+            indptr=self.indptr, indices=self.indices,
+            length_m=self.length_m, duration_s=self.duration_s,
+        )
+
+    def nearest_node(self, lat: float, lon: float) -> Tuple[int, float]:
+        """Closest node and its distance in meters."""
+        distances = geometry.haversine_m(float(lat), float(lon), self.lat, self.lon)
+        idx = int(np.argmin(distances))
+        return idx, float(distances[idx])
+
+    def shortest_path(self, source: int, target: int) -> Optional[Tuple[List[int], float, float]]:
+        """A* on travel time. Returns (nodes, length_m, duration_s), or None if unreachable."""
+        if source == target:
+            return [source], 0.0, 0.0
+        heuristic = (geometry.haversine_m(self.lat[target], self.lon[target], self.lat, self.lon)
+                     / self.max_speed_mps).tolist()
+        indptr, indices, lengths, durations = self._indptr, self._indices, self._length, self._duration
+
+        best = {source: 0.0}
+        parent = {source: (-1, 0.0)}
+        heap = [(heuristic[source], 0.0, source)]
+        closed = set()
+        while heap:
+            _, cost, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            if node == target:
+                break
+            closed.add(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                nxt = indices[edge]
+                new_cost = cost + durations[edge]
+                if new_cost < best.get(nxt, float('inf')):
+                    best[nxt] = new_cost
+                    parent[nxt] = (node, lengths[edge])
+                    heapq.heappush(heap, (new_cost + heuristic[nxt], new_cost, nxt))
+        else:
+            return None
+
+        path = []
+        length = 0.0
+        node = target
+        while node != -1:
+            path.append(node)
+            prev, edge_length = parent[node]
+            length += edge_length
+            node = prev
+        return path[::-1], length, best[target]
+
+    def one_to_many(self, source: int, targets: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Dijkstra from one node until every target is settled. Returns (length_m, duration_s) per target."""
+        remaining = set(targets)
+        indptr, indices, lengths, durations = self._indptr, self._indices, self._length, self._duration
+        best = {source: (0.0, 0.0)}
+        heap = [(0.0, 0.0, source)]
+        closed = set()
+        while heap and remaining:
+            cost, length, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            closed.add(node)
+            remaining.discard(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                nxt = indices[edge]
+                new_cost = cost + durations[edge]
+                if new_cost < best.get(nxt, (float('inf'), 0.0))[0]:
+                    best[nxt] = (new_cost, length + lengths[edge])
+                    heapq.heappush(heap, (new_cost, length + lengths[edge], nxt))
+        out_length = np.array([best[t][1] if t in closed else np.nan for t in targets])
+        out_duration = np.array([best[t][0] if t in closed else np.nan for t in targets])
+        return out_length, out_duration
+
+
+_graph = None
+_load_failed = False
+_lock = threading.Lock()
+
+
+def get_graph() -> Optional[RoadGraph]:
+    """The configured graph, loaded once per process; None when not configured or unreadable."""
+    global _graph, _load_failed
+    if _graph is not None:
+        return _graph
+    if not ROUTING_GRAPH_PATH or _load_failed:
+        return None
+    with _lock:
+        if _graph is None and not _load_failed:
+            try:
+                _graph = RoadGraph.load(ROUTING_GRAPH_PATH)
+            except Exception as e:
+                print(f"Could not load routing graph {ROUTING_GRAPH_PATH}: {e}")
+                _load_failed = True
+    return _graph
+
+
+def set_graph(graph: Optional[RoadGraph]) -> None:
+    """Install a graph directly (tests, or a graph built in-process); None reverts to ROUTING_GRAPH_PATH."""
+    global _graph, _load_failed
+    with _lock:
+        _graph = graph
+        _load_failed = False
+
+
+def enabled() -> bool:
+    return ROUTING_BACKEND in ('offline', 'fallback')
+
+
+def preferred() -> bool:
+    return ROUTING_BACKEND == 'offline'
+
+
+def _snap(graph: RoadGraph, lonlat) -> Optional[Tuple[int, float]]:
+    node, offset = graph.nearest_node(lonlat[1], lonlat[0])
+    if offset > OFFLINE_SNAP_MAX_M:
+        return None
+    return node, offset
+
+
+def route(start_coords, end_coords, graph: Optional[RoadGraph] = None) -> Optional[Dict[str, object]]:
+    """
+    Shortest-time route between two (lon, lat) points.
+
+    Returns a dict shaped like RoutingService.calculate_route's result, or
+    None when no graph is loaded, an endpoint is off the network, or the
+    nodes aren't connected.
+    """
+    graph = graph or get_graph()
+    if graph is None:
+        return None
+    start = _snap(graph, start_coords)
+    end = _snap(graph, end_coords)
+    if start is None or end is None:
+        return None
+    found = graph.shortest_path(start[0], end[0])
+    if found is None:
+        return None
+    nodes, length_m, duration_s = found
+    length_m += start[1] + end[1]
+    duration_s += (start[1] + end[1]) / SNAP_SPEED_MPS
+
+    coordinates = [[float(start_coords[0]), float(start_coords[1])]]
+    coordinates += [[float(graph.lon[n]), float(graph.lat[n])] for n in nodes]
+    coordinates.append([float(end_coords[0]), float(end_coords[1])])
+    route_data = {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': coordinates},
+            'properties': {
+                'segments': [{'distance': length_m, 'duration': duration_s, 'steps': []}],
+                'summary': {'distance': length_m, 'duration': duration_s},
+                'way_points': [0, len(coordinates) - 1],
+                'engine': 'offline',
+            },
+        }],
+    }
+    return {
+        'route_data': route_data,
+        'distance': round(length_m / 1000, 2),
+        'duration': int(duration_s),
+        'too_close': False,
+    }
+
+
+def matrix(sources, destinations, graph: Optional[RoadGraph] = None) -> Optional[Dict[str, np.ndarray]]:
+    """Distance (km) / duration (s) matrix between (lon, lat) points; unreachable cells are NaN."""
+    graph = graph or get_graph()
+    if graph is None:
+        return None
+    snapped_src = [_snap(graph, p) for p in sources]
+    snapped_dst = [_snap(graph, p) for p in destinations]
+    distances = np.full((len(sources), len(destinations)), np.nan)
+    durations = np.full((len(sources), len(destinations)), np.nan)
+    targets = [s[0] for s in snapped_dst if s is not None]
+    columns = [j for j, s in enumerate(snapped_dst) if s is not None]
+    for i, src in enumerate(snapped_src):
+        if src is None or not targets:
+            continue
+        lengths, times = graph.one_to_many(src[0], targets)
+        offsets = np.array([src[1] + snapped_dst[j][1] for j in columns])
+        distances[i, columns] = (lengths + offsets) / 1000.0
+        durations[i, columns] = times + offsets / SNAP_SPEED_MPS
+    return {'distances': distances, 'durations': durations}
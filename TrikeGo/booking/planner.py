@@ -0,0 +1,313 @@
+"""
+Stop ordering for a driver's shared trips (pickup-and-delivery).
+
+A ``PlanningProblem`` holds the driver's start, the pending stops and a leg
+cost matrix. Every plan respects two constraints:
+
+* precedence - a booking's pickup comes before its dropoff;
+* capacity - the passengers on board never exceed the tricycle's capacity.
+
+Strategies are registered in ``PLANNERS``:
+
+* ``insertion`` - cheapest insertion, one booking at a time;
+* ``local_search`` - insertion followed by 2-opt and or-opt moves until no
+  move improves the route or the time budget runs out;
+* ``exact`` - dynamic programming over stop subsets, for small problems;
+* ``auto`` (default) - exact up to PLANNER_EXACT_MAX_STOPS stops, local
+  search beyond that.
+
+The module has no Django dependencies; ``booking.utils.plan_driver_stops``
+builds the problem from BookingStop rows and stores the resulting order.
+"""
+import os
+import time
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import geometry
+
+# Strategy used when callers don't ask for one.
+ITINERARY_PLANNER = os.environ.get('ITINERARY_PLANNER', 'auto')
+# Largest number of stops solved exactly by ``auto``.
+PLANNER_EXACT_MAX_STOPS = int(os.environ.get('PLANNER_EXACT_MAX_STOPS', 10))
+# Wall-clock budget for local search, in milliseconds.
+PLANNER_TIME_BUDGET_MS = float(os.environ.get('PLANNER_TIME_BUDGET_MS', 50))
+
+PICKUP = 'PICKUP'
+DROPOFF = 'DROPOFF'
+
+
+class PlanStop(NamedTuple):
+    key: Hashable            # caller's identifier, e.g. a BookingStop id
+    group: Hashable          # stops of one booking share a group
+    kind: str                # PICKUP or DROPOFF
+    load: int                # passengers boarding or leaving
+    coord: Tuple[float, float]  # (lat, lon)
+
+
+class PlanningProblem:
+    """Pending stops plus everything needed to cost and validate an order.
+
+    Node 0 is the driver's start; stop ``i`` is node ``i + 1``. Without a
+    start the first leg is free. ``onboard`` is the load already in the
+    vehicle (pickups done, dropoffs pending).
+    """
+
+    def __init__(
+        self,
+        stops: Sequence[PlanStop],
+        start: Optional[Tuple[float, float]] = None,
+        capacity: Optional[int] = None,
+        onboard: int = 0,
+        matrix: Optional[np.ndarray] = None,
+    ):
+        self.stops = list(stops)
+        self.start = start
+        self.onboard = int(onboard)
+        n = len(self.stops)
+
+        if matrix is None:
+            points = [start or (0.0, 0.0)] + [s.coord for s in self.stops]
+            matrix = geometry.pairwise_matrix_km(points)
+            if start is None:
+                matrix[0, :] = 0.0
+        self.matrix = np.asarray(matrix, dtype=float)
+        if self.matrix.shape != (n + 1, n + 1):
+            raise ValueError('cost matrix must be (stops + 1) square')
+
+        # pickup index for each dropoff whose pickup is still pending
+        pickup_of = {s.group: i for i, s in enumerate(self.stops) if s.kind == PICKUP}
+        self.pickup_for: Dict[int, int] = {
+            i: pickup_of[s.group]
+            for i, s in enumerate(self.stops)
+            if s.kind == DROPOFF and s.group in pickup_of
+        }
+        self.delta = [s.load if s.kind == PICKUP else -s.load for s in self.stops]
+
+        # Never tighter than the trivial schedule (drop everyone, then serve
+        # bookings one at a time), so a feasible plan always exists.
+        widest = max([s.load for s in self.stops if s.kind == PICKUP], default=0)
+        floor = max(self.onboard, widest)
+        self.capacity = max(int(capacity), floor) if capacity else None
+
+    def __len__(self) -> int:
+        return len(self.stops)
+
+    def cost(self, order: Sequence[int]) -> float:
+        total = 0.0
+        prev = 0
+        m = self.matrix
+        for i in order:
+            total += m[prev, i + 1]
+            prev = i + 1
+        return float(total)
+
+    def feasible(self, order: Sequence[int]) -> bool:
+        load = self.onboard
+        seen = set()
+        for i in order:
+            pickup = self.pickup_for.get(i)
+            if pickup is not None and pickup not in seen:
+                return False
+            load += self.delta[i]
+            if self.capacity is not None and load > self.capacity:
+                return False
+            seen.add(i)
+        return True
+
+
+class Planner:
+    name = ''
+
+    def solve(self, problem: PlanningProblem) -> List[int]:
+        raise NotImplementedError
+
+
+class InsertionPlanner(Planner):
+    """Cheapest insertion: dropoffs for passengers on board first, then one booking at a time."""
+
+    name = 'insertion'
+
+    def solve(self, problem: PlanningProblem, order: Optional[List[int]] = None) -> List[int]:
+        order = list(order or [])
+        placed = set(order)
+        pairs = {pickup: dropoff for dropoff, pickup in problem.pickup_for.items()}
+        paired_dropoffs = set(problem.pickup_for)
+
+        singles = [i for i in range(len(problem)) if i not in placed and i not in pairs and i not in paired_dropoffs]
+        for i in singles:
+            order = self.insert(problem, order, [i])
+
+        # Place bookings nearest the start first; it keeps early insertions stable
+        pending_pairs = sorted(
+            (p for p in pairs if p not in placed),
+            key=lambda p: problem.matrix[0, p + 1],
+        )
+        for pickup in pending_pairs:
+            order = self.insert(problem, order, [pickup, pairs[pickup]])
+        return order
+
+    @staticmethod
+    def insert(problem: PlanningProblem, order: List[int], nodes: List[int]) -> List[int]:
+        """Return ``order`` with ``nodes`` (one stop, or a pickup and its dropoff) inserted at least cost."""
+        best = None
+        best_cost = float('inf')
+        n = len(order)
+        if len(nodes) == 1:
+            candidates = ((order[:i] + nodes + order[i:]) for i in range(n + 1))
+        else:
+            first, second = nodes
+            candidates = (
+                order[:i] + [first] + order[i:j] + [second] + order[j:]
+                for i in range(n + 1)
+                for j in range(i, n + 1)
+            )
+        for candidate in candidates:
+            if not problem.feasible(candidate):
+                continue
+            cost = problem.cost(candidate)
+            if cost < best_cost:
+                best, best_cost = candidate, cost
+        if best is None:
+            # Can't happen with the capacity floor, but never lose a stop
+            best = order + nodes
+        return best
+
+
+class LocalSearchPlanner(Planner):
+    """Insertion start improved with 2-opt and or-opt moves under a time budget."""
+
+    name = 'local_search'
+
+    def __init__(self, time_budget_ms: float = PLANNER_TIME_BUDGET_MS):
+        self.time_budget_ms = time_budget_ms
+
+    def solve(self, problem: PlanningProblem, order: Optional[List[int]] = None) -> List[int]:
+        order = InsertionPlanner().solve(problem, order)
+        deadline = time.monotonic() + self.time_budget_ms / 1000.0
+        best_cost = problem.cost(order)
+
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for candidate in self._neighbours(order):
+                if time.monotonic() >= deadline:
+                    break
+                if not problem.feasible(candidate):
+                    continue
+                cost = problem.cost(candidate)
+                if cost < best_cost - 1e-9:
+                    order, best_cost = candidate, cost
+                    improved = True
+                    break
+        return order
+
+    @staticmethod
+    def _neighbours(order: List[int]):
+        n = len(order)
+        # 2-opt: reverse a segment
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                yield order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+        # or-opt: move a run of 1-3 stops elsewhere
+        for length in (1, 2, 3):
+            for i in range(n - length + 1):
+                segment = order[i:i + length]
+                rest = order[:i] + order[i + length:]
+                for j in range(len(rest) + 1):
+                    if j != i:
+                        yield rest[:j] + segment + rest[j:]
+
+
+class ExactPlanner(Planner):
+    """Held-Karp style dynamic programming over visited-stop subsets (O(2^n * n^2))."""
+
+    name = 'exact'
+
+    def solve(self, problem: PlanningProblem, order: Optional[List[int]] = None) -> List[int]:
+        n = len(problem)
+        if n == 0:
+            return []
+        full = (1 << n) - 1
+        m = problem.matrix
+        inf = float('inf')
+
+        load = [problem.onboard] * (1 << n)
+        for mask in range(1, 1 << n):
+            low = (mask & -mask).bit_length() - 1
+            load[mask] = load[mask & (mask - 1)] + problem.delta[low]
+
+        required = [0] * n
+        for dropoff, pickup in problem.pickup_for.items():
+            required[dropoff] = 1 << pickup
+
+        cost = [[inf] * n for _ in range(1 << n)]
+        parent = [[-1] * n for _ in range(1 << n)]
+        cap = problem.capacity
+
+        for i in range(n):
+            bit = 1 << i
+            if required[i] == 0 and (cap is None or load[bit] <= cap):
+                cost[bit][i] = m[0, i + 1]
+
+        for mask in range(1, 1 << n):
+            row = cost[mask]
+            for last in range(n):
+                base = row[last]
+                if base == inf:
+                    continue
+                for nxt in range(n):
+                    bit = 1 << nxt
+                    if mask & bit or (required[nxt] and not mask & required[nxt]):
+                        continue
+                    new_mask = mask | bit
+                    if cap is not None and load[new_mask] > cap:
+                        continue
+                    value = base + m[last + 1, nxt + 1]
+                    if value < cost[new_mask][nxt]:
+                        cost[new_mask][nxt] = value
+                        parent[new_mask][nxt] = last
+
+        last = min(range(n), key=lambda i: cost[full][i])
+        if cost[full][last] == inf:
+            return InsertionPlanner().solve(problem)
+        result = []
+        mask = full
+        while last != -1:
+            result.append(last)
+            prev = parent[mask][last]
+            mask &= ~(1 << last)
+            last = prev
+        return result[::-1]
+
+
+class AutoPlanner(Planner):
+    name = 'auto'
+
+    def solve(self, problem: PlanningProblem, order: Optional[List[int]] = None) -> List[int]:
+        if len(problem) <= PLANNER_EXACT_MAX_STOPS:
+            return ExactPlanner().solve(problem)
+        return LocalSearchPlanner().solve(problem, order)
+
+
+PLANNERS: Dict[str, Callable[[], Planner]] = {
+    InsertionPlanner.name: InsertionPlanner,
+    LocalSearchPlanner.name: LocalSearchPlanner,
+    ExactPlanner.name: ExactPlanner,
+    AutoPlanner.name: AutoPlanner,
+}
+
+
+def get_planner(name: Optional[str] = None) -> Planner:
+    factory = PLANNERS.get(name or ITINERARY_PLANNER)
+    if factory is None:
+        print(f"Unknown itinerary planner {name or ITINERARY_PLANNER!r}; using auto")
+        factory = AutoPlanner
+    return factory()
+
+
+def plan(problem: PlanningProblem, strategy: Optional[str] = None) -> List[Hashable]:
+    """Order the problem's stops and return their keys."""
+    order = get_planner(strategy).solve(problem)
+    return [problem.stops[i].key for i in order]
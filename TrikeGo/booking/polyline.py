@@ -0,0 +1,85 @@
+"""
+Encoded polyline format (the Google / OSRM / ORS ``geometry`` encoding).
+
+Coordinates are rounded to ``precision`` decimal places, delta-encoded and
+written as base64-ish varints, which brings a route down to a few bytes per
+vertex versus ~40 for GeoJSON floats. Precision 5 is about 1.1 m, finer than
+any GPS fix we get.
+
+Points are (lat, lon) pairs, the order the format defines.
+"""
+from typing import Iterable, List, Sequence, Tuple
+
+DEFAULT_PRECISION = 5
+
+
+def _encode_value(value: int, out: List[str]) -> None:
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode(points: Iterable[Sequence[float]], precision: int = DEFAULT_PRECISION) -> str:
+    """Encode (lat, lon) points into a polyline string."""
+    factor = 10 ** precision
+    out: List[str] = []
+    prev_lat = prev_lon = 0
+    for point in points:
+        lat = int(round(float(point[0]) * factor))
+        lon = int(round(float(point[1]) * factor))
+        _encode_value(lat - prev_lat, out)
+        _encode_value(lon - prev_lon, out)
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+
+def decode(encoded: str, precision: int = DEFAULT_PRECISION) -> List[Tuple[float, float]]:
+    """Decode a polyline string into (lat, lon) points."""
+    factor = float(10 ** precision)
+    points: List[Tuple[float, float]] = []
+    index = 0
+    length = len(encoded or '')
+    lat = lon = 0
+    while index < length:
+        deltas = []
+        for _ in range(2):
+            result = shift = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1f) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        points.append((lat / factor, lon / factor))
+    return points
+
+
+def encode_lonlat(coordinates: Iterable[Sequence[float]], precision: int = DEFAULT_PRECISION) -> str:
+    """Encode GeoJSON-ordered (lon, lat) coordinates."""
+    return encode(((c[1], c[0]) for c in coordinates), precision)
+
+
+STEP_FIELDS = ('instruction', 'name', 'type', 'distance', 'duration', 'way_points')
+
+
+def compact_route(route_data) -> dict:
+    """
+    Split an ORS GeoJSON response into an encoded ``geometry`` and a flat
+    ``steps`` list keeping only the fields the apps display.
+    """
+    try:
+        feature = route_data['features'][0]
+    except (KeyError, IndexError, TypeError):
+        return {'geometry': '', 'steps': []}
+    coordinates = (feature.get('geometry') or {}).get('coordinates') or []
+    steps = []
+    for segment in (feature.get('properties') or {}).get('segments') or []:
+        for step in segment.get('steps') or []:
+            steps.append({field: step[field] for field in STEP_FIELDS if field in step})
+    return {'geometry': encode_lonlat(coordinates), 'steps': steps}
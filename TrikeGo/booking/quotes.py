@@ -0,0 +1,157 @@
+"""
+Ride quotes.
+
+The rider dashboard asks for a quote as soon as pickup and destination are
+both set. The route, distance, duration and fare are worked out then and
+cached under a quote id for QUOTE_TTL seconds; creating the booking only
+looks the quote up, so the form POST is a plain insert. The route itself
+stays in the route cache, where route_info's rider preview finds it.
+
+A booking created without a usable quote (expired, other coordinates, no
+JavaScript) is priced from the route cache when possible, otherwise by
+estimate_booking_fare in the background. Requests never route: without a
+worker the booking stays unpriced, and the rider dashboard and booking page
+retry (retry_pricing) until its route is cached or a worker picks it up.
+"""
+import os
+import time
+import uuid
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+from django.core.cache import cache
+
+from . import polyline
+from .route_cache import route_cache
+from .services import RoutingService
+
+QUOTE_TTL = int(os.environ.get('QUOTE_TTL', 10 * 60))
+# Minimum gap between estimate_booking_fare tasks queued for one booking.
+PRICING_RETRY_SECONDS = int(os.environ.get('PRICING_RETRY_SECONDS', 60))
+
+LonLat = Tuple[float, float]
+
+
+def _key(quote_id) -> str:
+    return f'quote:{quote_id}'
+
+
+def _estimates(route) -> Dict[str, object]:
+    """Distance (km), duration (min) and fare for a calculate_route result, priced by Booking.calculate_fare."""
+    from .models import Booking
+
+    if not route or route.get('too_close'):
+        return {'distance_km': None, 'duration_min': None, 'fare': None}
+    booking = Booking(
+        estimated_distance=Decimal(str(route['distance'])),
+        estimated_duration=int(route['duration']) // 60,
+    )
+    fare = booking.calculate_fare()
+    return {
+        'distance_km': str(booking.estimated_distance),
+        'duration_min': booking.estimated_duration,
+        'fare': str(fare) if fare is not None else None,
+    }
+
+
+def create_quote(rider_id, pickup: LonLat, destination: LonLat) -> Optional[Dict[str, object]]:
+    """Route and price a trip, cache the quote and return it (None when no route could be found)."""
+    route = RoutingService().calculate_route(pickup, destination)
+    if not route:
+        return None
+    quote = {
+        'quote_id': uuid.uuid4().hex,
+        'rider_id': rider_id,
+        'pickup': list(route_cache.quantize(pickup)),
+        'destination': list(route_cache.quantize(destination)),
+        'too_close': bool(route.get('too_close')),
+        'expires_at': int(time.time()) + QUOTE_TTL,
+    }
+    quote.update(_estimates(route))
+    cache.set(_key(quote['quote_id']), quote, timeout=QUOTE_TTL)
+    # Geometry is for the client's preview only; the route cache keeps the full route
+    return dict(quote, geometry=polyline.compact_route(route.get('route_data'))['geometry'])
+
+
+def get_quote(quote_id, rider_id, pickup: LonLat, destination: LonLat) -> Optional[Dict[str, object]]:
+    """The rider's quote, if it is still cached and was made for these coordinates."""
+    if not quote_id:
+        return None
+    try:
+        quote = cache.get(_key(quote_id))
+    except Exception:
+        return None
+    if not quote or quote.get('rider_id') != rider_id:
+        return None
+    if tuple(quote['pickup']) != route_cache.quantize(pickup) \
+            or tuple(quote['destination']) != route_cache.quantize(destination):
+        return None
+    return quote
+
+
+def _apply(booking, estimates) -> bool:
+    if estimates.get('fare') is None:
+        return False
+    booking.estimated_distance = Decimal(estimates['distance_km'])
+    booking.estimated_duration = estimates['duration_min']
+    booking.fare = Decimal(estimates['fare'])
+    return True
+
+
+def price_booking(booking, quote_id=None) -> Optional[Dict[str, object]]:
+    """
+    Fill in the estimates and fare of an unsaved booking from its quote, or
+    from a cached route. Returns the quote or cached route used, or None
+    when estimate_booking_fare has to price it after saving.
+    """
+    pickup = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+    destination = (float(booking.destination_longitude), float(booking.destination_latitude))
+    quote = get_quote(quote_id, booking.rider_id, pickup, destination)
+    if quote is not None:
+        _apply(booking, quote)
+        return quote
+    route = RoutingService().peek_route(pickup, destination)
+    if route is not None:
+        estimates = _estimates(route)
+        _apply(booking, estimates)
+        return dict(estimates, too_close=bool(route.get('too_close')))
+    return None
+
+
+def schedule_pricing(booking) -> bool:
+    """
+    Queue estimate_booking_fare for a saved booking that price_booking
+    couldn't price. Returns False when nothing was queued (no worker, or a
+    task was queued less than PRICING_RETRY_SECONDS ago).
+    """
+    from .tasks import enqueue, estimate_booking_fare
+
+    if not cache.add(f'pricing_queued_{booking.id}', 1, timeout=PRICING_RETRY_SECONDS):
+        return False
+    return enqueue(estimate_booking_fare, booking.id)
+
+
+def retry_pricing(booking) -> bool:
+    """
+    For read paths showing an unpriced booking: price it from the route cache
+    if its route has been cached since, else queue estimate_booking_fare.
+    Returns True when the booking got a fare now.
+    """
+    if booking.fare is not None:
+        return False
+    if price_booking(booking) is not None and booking.fare is not None:
+        booking.save(update_fields=['estimated_distance', 'estimated_duration', 'fare'])
+        return True
+    schedule_pricing(booking)
+    return False
+
+
+def estimate_booking(booking) -> bool:
+    """Route and price a saved booking; returns True when it got a fare."""
+    pickup = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+    destination = (float(booking.destination_longitude), float(booking.destination_latitude))
+    route = RoutingService().calculate_route(pickup, destination)
+    if not _apply(booking, _estimates(route)):
+        return False
+    booking.save(update_fields=['estimated_distance', 'estimated_duration', 'fare'])
+    return True
@@ -0,0 +1,170 @@
+"""
+Content-addressed cache for ORS route lookups.
+
+Routes are keyed by their quantized (lon, lat) endpoints plus the routing
+profile, so identical pickup->destination or driver->pickup pairs resolve to
+the same entry for every rider, driver and worker. Lookups go through a small
+in-process LRU first and then the shared Django cache (Redis in production).
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from django.core.cache import cache
+
+# Decimal places kept when quantizing coordinates. 4 places is roughly 11m,
+# well inside the 50m "too close" threshold used by calculate_route.
+ROUTE_CACHE_PRECISION = int(os.environ.get('ROUTE_CACHE_PRECISION', 4))
+# Road geometry barely changes, so entries can live for hours.
+ROUTE_GEOMETRY_CACHE_TTL = int(os.environ.get('ROUTE_GEOMETRY_CACHE_TTL', 6 * 60 * 60))
+# Entries kept in each worker's local LRU tier.
+ROUTE_CACHE_LOCAL_SIZE = int(os.environ.get('ROUTE_CACHE_LOCAL_SIZE', 512))
+# Matrix cells (road distance/duration between two points) carry timing, so expire sooner.
+ROUTE_MATRIX_CACHE_TTL = int(os.environ.get('ROUTE_MATRIX_CACHE_TTL', 30 * 60))
+ROUTE_MATRIX_LOCAL_SIZE = int(os.environ.get('ROUTE_MATRIX_LOCAL_SIZE', 4096))
+
+KEY_PREFIX = 'routecache'
+
+
+class RouteCache:
+    """Two-tier (local LRU + shared cache) store of calculate_route results."""
+
+    def __init__(self, maxsize: int = ROUTE_CACHE_LOCAL_SIZE, ttl: int = ROUTE_GEOMETRY_CACHE_TTL,
+                 precision: int = ROUTE_CACHE_PRECISION, prefix: str = KEY_PREFIX):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.precision = precision
+        self.prefix = prefix
+        self._local: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def quantize(self, coords) -> Tuple[float, float]:
+        return (round(float(coords[0]), self.precision), round(float(coords[1]), self.precision))
+
+    def make_key(self, start_coords, end_coords, profile: str = 'driving-car') -> str:
+        """Return the content address for a (start, end, profile) route request."""
+        start = self.quantize(start_coords)
+        end = self.quantize(end_coords)
+        fmt = f'.{self.precision}f'
+        raw = f"{profile}|{start[0]:{fmt}},{start[1]:{fmt}}|{end[0]:{fmt}},{end[1]:{fmt}}"
+        digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def get(self, start_coords, end_coords, profile: str = 'driving-car') -> Optional[dict]:
+        key = self.make_key(start_coords, end_coords, profile)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._local.move_to_end(key)
+                    self.stats['local_hits'] += 1
+                    return value
+                del self._local[key]
+
+        try:
+            value = cache.get(key)
+        except Exception:
+            value = None
+
+        if value is None:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['shared_hits'] += 1
+        self._store_local(key, value, now)
+        return value
+
+    def set(self, start_coords, end_coords, value: dict, profile: str = 'driving-car') -> None:
+        key = self.make_key(start_coords, end_coords, profile)
+        self._store_local(key, value, time.monotonic())
+        try:
+            cache.set(key, value, timeout=self.ttl)
+        except Exception:
+            pass
+
+    def get_many(self, pairs, profile: str = 'driving-car') -> Dict[int, dict]:
+        """Look up several (start, end) pairs; returns {index: value} for the hits, one shared-cache call."""
+        now = time.monotonic()
+        keys = [self.make_key(start, end, profile) for start, end in pairs]
+        found: Dict[int, dict] = {}
+        remote: Dict[str, List[int]] = {}
+
+        with self._lock:
+            for idx, key in enumerate(keys):
+                entry = self._local.get(key)
+                if entry is not None and entry[0] > now:
+                    self._local.move_to_end(key)
+                    found[idx] = entry[1]
+                    self.stats['local_hits'] += 1
+                else:
+                    remote.setdefault(key, []).append(idx)
+
+        if remote:
+            try:
+                values = cache.get_many(list(remote))
+            except Exception:
+                values = {}
+            for key, indexes in remote.items():
+                value = values.get(key)
+                if value is None:
+                    self.stats['misses'] += len(indexes)
+                    continue
+                self.stats['shared_hits'] += len(indexes)
+                self._store_local(key, value, now)
+                for idx in indexes:
+                    found[idx] = value
+        return found
+
+    def set_many(self, items, profile: str = 'driving-car') -> None:
+        """Store several ((start, end), value) items with one shared-cache call."""
+        now = time.monotonic()
+        entries = {self.make_key(start, end, profile): value for (start, end), value in items}
+        for key, value in entries.items():
+            self._store_local(key, value, now)
+        try:
+            cache.set_many(entries, timeout=self.ttl)
+        except Exception:
+            pass
+
+    def evict(self, start_coords, end_coords, profile: str = 'driving-car') -> None:
+        """Explicitly drop one route from both tiers."""
+        key = self.make_key(start_coords, end_coords, profile)
+        with self._lock:
+            self._local.pop(key, None)
+        try:
+            cache.delete(key)
+        except Exception:
+            pass
+
+    def clear(self) -> None:
+        """Drop the local tier, and the shared tier when the backend supports pattern deletes (django-redis)."""
+        with self._lock:
+            self._local.clear()
+        delete_pattern = getattr(cache, 'delete_pattern', None)
+        if delete_pattern:
+            try:
+                delete_pattern(f"{self.prefix}:*")
+            except Exception:
+                pass
+
+    def _store_local(self, key: str, value: dict, now: float) -> None:
+        with self._lock:
+            self._local[key] = (now + self.ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+route_cache = RouteCache()
+# Per-leg geometry from multi-waypoint requests, keyed the same way as full routes.
+leg_cache = RouteCache(prefix='routeleg')
+# Single origin->destination cells from matrix requests.
+matrix_cache = RouteCache(maxsize=ROUTE_MATRIX_LOCAL_SIZE, ttl=ROUTE_MATRIX_CACHE_TTL, prefix='routecell')
@@ -0,0 +1,134 @@
+"""
+Precomputed polyline index for route-deviation checks.
+
+A PolylineIndex projects a route's vertices once into local planar meters and
+buckets every segment's bounding box into a square grid. A deviation check then
+only measures the segments whose cells overlap the search radius around the
+driver, instead of every vertex of the route. Indexes are cached per
+RouteSnapshot id, so the snapshot's geometry is decoded once per active route
+rather than on every location ping.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import geometry
+
+# Grid cell size in projected meters.
+ROUTE_INDEX_CELL_M = float(os.environ.get('ROUTE_INDEX_CELL_M', 200))
+# Number of snapshot indexes kept per worker.
+ROUTE_INDEX_CACHE_SIZE = int(os.environ.get('ROUTE_INDEX_CACHE_SIZE', 256))
+
+
+class PolylineIndex:
+    """Segment grid over a polyline given as (lat, lon) vertices."""
+
+    def __init__(self, latlon, cell_m: float = ROUTE_INDEX_CELL_M):
+        points = np.asarray(latlon, dtype=float).reshape(-1, 2)
+        if len(points) == 0:
+            raise ValueError('PolylineIndex needs at least one vertex')
+
+        self.cell_m = cell_m
+        self.origin = (float(points[:, 0].mean()), float(points[:, 1].mean()))
+        self.vertices = points
+        xy = geometry.project_local(points, self.origin[0], self.origin[1])
+        if len(xy) == 1:
+            # Degenerate route: a single zero-length segment
+            xy = np.vstack((xy, xy))
+        self.starts = xy[:-1]
+        self.ends = xy[1:]
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+
+        lo = np.floor(np.minimum(self.starts, self.ends) / cell_m).astype(int)
+        hi = np.floor(np.maximum(self.starts, self.ends) / cell_m).astype(int)
+        for seg_idx in range(len(self.starts)):
+            for cx in range(lo[seg_idx, 0], hi[seg_idx, 0] + 1):
+                for cy in range(lo[seg_idx, 1], hi[seg_idx, 1] + 1):
+                    self._grid.setdefault((cx, cy), []).append(seg_idx)
+
+    @classmethod
+    def from_lonlat(cls, coordinates, cell_m: float = ROUTE_INDEX_CELL_M) -> 'PolylineIndex':
+        """Build from GeoJSON-ordered (lon, lat) coordinates."""
+        points = np.asarray(coordinates, dtype=float).reshape(-1, 2)[:, ::-1]
+        return cls(points, cell_m=cell_m)
+
+    def _project_point(self, lat: float, lon: float) -> Tuple[float, float]:
+        xy = geometry.project_local(np.array([[float(lat), float(lon)]]), self.origin[0], self.origin[1])
+        return float(xy[0, 0]), float(xy[0, 1])
+
+    def candidate_segments(self, x: float, y: float, radius_m: float) -> np.ndarray:
+        cell = self.cell_m
+        min_cx, max_cx = int(math.floor((x - radius_m) / cell)), int(math.floor((x + radius_m) / cell))
+        min_cy, max_cy = int(math.floor((y - radius_m) / cell)), int(math.floor((y + radius_m) / cell))
+        found = set()
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                found.update(self._grid.get((cx, cy), ()))
+        return np.fromiter(found, dtype=int, count=len(found))
+
+    def distance_m(self, lat: float, lon: float, radius_m: Optional[float] = None) -> float:
+        """Distance in meters from a point to the nearest segment.
+
+        With ``radius_m`` only segments in nearby cells are measured, and
+        ``inf`` is returned when none lie within the radius.
+        """
+        x, y = self._project_point(lat, lon)
+        if radius_m is None:
+            starts, ends = self.starts, self.ends
+        else:
+            idx = self.candidate_segments(x, y, radius_m)
+            if idx.size == 0:
+                return float('inf')
+            starts, ends = self.starts[idx], self.ends[idx]
+        distances = geometry.point_to_segments_m(x, y, starts, ends)
+        best = float(distances.min())
+        if radius_m is not None and best > radius_m:
+            return float('inf')
+        return best
+
+    def is_within(self, lat: float, lon: float, radius_m: float) -> bool:
+        return self.distance_m(lat, lon, radius_m) <= radius_m
+
+
+_cache: "OrderedDict[int, PolylineIndex]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _snapshot_coordinates(snapshot):
+    coordinates = snapshot.coordinates
+    return coordinates if coordinates else None
+
+
+def for_snapshot(snapshot) -> Optional[PolylineIndex]:
+    """Return the cached index for a RouteSnapshot, building it on first use.
+
+    Callers may pass a snapshot with its geometry columns deferred; they
+    are only fetched when the index isn't cached yet.
+    """
+    key = snapshot.pk
+    with _lock:
+        index = _cache.get(key)
+        if index is not None:
+            _cache.move_to_end(key)
+            return index
+
+    coordinates = _snapshot_coordinates(snapshot)
+    if coordinates is None:
+        return None
+    index = PolylineIndex(coordinates)
+
+    with _lock:
+        _cache[key] = index
+        _cache.move_to_end(key)
+        while len(_cache) > ROUTE_INDEX_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
+
+
+def discard(snapshot_id) -> None:
+    with _lock:
+        _cache.pop(snapshot_id, None)
@@ -0,0 +1,338 @@
+"""
+Payload for the trip map endpoint (user.views.get_route_info).
+
+Everything the payload needs comes from one fetch plan: the booking joined
+with both users and their Rider/Driver profiles (booking_queryset), which is
+all a cached response needs, plus stops, driver tricycles and the active
+route snapshot, prefetched by build(). Routing is never computed here: the
+preview route and the distances come from the route cache or the active
+snapshot, and a miss queues compute_and_cache_route instead of calling ORS
+inline. The driver's shared itinerary is read from its cache
+(booking.itinerary).
+
+Responses are cached under versioned keys (booking.cache_keys) with
+stale-while-revalidate (booking.swr_cache): past ROUTE_CACHE_TTL, or once a
+driver or itinerary write has moved the key to a new version, the last
+stored copy keeps being served while one compute_and_cache_route task
+rebuilds it. A write to the booking itself is never served stale: the next
+read builds the payload. The driver's
+position is not cached at all: get_payload adds the latest fix from
+booking.location_store, so GPS pings don't invalidate anything.
+
+A cold request is a fixed handful of queries however many stops or
+passengers the trip has; user/tests.py holds the budget.
+"""
+import os
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Prefetch, prefetch_related_objects
+
+from . import cache_keys, itinerary, location_store, polyline, swr_cache
+from .models import Booking, BookingStop, RouteSnapshot
+from .services import RoutingService
+from .utils import ensure_booking_stops
+
+ACTIVE_STATUSES = ['accepted', 'on_the_way', 'started']
+# Writers bump the booking/driver cache versions, so entries can live long.
+ROUTE_CACHE_TTL = int(os.environ.get('ROUTE_CACHE_TTL', 5 * 60))
+
+
+class ProfileNotFound(Exception):
+    pass
+
+
+def _viewer(user) -> Optional[str]:
+    # Drivers see their own tricycle, so their payloads are kept apart
+    return f'driver{user.id}' if user.trikego_user == 'D' else None
+
+
+def response_cache_key(booking, user) -> str:
+    """Versioned key (booking.cache_keys) of ``user``'s payload."""
+    return cache_keys.route_info_key(booking, _viewer(user))
+
+
+def response_cache_keys(booking, user):
+    """``user``'s versioned key and the stale key it falls back to (booking.cache_keys.route_info_keys)."""
+    return cache_keys.route_info_keys(booking, _viewer(user))
+
+
+def booking_queryset():
+    """The booking joined with both users and their profiles: enough to authorize and find the cache key."""
+    return Booking.objects.select_related('rider__rider', 'driver__driver')
+
+
+def prefetch(booking) -> None:
+    """The rest of the fetch plan, one query each: stops, driver tricycles, active route snapshot."""
+    from user.models import Tricycle
+
+    prefetch_related_objects(
+        [booking],
+        Prefetch('stops', queryset=BookingStop.objects.order_by('sequence', 'created_at')),
+        Prefetch('driver__driver__tricycles', queryset=Tricycle.objects.order_by('id')),
+        Prefetch(
+            'routes',
+            queryset=RouteSnapshot.objects.filter(is_active=True).only('id', 'booking_id', 'distance', 'duration'),
+            to_attr='active_routes',
+        ),
+    )
+
+
+def _profile(user, attr):
+    if user is None:
+        return None
+    try:
+        return getattr(user, attr)
+    except ObjectDoesNotExist:
+        return None
+
+
+def _driver_profile(booking, user):
+    """The requesting driver's profile, from the fetch plan when they drive this booking."""
+    if booking.driver_id == user.id:
+        return _profile(booking.driver, 'driver')
+    from user.models import Driver
+    return Driver.objects.select_related('user').prefetch_related('tricycles').filter(user=user).first()
+
+
+def _tricycle(driver_profile) -> Optional[Dict[str, object]]:
+    trikes = list(driver_profile.tricycles.all()) if driver_profile else []
+    if not trikes:
+        return None
+    trike = trikes[0]
+    return {
+        'plate_number': trike.plate_number,
+        'color': trike.color,
+        'image_url': trike.image_url,
+    }
+
+
+def _queue_route(booking) -> None:
+    """Have a worker compute and cache the route this payload couldn't find."""
+    if cache.add(f'route_info_queued_{booking.id}', 1, timeout=60):
+        from .tasks import compute_and_cache_route, enqueue
+        enqueue(compute_and_cache_route, booking.id)
+
+
+def _stops(booking):
+    stops = list(booking.stops.all())
+    if {'PICKUP', 'DROPOFF'} <= {stop.stop_type for stop in stops}:
+        return stops
+    ensure_booking_stops(booking)
+    return list(BookingStop.objects.filter(booking=booking).order_by('sequence', 'created_at'))
+
+
+def _stops_payload(stops):
+    payload = []
+    for idx, stop in enumerate(stops, start=1):
+        lat_val = None
+        lon_val = None
+        if stop.latitude is not None and stop.longitude is not None:
+            lat_val = float(stop.latitude)
+            lon_val = float(stop.longitude)
+        payload.append({
+            'sequence': idx,
+            'type': stop.stop_type,
+            'status': stop.status,
+            'address': stop.address,
+            'lat': lat_val,
+            'lon': lon_val,
+            'passenger_count': stop.passenger_count,
+            'label': 'Pickup' if stop.stop_type == 'PICKUP' else 'Drop-off',
+            'booking_id': stop.booking_id,
+        })
+    return payload
+
+
+def _float(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        try:
+            return float(Decimal(str(value)))
+        except Exception:
+            return None
+
+
+def build(booking, user) -> Dict[str, object]:
+    """Assemble the route_info payload for ``user``; raises ProfileNotFound like the old lookups did."""
+    prefetch(booking)
+    booking_is_active = booking.status in ACTIVE_STATUSES
+
+    if user.trikego_user == 'D':
+        driver_profile = _driver_profile(booking, user)
+        rider_profile = _profile(booking.rider, 'rider')
+        if driver_profile is None or rider_profile is None:
+            raise ProfileNotFound('Profile not found for driver or rider.')
+    else:
+        rider_profile = _profile(booking.rider, 'rider')
+        if rider_profile is None:
+            raise ProfileNotFound('Rider profile not found.')
+        driver_profile = _profile(booking.driver, 'driver') if booking_is_active and booking.driver_id else None
+
+    tricycle_data = _tricycle(driver_profile)
+
+    routing = RoutingService()
+    pickup = destination = None
+    if booking.pickup_latitude is not None and booking.pickup_longitude is not None:
+        pickup = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+    if booking.destination_latitude is not None and booking.destination_longitude is not None:
+        destination = (float(booking.destination_longitude), float(booking.destination_latitude))
+    trip_route = routing.peek_route(pickup, destination) if pickup and destination else None
+
+    route_payload = None
+    pickup_to_dest_km = trip_route.get('distance') if trip_route else None
+    driver_to_pickup_km = None
+    if not booking_is_active or not booking.driver_id:
+        # Rider preview: pickup -> destination only
+        if trip_route:
+            route_payload = {
+                'geometry': polyline.compact_route(trip_route.get('route_data'))['geometry'],
+                'distance': trip_route.get('distance'),
+                'duration': trip_route.get('duration'),
+                'too_close': trip_route.get('too_close', False),
+            }
+        elif pickup and destination and not booking.driver_id:
+            _queue_route(booking)
+    elif pickup and booking.status != 'started':
+        # Before pickup the active snapshot is the driver -> pickup route;
+        # with_driver_position() prefers a cached route from the live fix
+        if booking.active_routes:
+            driver_to_pickup_km = _float(booking.active_routes[0].distance)
+        elif location_store.get_driver_location(booking.driver_id):
+            _queue_route(booking)
+    if pickup_to_dest_km is None:
+        pickup_to_dest_km = _float(booking.estimated_distance)
+
+    driver_info = None
+    if driver_profile:
+        driver_name = f"{driver_profile.user.first_name} {driver_profile.user.last_name}".strip() \
+            or driver_profile.user.username
+        driver_info = {
+            'id': driver_profile.id,
+            'name': driver_name,
+            'lat': None,
+            'lon': None,
+        }
+        if tricycle_data:
+            driver_info['plate'] = tricycle_data.get('plate_number')
+            driver_info['color'] = tricycle_data.get('color')
+
+    # Stops for the numbered markers matching the driver's itinerary
+    try:
+        stops_payload = _stops_payload(_stops(booking))
+    except Exception as e:
+        print(f"Route info stops failed for booking {booking.id}: {e}")
+        stops_payload = []
+
+    shared_itinerary = None
+    if booking_is_active and booking.driver_id and driver_profile:
+        try:
+            itinerary_result = itinerary.get_itinerary_nowait(booking.driver)
+            if isinstance(itinerary_result, dict):
+                shared_itinerary = itinerary_result.get('itinerary')
+        except Exception as e:
+            print(f"Route info itinerary failed for booking {booking.id}: {e}")
+
+    fare_amount = _float(booking.fare)
+    return {
+        'status': 'success',
+        'booking_status': booking.status,
+        'driver': driver_info if booking_is_active else None,
+        # Filled in by with_driver_position(), never cached
+        'driver_lat': None,
+        'driver_lon': None,
+        'driver_name': driver_info.get('name') if (booking_is_active and driver_info) else None,
+        'rider_lat': rider_profile.current_latitude,
+        'rider_lon': rider_profile.current_longitude,
+        'pickup_address': booking.pickup_address,
+        'pickup_lat': booking.pickup_latitude,
+        'pickup_lon': booking.pickup_longitude,
+        'destination_address': booking.destination_address,
+        'destination_lat': booking.destination_latitude,
+        'destination_lon': booking.destination_longitude,
+        'estimated_arrival': booking.estimated_arrival.isoformat() if booking.estimated_arrival else None,
+        'estimated_distance_km': _float(booking.estimated_distance),
+        'estimated_duration_min': booking.estimated_duration,
+        'fare': fare_amount,
+        'fare_display': f"₱{booking.fare}" if fare_amount is not None else None,
+        'tricycle': tricycle_data,
+        'route_payload': route_payload,
+        'pickup_to_destination_km': pickup_to_dest_km,
+        'driver_to_pickup_km': driver_to_pickup_km,
+        'stops': stops_payload,
+        'itinerary': shared_itinerary,
+    }
+
+
+def with_driver_position(payload, booking) -> Dict[str, object]:
+    """
+    ``payload`` with the driver's latest fix from the location store. Fixes
+    arrive every second or so, so they are added on read rather than being
+    part of the cached payload (and of its key).
+    """
+    if not payload.get('driver') or not booking.driver_id:
+        return payload
+    fix = location_store.get_driver_location(booking.driver_id)
+    if fix is None:
+        return payload
+    payload = dict(payload, driver=dict(payload['driver'], lat=fix.latitude, lon=fix.longitude),
+                   driver_lat=fix.latitude, driver_lon=fix.longitude)
+    if booking.pickup_latitude is not None and booking.pickup_longitude is not None:
+        pickup = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+        approach = RoutingService().peek_route(fix.lonlat, pickup)
+        if approach:
+            payload['driver_to_pickup_km'] = approach.get('distance')
+    return payload
+
+
+def get_payload(booking, user) -> Dict[str, object]:
+    """The route_info payload for ``user``, from the cache when possible, with the driver's live position."""
+    return with_driver_position(_cached_payload(booking, user), booking)
+
+
+def _cached_payload(booking, user) -> Dict[str, object]:
+    key, stale_key = response_cache_keys(booking, user)
+
+    def refresh():
+        from .tasks import compute_and_cache_route, enqueue
+        return enqueue(compute_and_cache_route, booking.id, user.id)
+
+    def is_current():
+        # A version moved while building: the payload may predate the change
+        return response_cache_key(booking, user) == key
+
+    try:
+        return swr_cache.get_or_build(key, lambda: build(booking, user), ttl=ROUTE_CACHE_TTL,
+                                      refresh=refresh, is_current=is_current,
+                                      stale_key=stale_key)
+    except ProfileNotFound:
+        raise
+    except Exception as e:
+        print(f"Route info cache unavailable for booking {booking.id}: {e}")
+        return build(booking, user)
+
+
+def refresh_payload(booking_id, user_id) -> bool:
+    """Rebuild and store a cached payload in the background (see get_payload)."""
+    from user.models import CustomUser
+
+    booking = booking_queryset().filter(id=booking_id).first()
+    user = CustomUser.objects.filter(id=user_id).first()
+    if booking is None or user is None:
+        return False
+    key, stale_key = response_cache_keys(booking, user)
+    try:
+        payload = build(booking, user)
+    except ProfileNotFound:
+        swr_cache.release(key)
+        return False
+    if response_cache_key(booking, user) != key:
+        swr_cache.release(key)
+        return False
+    swr_cache.store(key, payload, ROUTE_CACHE_TTL, stale_key)
+    return True
@@ -0,0 +1,219 @@
+"""
+Retention for route snapshots.
+
+Every reroute deactivates the booking's current RouteSnapshot and inserts a
+new one, so long trips with GPS drift pile up rows nobody reads again.
+``prune`` runs from the Celery beat schedule (``prune_route_snapshots``) and
+applies two policies:
+
+* live bookings keep their active snapshot plus at most ROUTE_HISTORY_KEEP
+  older ones, spread evenly over the trip. History older than
+  ROUTE_HISTORY_MAX_AGE_HOURS is dropped, and kept history loses its steps;
+* finished bookings (completed, cancelled, no driver) are compacted into one
+  snapshot: the path the driver actually followed, stitched from the history
+  and simplified to ROUTE_SIMPLIFY_TOLERANCE_M.
+
+Each run reports the rows deleted and rewritten and an estimate of the bytes
+reclaimed (geometry, steps and legacy GeoJSON payloads).
+"""
+import contextlib
+import json
+import os
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict, List
+
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from . import geometry, polyline, route_index
+from .models import RouteSnapshot
+
+ROUTE_HISTORY_KEEP = int(os.environ.get('ROUTE_HISTORY_KEEP', 5))
+ROUTE_HISTORY_MAX_AGE_HOURS = float(os.environ.get('ROUTE_HISTORY_MAX_AGE_HOURS', 24))
+ROUTE_SIMPLIFY_TOLERANCE_M = float(os.environ.get('ROUTE_SIMPLIFY_TOLERANCE_M', 5))
+ROUTE_RETENTION_BATCH = int(os.environ.get('ROUTE_RETENTION_BATCH', 200))
+
+LIVE_STATUSES = ['pending', 'accepted', 'on_the_way', 'started']
+FINISHED_STATUSES = ['completed', 'cancelled_by_rider', 'cancelled_by_driver', 'no_driver_found']
+
+REPORT_KEY = 'route_retention:last_run'
+
+
+def _payload_size(snapshot) -> int:
+    size = len(snapshot.geometry or '')
+    if snapshot.route_data is not None:
+        size += len(json.dumps(snapshot.route_data))
+    if snapshot.steps is not None:
+        size += len(json.dumps(snapshot.steps))
+    return size
+
+
+def _path_length_m(points: np.ndarray) -> float:
+    if len(points) < 2:
+        return 0.0
+    return float(geometry.haversine_m(points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1]).sum())
+
+
+def stitch_history(snapshots: List[RouteSnapshot]):
+    """
+    Reconstruct the driven path from chronologically ordered snapshots.
+
+    Each snapshot was followed until the next reroute, which started from the
+    driver's position at that time, so every route is cut at its vertex
+    nearest the next one's start. Returns ((lat, lon) array, km, seconds).
+    """
+    parts = []
+    distance_m = 0.0
+    duration_s = 0.0
+    routes = [(s, geometry.as_points(s.coordinates)) for s in snapshots]
+    routes = [(s, points) for s, points in routes if len(points)]
+    for i, (snapshot, points) in enumerate(routes):
+        full_length = _path_length_m(points)
+        if i + 1 < len(routes):
+            next_start = routes[i + 1][1][0]
+            cut = int(np.argmin(geometry.point_to_points_m(next_start[0], next_start[1], points)))
+            points = points[:cut + 1]
+        length = _path_length_m(points)
+        parts.append(points)
+        distance_m += length
+        if full_length > 0:
+            duration_s += snapshot.duration * min(length / full_length, 1.0)
+    if not parts:
+        return np.empty((0, 2)), 0.0, 0
+    return np.vstack(parts), distance_m / 1000.0, int(duration_s)
+
+
+def _compact_finished(booking_id, report: Dict[str, int]) -> None:
+    snapshots = list(RouteSnapshot.objects.filter(booking_id=booking_id).order_by('created_at', 'id'))
+    if not snapshots:
+        return
+    keep = snapshots[-1]
+    before = sum(_payload_size(s) for s in snapshots)
+
+    path, distance_km, duration_s = stitch_history(snapshots)
+    if len(path):
+        keep.geometry = polyline.encode(geometry.simplify_polyline(path, ROUTE_SIMPLIFY_TOLERANCE_M))
+        keep.distance = Decimal(str(round(distance_km, 2)))
+        keep.duration = duration_s
+    keep.steps = None
+    keep.route_data = None
+    keep.is_active = True
+    keep.save(update_fields=['geometry', 'distance', 'duration', 'steps', 'route_data', 'is_active'])
+
+    stale = [s.pk for s in snapshots[:-1]]
+    RouteSnapshot.objects.filter(pk__in=stale).delete()
+    for pk in stale + [keep.pk]:
+        route_index.discard(pk)
+
+    report['deleted'] += len(stale)
+    report['rewritten'] += 1
+    report['bytes_reclaimed'] += max(before - _payload_size(keep), 0)
+
+
+def _trim_live(booking_id, cutoff, report: Dict[str, int]) -> None:
+    history = list(
+        RouteSnapshot.objects.filter(booking_id=booking_id, is_active=False).order_by('created_at', 'id')
+    )
+    expired = [s for s in history if s.created_at < cutoff]
+    recent = [s for s in history if s.created_at >= cutoff]
+    if len(recent) > ROUTE_HISTORY_KEEP:
+        picks = set()
+        if ROUTE_HISTORY_KEEP > 0:
+            picks = set(np.linspace(0, len(recent) - 1, ROUTE_HISTORY_KEEP).round().astype(int).tolist())
+        expired += [s for i, s in enumerate(recent) if i not in picks]
+        recent = [s for i, s in enumerate(recent) if i in picks]
+
+    if expired:
+        RouteSnapshot.objects.filter(pk__in=[s.pk for s in expired]).delete()
+        for s in expired:
+            route_index.discard(s.pk)
+        report['deleted'] += len(expired)
+        report['bytes_reclaimed'] += sum(_payload_size(s) for s in expired)
+
+    for snapshot in recent:
+        if snapshot.steps is None and snapshot.route_data is None:
+            continue
+        before = _payload_size(snapshot)
+        if not snapshot.geometry:
+            snapshot.geometry = polyline.encode(snapshot.coordinates)
+        snapshot.steps = None
+        snapshot.route_data = None
+        snapshot.save(update_fields=['geometry', 'steps', 'route_data'])
+        report['rewritten'] += 1
+        report['bytes_reclaimed'] += max(before - _payload_size(snapshot), 0)
+
+
+def _finished_candidates(limit, seen):
+    bloated = Q(route_data__isnull=False) | Q(steps__isnull=False) | Q(is_active=False)
+    return list(
+        RouteSnapshot.objects.filter(booking__status__in=FINISHED_STATUSES)
+        .filter(bloated)
+        .exclude(booking_id__in=seen)
+        .order_by()  # Meta.ordering would leak created_at into DISTINCT
+        .values_list('booking_id', flat=True)
+        .distinct()[:limit]
+    )
+
+
+def _live_candidates(cutoff, limit, seen):
+    history = RouteSnapshot.objects.filter(booking__status__in=LIVE_STATUSES, is_active=False)
+    history = history.exclude(booking_id__in=seen).order_by()
+    crowded = (
+        history.values('booking_id')
+        .annotate(count=Count('id'), oldest=Min('created_at'))
+        .filter(Q(count__gt=ROUTE_HISTORY_KEEP) | Q(oldest__lt=cutoff))
+        .values_list('booking_id', flat=True)
+    )
+    detailed = history.filter(Q(route_data__isnull=False) | Q(steps__isnull=False)).values_list('booking_id', flat=True)
+    ids = list(crowded[:limit])
+    ids += [b for b in detailed.distinct()[:limit] if b not in ids]
+    return ids[:limit]
+
+
+def _drain(candidates, handle, seen, report) -> None:
+    while True:
+        batch = candidates(seen)
+        if not batch:
+            return
+        for booking_id in batch:
+            seen.add(booking_id)
+            try:
+                with transaction.atomic():
+                    handle(booking_id, report)
+            except Exception as e:
+                print(f"Route retention failed for booking {booking_id}: {e}")
+        report['bookings'] += len(batch)
+
+
+def prune(batch_size: int = ROUTE_RETENTION_BATCH, dry_run: bool = False) -> Dict[str, int]:
+    """Apply the retention policies to every booking that needs them; ``dry_run`` rolls everything back."""
+    report = {'bookings': 0, 'deleted': 0, 'rewritten': 0, 'bytes_reclaimed': 0}
+    cutoff = timezone.now() - timedelta(hours=ROUTE_HISTORY_MAX_AGE_HOURS)
+    seen = set()
+
+    with transaction.atomic() if dry_run else contextlib.nullcontext():
+        _drain(lambda done: _finished_candidates(batch_size, done), _compact_finished, seen, report)
+        _drain(
+            lambda done: _live_candidates(cutoff, batch_size, done),
+            lambda booking_id, r: _trim_live(booking_id, cutoff, r),
+            seen, report,
+        )
+        if dry_run:
+            transaction.set_rollback(True)
+
+    if not dry_run:
+        cache.set(REPORT_KEY, dict(report, ran_at=timezone.now().isoformat()), timeout=None)
+        if report['deleted'] or report['rewritten']:
+            print(
+                f"Route retention: {report['deleted']} snapshots deleted, {report['rewritten']} compacted, "
+                f"~{report['bytes_reclaimed']} bytes reclaimed across {report['bookings']} bookings"
+            )
+    return report
+
+
+def last_report():
+    return cache.get(REPORT_KEY)
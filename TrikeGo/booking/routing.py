@@ -1,4 +1,7 @@
 from django.urls import path
+from . import consumers
 
-# Placeholder for booking-specific websocket routes (extend later if needed)
-websocket_urlpatterns = []
+websocket_urlpatterns = [
+    path('ws/tracking/booking/<int:booking_id>/', consumers.TrackingConsumer.as_asgi()),
+    path('ws/tracking/driver/', consumers.TrackingConsumer.as_asgi()),
+]
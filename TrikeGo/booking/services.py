@@ -1,15 +1,20 @@
-import openrouteservice
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.utils import timezone
 from .models import RouteSnapshot, DriverLocation
+from . import geometry, offline_routing, polyline, route_index, tracking, transport
+from .route_cache import leg_cache, matrix_cache, route_cache
+from datetime import timedelta
 from decimal import Decimal
-import math
-import requests
+import numpy as np
 
 class RoutingService:
     def __init__(self):
         self.api_key = settings.OPENROUTESERVICE_API_KEY
-        self.client = openrouteservice.Client(key=self.api_key)
-        self.base_url = 'https://api.openrouteservice.org'
+        # Shared, pooled client: constructing a RoutingService is cheap and
+        # every instance reuses the same keep-alive connections.
+        self.client = transport.get_client()
+        self.base_url = transport.ORS_BASE_URL
     
     def geocode_address(self, query, focus_point=None):
         """
@@ -23,7 +28,6 @@ class RoutingService:
             list of results with formatted address, lat, lon
         """
         try:
-            url = f"{self.base_url}/geocode/search"
             params = {
                 'api_key': self.api_key,
                 'text': query,
@@ -36,8 +40,7 @@ class RoutingService:
                 params['focus.point.lon'] = focus_point[0]
                 params['focus.point.lat'] = focus_point[1]
             
-            response = requests.get(url, params=params)
-            data = response.json()
+            data = transport.get_json('/geocode/search', params)
             
             results = []
             for feature in data.get('features', []):
@@ -67,7 +70,6 @@ class RoutingService:
             dict with formatted address
         """
         try:
-            url = f"{self.base_url}/geocode/reverse"
             params = {
                 'api_key': self.api_key,
                 'point.lon': lon,
@@ -75,8 +77,7 @@ class RoutingService:
                 'size': 1
             }
             
-            response = requests.get(url, params=params)
-            data = response.json()
+            data = transport.get_json('/geocode/reverse', params)
             
             if data.get('features'):
                 props = data['features'][0]['properties']
@@ -104,6 +105,27 @@ class RoutingService:
         """
         return self._haversine_distance(coord1[1], coord1[0], coord2[1], coord2[0]) / 1000
     
+    def peek_route(self, start_coords, end_coords, profile='driving-car'):
+        """
+        Route between two points if it is known without calling ORS: points
+        too close to route, or an entry in the route cache. Returns None otherwise.
+        """
+        # Check if points are too close (less than 50 meters)
+        distance_m = self._haversine_distance(
+            start_coords[1], start_coords[0],
+            end_coords[1], end_coords[0]
+        )
+        
+        if distance_m < 50:
+            return {
+                'route_data': None,
+                'distance': round(distance_m / 1000, 2),
+                'duration': int(distance_m / 1.4),  # Walking speed ~1.4 m/s
+                'too_close': True
+            }
+        
+        return route_cache.get(start_coords, end_coords, profile)
+    
     def calculate_route(self, start_coords, end_coords, profile='driving-car'):
         """
         Calculate route between two points with traffic consideration
@@ -117,48 +139,239 @@ class RoutingService:
             dict with route_data, distance (km), duration (seconds)
         """
         try:
-            # Check if points are too close (less than 50 meters)
-            distance_m = self._haversine_distance(
-                start_coords[1], start_coords[0],
-                end_coords[1], end_coords[0]
-            )
+            known = self.peek_route(start_coords, end_coords, profile)
+            if known is not None:
+                return known
             
-            if distance_m < 50:
-                print(f"Points too close: {distance_m}m")
-                return {
-                    'route_data': None,
-                    'distance': round(distance_m / 1000, 2),
-                    'duration': int(distance_m / 1.4),  # Walking speed ~1.4 m/s
-                    'too_close': True
-                }
+            if offline_routing.preferred():
+                offline = offline_routing.route(start_coords, end_coords)
+                if offline:
+                    return offline
             
             coords = [start_coords, end_coords]
             
             # Request route with traffic consideration
-            route = self.client.directions(
-                coordinates=coords,
-                profile=profile,
-                format='geojson',
-                geometry='true',
-                instructions='true',
-                elevation='false',
-                # Note: Real-time traffic requires premium ORS subscription
-                # For now, we use standard routing which considers typical traffic patterns
-            )
+            try:
+                route = self.client.directions(
+                    coordinates=coords,
+                    profile=profile,
+                    format='geojson',
+                    geometry='true',
+                    instructions='true',
+                    elevation='false',
+                    # Note: Real-time traffic requires premium ORS subscription
+                    # For now, we use standard routing which considers typical traffic patterns
+                )
+            except Exception as e:
+                if not offline_routing.enabled():
+                    raise
+                # ORS down or rate limited: answer from the local road graph (not cached,
+                # so ORS geometry takes over again once it recovers)
+                print(f"Routing error: {e}; using offline graph")
+                return offline_routing.route(start_coords, end_coords)
             
             # Extract route information
             distance = route['features'][0]['properties']['segments'][0]['distance'] / 1000
             duration = route['features'][0]['properties']['segments'][0]['duration']
             
-            return {
+            result = {
                 'route_data': route,
                 'distance': round(distance, 2),
                 'duration': int(duration),
                 'too_close': False
             }
+            route_cache.set(start_coords, end_coords, result, profile)
+            return result
+        except Exception as e:
+            print(f"Routing error: {e}")
+            return None
+    
+    def calculate_route_legs(self, waypoints, profile='driving-car'):
+        """
+        Route through several waypoints with at most one directions request
+        
+        Legs already in the leg cache are reused, so when only the first
+        waypoint (the driver) moved, just that leg is requested.
+        
+        Args:
+            waypoints: list of (longitude, latitude) tuples
+            profile: ORS routing profile
+        
+        Returns:
+            list with one dict per consecutive waypoint pair: points
+            ([lat, lon] list), distance (km), duration (seconds) and precise
+            (False when the leg is a straight-line fallback)
+        """
+        waypoints = [(float(lon), float(lat)) for lon, lat in waypoints]
+        legs = [None] * max(len(waypoints) - 1, 0)
+        missing = []
+        for i in range(len(legs)):
+            start, end = waypoints[i], waypoints[i + 1]
+            distance_m = self._haversine_distance(start[1], start[0], end[1], end[0])
+            if distance_m < 50:
+                legs[i] = self._straight_leg(start, end, distance_m)
+                continue
+            cached = leg_cache.get(start, end, profile)
+            if cached is not None:
+                legs[i] = cached
+            else:
+                missing.append(i)
+
+        if missing and offline_routing.preferred():
+            for i in list(missing):
+                legs[i] = self._offline_leg(waypoints[i], waypoints[i + 1])
+            missing = [i for i in missing if legs[i] is None]
+
+        if missing:
+            first, last = missing[0], missing[-1]
+            span = waypoints[first:last + 2]
+            fetched = self._request_legs(span, profile)
+            for offset, leg in enumerate(fetched or []):
+                i = first + offset
+                if legs[i] is None and leg is not None:
+                    legs[i] = leg
+                    leg_cache.set(waypoints[i], waypoints[i + 1], leg, profile)
+            if fetched is None and offline_routing.enabled():
+                for i in missing:
+                    legs[i] = self._offline_leg(waypoints[i], waypoints[i + 1])
+
+        for i, leg in enumerate(legs):
+            if leg is None:
+                start, end = waypoints[i], waypoints[i + 1]
+                legs[i] = self._straight_leg(start, end, self._haversine_distance(start[1], start[0], end[1], end[0]))
+        return legs
+
+    def _request_legs(self, waypoints, profile):
+        """One directions call through ``waypoints``, split back into legs using ORS way_points."""
+        try:
+            route = self.client.directions(
+                coordinates=waypoints,
+                profile=profile,
+                format='geojson',
+                geometry='true',
+                instructions='false',
+                elevation='false',
+            )
+            feature = route['features'][0]
+            coordinates = feature['geometry']['coordinates']
+            way_points = feature['properties']['way_points']
+            segments = feature['properties']['segments']
         except Exception as e:
             print(f"Routing error: {e}")
             return None
+
+        legs = []
+        for i in range(len(waypoints) - 1):
+            try:
+                leg_coords = coordinates[way_points[i]:way_points[i + 1] + 1]
+                segment = segments[i]
+            except (IndexError, TypeError):
+                legs.append(None)
+                continue
+            if len(leg_coords) < 2:
+                legs.append(None)
+                continue
+            legs.append({
+                'points': [[float(c[1]), float(c[0])] for c in leg_coords],
+                'distance': round(segment.get('distance', 0) / 1000, 2),
+                'duration': int(segment.get('duration', 0)),
+                'precise': True,
+            })
+        return legs
+
+    @staticmethod
+    def _offline_leg(start, end):
+        result = offline_routing.route(start, end)
+        if not result:
+            return None
+        coordinates = result['route_data']['features'][0]['geometry']['coordinates']
+        return {
+            'points': [[c[1], c[0]] for c in coordinates],
+            'distance': result['distance'],
+            'duration': result['duration'],
+            'precise': True,
+        }
+
+    @staticmethod
+    def _straight_leg(start, end, distance_m):
+        return {
+            'points': [[start[1], start[0]], [end[1], end[0]]],
+            'distance': round(distance_m / 1000, 2),
+            'duration': int(distance_m / 1.4),
+            'precise': False,
+        }
+    
+    def calculate_matrix(self, sources, destinations=None, profile='driving-car'):
+        """
+        Road distances and durations between every source and destination
+        
+        Cells are cached individually, so only rows and columns with missing
+        cells are sent to ORS, in a single matrix request.
+        
+        Args:
+            sources: list of (longitude, latitude) tuples
+            destinations: list of (longitude, latitude) tuples (defaults to sources)
+            profile: ORS routing profile
+        
+        Returns:
+            dict with distances (km) and durations (seconds) as NumPy arrays of
+            shape (len(sources), len(destinations)), or None if ORS failed
+        """
+        sources = [(float(lon), float(lat)) for lon, lat in sources]
+        destinations = sources if destinations is None else [(float(lon), float(lat)) for lon, lat in destinations]
+        n, m = len(sources), len(destinations)
+        distances = np.full((n, m), np.nan)
+        durations = np.full((n, m), np.nan)
+        if n == 0 or m == 0:
+            return {'distances': distances, 'durations': durations}
+
+        if offline_routing.preferred():
+            offline = offline_routing.matrix(sources, destinations)
+            if offline is not None and not np.isnan(offline['distances']).any():
+                return offline
+
+        pairs = [(src, dst) for src in sources for dst in destinations]
+        for idx, cell in matrix_cache.get_many(pairs, profile).items():
+            distances[idx // m, idx % m] = cell['distance']
+            durations[idx // m, idx % m] = cell['duration']
+        for i, src in enumerate(sources):
+            for j, dst in enumerate(destinations):
+                if matrix_cache.quantize(src) == matrix_cache.quantize(dst):
+                    distances[i, j] = durations[i, j] = 0.0
+
+        missing = np.isnan(distances)
+        if missing.any():
+            rows = np.flatnonzero(missing.any(axis=1)).tolist()
+            cols = np.flatnonzero(missing.any(axis=0)).tolist()
+            try:
+                response = self.client.distance_matrix(
+                    locations=[sources[i] for i in rows] + [destinations[j] for j in cols],
+                    profile=profile,
+                    sources=list(range(len(rows))),
+                    destinations=list(range(len(rows), len(rows) + len(cols))),
+                    metrics=['distance', 'duration'],
+                    units='km',
+                )
+            except Exception as e:
+                print(f"Matrix error: {e}")
+                if offline_routing.enabled():
+                    return offline_routing.matrix(sources, destinations)
+                return None
+
+            fetched = []
+            for r, i in enumerate(rows):
+                for c, j in enumerate(cols):
+                    distance = response['distances'][r][c]
+                    duration = response['durations'][r][c]
+                    if distance is None or duration is None:
+                        continue  # unroutable cell; left as NaN
+                    if np.isnan(distances[i, j]):
+                        distances[i, j] = distance
+                        durations[i, j] = duration
+                        fetched.append(((sources[i], destinations[j]), {'distance': distance, 'duration': duration}))
+            matrix_cache.set_many(fetched, profile)
+
+        return {'distances': distances, 'durations': durations}
     
     def save_route_snapshot(self, booking, route_info):
         """Save route snapshot to database"""
@@ -167,13 +380,16 @@ class RoutingService:
             RouteSnapshot.objects.filter(booking=booking, is_active=True).update(is_active=False)
             
             # Create new route snapshot
+            compact = polyline.compact_route(route_info['route_data'])
             snapshot = RouteSnapshot.objects.create(
                 booking=booking,
-                route_data=route_info['route_data'],
+                geometry=compact['geometry'],
+                steps=compact['steps'],
                 distance=Decimal(str(route_info['distance'])),
                 duration=route_info['duration'],
                 is_active=True
             )
+            tracking.publish_eta(booking.id, route_info['distance'], route_info['duration'])
             return snapshot
         return None
     
@@ -189,41 +405,28 @@ class RoutingService:
         Returns:
             bool: True if rerouting is needed
         """
-        if not current_route or not current_route.route_data:
+        if not current_route:
             return True
         
         try:
-            # Get route coordinates
-            route_coords = current_route.route_data['features'][0]['geometry']['coordinates']
-            driver_point = (float(driver_location.longitude), float(driver_location.latitude))
+            # Precomputed per-snapshot segment grid; only segments near the
+            # driver are measured, and the route JSON is parsed once per snapshot.
+            index = route_index.for_snapshot(current_route)
+            if index is None:
+                return True
             
-            # Find minimum distance to route
-            min_distance = float('inf')
-            for coord in route_coords:
-                distance = self._haversine_distance(
-                    driver_point[1], driver_point[0],
-                    coord[1], coord[0]
-                )
-                min_distance = min(min_distance, distance)
-            
-            return min_distance > threshold_meters
+            return not index.is_within(
+                float(driver_location.latitude),
+                float(driver_location.longitude),
+                threshold_meters,
+            )
         except Exception as e:
             print(f"Error checking route deviation: {e}")
             return False
     
     def _haversine_distance(self, lat1, lon1, lat2, lon2):
         """Calculate distance between two points in meters"""
-        R = 6371000  # Earth's radius in meters
-        
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        delta_phi = math.radians(lat2 - lat1)
-        delta_lambda = math.radians(lon2 - lon1)
-        
-        a = math.sin(delta_phi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        
-        return R * c
+        return geometry.haversine_m(float(lat1), float(lon1), float(lat2), float(lon2))
     
     def get_eta(self, driver_location, destination_coords):
         """
@@ -233,6 +436,9 @@ class RoutingService:
             int: ETA in seconds, or None if calculation fails
         """
         driver_coords = (float(driver_location.longitude), float(driver_location.latitude))
+        etas = self.get_etas(driver_location, [destination_coords])
+        if etas and etas[0] is not None:
+            return etas[0]
         route_info = self.calculate_route(driver_coords, destination_coords)
         
         if route_info and not route_info.get('too_close'):
@@ -240,4 +446,68 @@ class RoutingService:
         elif route_info and route_info.get('too_close'):
             # If very close, return the calculated duration for short distance
             return route_info['duration']
-        return None
\ No newline at end of file
+        return None
+
+    def get_etas(self, driver_location, destinations):
+        """
+        ETAs in seconds from the driver to several (lon, lat) destinations, via one matrix row
+        
+        Returns:
+            list aligned with destinations (None for unroutable ones), or None if the matrix failed
+        """
+        driver_coords = (float(driver_location.longitude), float(driver_location.latitude))
+        matrix = self.calculate_matrix([driver_coords], destinations)
+        if matrix is None:
+            return None
+        return [None if np.isnan(value) else int(value) for value in matrix['durations'][0]]
+
+    # Async variants for the ASGI/Channels path. They run the sync call on a
+    # worker thread so the event loop is never blocked on ORS, while still going
+    # through the shared connection pool.
+
+    async def ageocode_address(self, query, focus_point=None):
+        return await sync_to_async(self.geocode_address, thread_sensitive=False)(query, focus_point)
+
+    async def areverse_geocode(self, lat, lon):
+        return await sync_to_async(self.reverse_geocode, thread_sensitive=False)(lat, lon)
+
+    async def acalculate_route(self, start_coords, end_coords, profile='driving-car'):
+        return await sync_to_async(self.calculate_route, thread_sensitive=False)(start_coords, end_coords, profile)
+
+    async def aget_eta(self, driver_location, destination_coords):
+        return await sync_to_async(self.get_eta, thread_sensitive=False)(driver_location, destination_coords)
+
+
+def check_and_reroute(booking, driver_location):
+    """Check if rerouting is needed and perform reroute"""
+    routing_service = RoutingService()
+    
+    # Get current active route; the geometry is only loaded if its deviation
+    # index isn't cached yet
+    current_route = RouteSnapshot.objects.filter(booking=booking, is_active=True).defer('route_data', 'geometry', 'steps').first()
+    
+    # Check if rerouting is needed
+    if routing_service.should_reroute(driver_location, current_route):
+        print(f"Rerouting needed for booking {booking.id}")
+        
+        # Determine destination based on status
+        if booking.status in ['accepted', 'on_the_way']:
+            destination = (float(booking.pickup_longitude), float(booking.pickup_latitude))
+        else:
+            destination = (float(booking.destination_longitude), float(booking.destination_latitude))
+        
+        # Calculate new route
+        start = (float(driver_location.longitude), float(driver_location.latitude))
+        new_route = routing_service.calculate_route(start, destination)
+        
+        if new_route:
+            # Save new route
+            routing_service.save_route_snapshot(booking, new_route)
+            
+            # Update booking estimates
+            booking.estimated_distance = Decimal(str(new_route['distance']))
+            booking.estimated_duration = new_route['duration'] // 60  # Convert to minutes
+            booking.estimated_arrival = timezone.now() + timedelta(seconds=new_route['duration'])
+            booking.save()
+            
+            print(f"New route saved. Distance: {new_route['distance']}km, Duration: {new_route['duration']}s")
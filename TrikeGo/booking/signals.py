@@ -0,0 +1,79 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from . import cache_keys, itinerary, location_store, tracking
+from .models import Booking, BookingStop, DriverLocation, RouteSnapshot
+from .spatial_index import registry
+from user.models import Driver, Tricycle
+
+
+@receiver(post_save, sender=DriverLocation)
+def index_driver_location(sender, instance, **kwargs):
+    # Direct saves (admin, fixtures) bypass the buffer; don't let a stale hot fix shadow them
+    location_store.invalidate(instance.driver_id)
+    registry.update_driver(instance.driver_id, instance.latitude, instance.longitude)
+
+
+@receiver(post_save, sender=Booking)
+def index_pending_pickup(sender, instance, **kwargs):
+    if instance.status == 'pending' and instance.driver_id is None:
+        registry.update_pickup(instance.id, instance.pickup_latitude, instance.pickup_longitude)
+    else:
+        registry.remove_pickup(instance.id)
+
+
+@receiver(post_delete, sender=Booking)
+def unindex_pending_pickup(sender, instance, **kwargs):
+    registry.remove_pickup(instance.id)
+
+
+@receiver(post_init, sender=Booking)
+def remember_booking_driver(sender, instance, **kwargs):
+    # Read from __dict__ so deferred loads don't trigger a query
+    instance._loaded_driver_id = instance.__dict__.get('driver_id')
+    instance._loaded_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Booking)
+def push_booking_status(sender, instance, created, **kwargs):
+    # Registered before refresh_driver_itineraries, which resets _loaded_driver_id
+    changed = created or instance.status != getattr(instance, '_loaded_status', None) \
+        or instance.driver_id != getattr(instance, '_loaded_driver_id', None)
+    instance._loaded_status = instance.status
+    if changed:
+        transaction.on_commit(lambda: tracking.publish_status(instance))
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def refresh_driver_itineraries(sender, instance, **kwargs):
+    # Both the current and a just-unassigned driver need a new itinerary
+    driver_ids = {instance.driver_id, getattr(instance, '_loaded_driver_id', None)} - {None}
+    for driver_id in driver_ids:
+        transaction.on_commit(lambda driver_id=driver_id: itinerary.schedule_refresh(driver_id))
+    instance._loaded_driver_id = instance.driver_id
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+@receiver(post_save, sender=BookingStop)
+@receiver(post_delete, sender=BookingStop)
+@receiver(post_save, sender=RouteSnapshot)
+@receiver(post_delete, sender=RouteSnapshot)
+def bump_booking_cache_version(sender, instance, **kwargs):
+    # After commit, so a reader can't cache pre-commit state under the new version
+    booking_id = instance.id if sender is Booking else instance.booking_id
+    transaction.on_commit(lambda: cache_keys.bump_booking(booking_id))
+
+
+@receiver(post_save, sender=Driver)
+@receiver(post_save, sender=Tricycle)
+@receiver(post_delete, sender=Tricycle)
+def bump_driver_cache_version(sender, instance, **kwargs):
+    # Driver name, plate and colour are part of route_info
+    if sender is Driver:
+        user_id = instance.user_id
+    else:
+        user_id = Driver.objects.filter(id=instance.driver_id).values_list('user_id', flat=True).first()
+    transaction.on_commit(lambda: cache_keys.bump_driver(user_id))
@@ -0,0 +1,248 @@
+"""
+Grid-based spatial index for online drivers and pending pickups.
+
+Points are bucketed into fixed-size lat/lon cells so radius queries only visit
+the handful of cells that overlap the search circle instead of scanning every
+open booking. Each worker keeps its own in-memory index: it is updated
+incrementally from model signals and rebuilt from the database whenever another
+worker signals a change (via a shared version counter) or the refresh interval
+elapses.
+"""
+import math
+import os
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from django.core.cache import cache
+
+from . import geometry
+
+# Cell size in degrees; 0.01 deg is ~1.1 km of latitude.
+SPATIAL_INDEX_CELL_DEG = float(os.environ.get('SPATIAL_INDEX_CELL_DEG', 0.01))
+# Upper bound on how stale a worker's index may get before a full rebuild.
+SPATIAL_INDEX_REFRESH_SECONDS = int(os.environ.get('SPATIAL_INDEX_REFRESH_SECONDS', 30))
+# Minimum gap between rebuilds triggered by other workers' changes.
+SPATIAL_INDEX_MIN_REBUILD_SECONDS = float(os.environ.get('SPATIAL_INDEX_MIN_REBUILD_SECONDS', 2))
+
+DRIVERS = 'drivers'
+PENDING_PICKUPS = 'pending_pickups'
+
+KM_PER_DEG_LAT = 111.32
+
+
+class GridIndex:
+    """Uniform grid of point ids keyed by (lat, lon) cell."""
+
+    def __init__(self, cell_deg: float = SPATIAL_INDEX_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells: Dict[Tuple[int, int], Dict[Hashable, Tuple[float, float]]] = {}
+        self._points: Dict[Hashable, Tuple[float, float, Tuple[int, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self._points
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg)))
+
+    def get(self, item_id) -> Optional[Tuple[float, float]]:
+        entry = self._points.get(item_id)
+        return (entry[0], entry[1]) if entry else None
+
+    def upsert(self, item_id, lat: float, lon: float) -> None:
+        lat = float(lat)
+        lon = float(lon)
+        cell = self._cell(lat, lon)
+        previous = self._points.get(item_id)
+        if previous and previous[2] != cell:
+            self._discard_from_cell(item_id, previous[2])
+        self._cells.setdefault(cell, {})[item_id] = (lat, lon)
+        self._points[item_id] = (lat, lon, cell)
+
+    def remove(self, item_id) -> None:
+        previous = self._points.pop(item_id, None)
+        if previous:
+            self._discard_from_cell(item_id, previous[2])
+
+    def clear(self) -> None:
+        self._cells.clear()
+        self._points.clear()
+
+    def _discard_from_cell(self, item_id, cell) -> None:
+        bucket = self._cells.get(cell)
+        if bucket is not None:
+            bucket.pop(item_id, None)
+            if not bucket:
+                del self._cells[cell]
+
+    def query_radius(self, lat: float, lon: float, radius_km: float) -> List[Tuple[Hashable, float]]:
+        """Return (id, distance_km) pairs within radius_km, nearest first."""
+        lat = float(lat)
+        lon = float(lon)
+        d_lat = radius_km / KM_PER_DEG_LAT
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        d_lon = radius_km / (KM_PER_DEG_LAT * cos_lat)
+
+        min_row, min_col = self._cell(lat - d_lat, lon - d_lon)
+        max_row, max_col = self._cell(lat + d_lat, lon + d_lon)
+
+        ids = []
+        coords = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                bucket = self._cells.get((row, col))
+                if not bucket:
+                    continue
+                for item_id, point in bucket.items():
+                    ids.append(item_id)
+                    coords.append(point)
+
+        if not ids:
+            return []
+
+        distances = geometry.point_to_points_m(lat, lon, coords) / 1000.0
+        order = np.argsort(distances, kind='stable')
+        return [(ids[i], float(distances[i])) for i in order if distances[i] <= radius_km]
+
+
+class SpatialRegistry:
+    """Per-worker driver/pickup indexes kept in sync with the database."""
+
+    VERSION_KEY = 'spatial_index_version'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._layers = {DRIVERS: GridIndex(), PENDING_PICKUPS: GridIndex()}
+        self._built_at = None
+        self._version = None
+
+    # ---- writes (called from signals and location updates) ----
+
+    def update_driver(self, driver_user_id, lat, lon) -> None:
+        if lat is None or lon is None:
+            return
+        with self._lock:
+            self._layers[DRIVERS].upsert(driver_user_id, lat, lon)
+
+    def remove_driver(self, driver_user_id) -> None:
+        with self._lock:
+            self._layers[DRIVERS].remove(driver_user_id)
+        self._bump_version()
+
+    def update_pickup(self, booking_id, lat, lon) -> None:
+        if lat is None or lon is None:
+            return self.remove_pickup(booking_id)
+        with self._lock:
+            self._layers[PENDING_PICKUPS].upsert(booking_id, lat, lon)
+        self._bump_version()
+
+    def remove_pickup(self, booking_id) -> None:
+        with self._lock:
+            if booking_id in self._layers[PENDING_PICKUPS]:
+                self._layers[PENDING_PICKUPS].remove(booking_id)
+        # Always bump: other workers may list the pickup even when this one doesn't
+        self._bump_version()
+
+    # ---- queries ----
+
+    def pending_bookings_near(self, lat, lon, radius_km: float) -> List[Tuple[int, float]]:
+        self._ensure_fresh()
+        with self._lock:
+            return self._layers[PENDING_PICKUPS].query_radius(lat, lon, radius_km)
+
+    def drivers_near(self, lat, lon, radius_km: float) -> List[Tuple[int, float]]:
+        self._ensure_fresh()
+        with self._lock:
+            return self._layers[DRIVERS].query_radius(lat, lon, radius_km)
+
+    # ---- maintenance ----
+
+    def _bump_version(self) -> None:
+        try:
+            version = cache.incr(self.VERSION_KEY)
+        except ValueError:
+            cache.add(self.VERSION_KEY, 1, timeout=None)
+            version = cache.get(self.VERSION_KEY)
+        except Exception:
+            return
+        # Our own change is already applied locally; don't rebuild for it unless
+        # another worker bumped the counter in the meantime.
+        with self._lock:
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+
+    def _shared_version(self):
+        try:
+            return cache.get(self.VERSION_KEY)
+        except Exception:
+            return None
+
+    def _ensure_fresh(self) -> None:
+        now = time.monotonic()
+        built_at = self._built_at
+        if built_at is None or now - built_at > SPATIAL_INDEX_REFRESH_SECONDS:
+            self.rebuild()
+            return
+        if now - built_at < SPATIAL_INDEX_MIN_REBUILD_SECONDS:
+            return
+        if self._shared_version() != self._version:
+            self.rebuild()
+
+    def rebuild(self) -> None:
+        """Reload both layers from the database."""
+        from user.models import Driver
+        from .models import Booking
+        from .location_store import get_driver_locations
+
+        version = self._shared_version()
+        drivers = GridIndex()
+        pickups = GridIndex()
+
+        online = Driver.objects.filter(
+            status__in=['Online', 'In_trip'],
+            user__isnull=False,
+        ).values_list('user_id', flat=True)
+        for user_id, fix in get_driver_locations(online).items():
+            drivers.upsert(user_id, fix.latitude, fix.longitude)
+
+        pending = Booking.objects.filter(
+            status='pending',
+            driver__isnull=True,
+            pickup_latitude__isnull=False,
+            pickup_longitude__isnull=False,
+        ).values_list('id', 'pickup_latitude', 'pickup_longitude')
+        for booking_id, lat, lon in pending:
+            pickups.upsert(booking_id, lat, lon)
+
+        with self._lock:
+            self._layers = {DRIVERS: drivers, PENDING_PICKUPS: pickups}
+            self._built_at = time.monotonic()
+            self._version = version
+
+
+registry = SpatialRegistry()
+
+
+def pending_bookings_near_driver(driver_user, radius_km: float) -> Optional[List[int]]:
+    """Return ids of pending bookings whose pickup is within radius_km of the driver, nearest first.
+
+    Returns None when the driver's position is unknown so callers can fall back
+    to an unfiltered listing.
+    """
+    from .location_store import get_driver_location
+
+    location = get_driver_location(driver_user.id)
+    if location is None:
+        return None
+
+    nearby = registry.pending_bookings_near(location.latitude, location.longitude, radius_km)
+    return [booking_id for booking_id, _ in nearby]
+
+
+def drivers_near_pickup(lat, lon, radius_km: float) -> List[Tuple[int, float]]:
+    """Return (driver_user_id, distance_km) for online drivers within radius_km of a pickup, nearest first."""
+    return registry.drivers_near(lat, lon, radius_km)
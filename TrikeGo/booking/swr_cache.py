@@ -0,0 +1,105 @@
+"""
+Stale-while-revalidate cache entries with single-flight refreshes.
+
+An entry is fresh for ``ttl`` seconds and then kept for another
+SWR_STALE_TTL seconds as a stale copy. Once stale, the first reader takes
+the entry's refresh lock and starts a refresh (normally a Celery task);
+every reader, that one included, keeps getting the stale copy until the
+refresh lands. With no worker available the lock holder rebuilds inline.
+
+Callers whose keys are versioned can pass a ``stale_key`` shared by the
+versions whose payloads may stand in for each other: each stored entry is
+copied there too, so when such a version moves, the previous payload is
+served stale while one refresh builds the new one. Versions that must not
+be served across (a change the reader has to see) use a different
+``stale_key`` and are built on a miss.
+
+When there is no copy at all, one reader builds it and the rest wait up to
+SWR_WAIT_SECONDS for that result instead of all building in parallel.
+"""
+import os
+import time
+from typing import Callable, Optional
+
+from django.core.cache import cache
+
+# How long an entry is still served after it stops being fresh.
+SWR_STALE_TTL = int(os.environ.get('SWR_STALE_TTL', 10 * 60))
+# A refresh that hasn't landed by then is presumed lost and may be retried.
+SWR_LOCK_TTL = int(os.environ.get('SWR_LOCK_TTL', 30))
+SWR_WAIT_SECONDS = float(os.environ.get('SWR_WAIT_SECONDS', 1.0))
+SWR_POLL_INTERVAL = 0.05
+
+
+def lock_key(key: str) -> str:
+    return f'{key}:refreshing'
+
+
+def store(key: str, payload, ttl: int, stale_key: Optional[str] = None) -> None:
+    entry = {'payload': payload, 'fresh_until': time.time() + ttl}
+    entries = {key: entry}
+    if stale_key:
+        entries[stale_key] = entry
+    cache.set_many(entries, timeout=ttl + SWR_STALE_TTL)
+    cache.delete(lock_key(key))
+
+
+def release(key: str) -> None:
+    cache.delete(lock_key(key))
+
+
+def _wait_for(key: str):
+    deadline = time.monotonic() + SWR_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        time.sleep(SWR_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def get_or_build(key: str, build: Callable[[], object], *, ttl: int,
+                 refresh: Optional[Callable[[], bool]] = None,
+                 is_current: Optional[Callable[[], bool]] = None,
+                 stale_key: Optional[str] = None):
+    """
+    Serve ``key``, building it with ``build()`` only when nothing usable is
+    cached. ``refresh()`` queues a background rebuild and returns False when
+    it couldn't; ``is_current()`` returning False skips storing a result
+    that is already outdated. ``stale_key`` holds the last entry stored for
+    any version of ``key`` (see the module docstring).
+    """
+    found = cache.get_many([key, stale_key] if stale_key else [key])
+    entry = found.get(key)
+    if entry is not None and entry['fresh_until'] > time.time():
+        return entry['payload']
+    if entry is None and stale_key:
+        # Another version's payload: stale however recently it was stored
+        entry = found.get(stale_key)
+
+    if entry is not None:
+        if cache.add(lock_key(key), 1, timeout=SWR_LOCK_TTL):
+            if refresh is None or not refresh():
+                return _build_and_store(key, build, ttl, is_current, stale_key)
+        return entry['payload']
+
+    if not cache.add(lock_key(key), 1, timeout=SWR_LOCK_TTL):
+        entry = _wait_for(key)
+        if entry is not None:
+            return entry['payload']
+        # The builder is slow or gone; build without storing
+        return build()
+    return _build_and_store(key, build, ttl, is_current, stale_key)
+
+
+def _build_and_store(key, build, ttl, is_current, stale_key=None):
+    try:
+        payload = build()
+    except Exception:
+        release(key)
+        raise
+    if is_current is None or is_current():
+        store(key, payload, ttl, stale_key)
+    else:
+        release(key)
+    return payload
@@ -1,55 +1,185 @@
 from celery import shared_task
-from .services import RoutingService
-from .models import Booking
+from .services import RoutingService, check_and_reroute
+from .models import Booking, DriverLocation
+from .location_store import get_driver_location
+from . import cache_keys
 from django.core.cache import cache
+from decimal import Decimal
 import os
+import time
+
+# Pings for the same booking inside this window collapse into one reroute.
+REROUTE_DEBOUNCE_SECONDS = float(os.environ.get('REROUTE_DEBOUNCE_SECONDS', 3))
+
+
+# After a failed publish, skip the broker for this long instead of paying
+# the connection timeout on every request.
+BROKER_BACKOFF_SECONDS = int(os.environ.get('CELERY_BROKER_BACKOFF_SECONDS', 60))
+
+
+def enqueue(task, *args, countdown=None):
+    """Queue a task, returning False when the broker is unavailable."""
+    if cache.get('celery_broker_unavailable'):
+        return False
+    try:
+        task.apply_async(args=list(args), countdown=countdown)
+        return True
+    except Exception as e:
+        print(f"Could not queue {task.name}: {e}")
+        cache.set('celery_broker_unavailable', 1, timeout=BROKER_BACKOFF_SECONDS)
+        return False
+
+
+def _reroute_latest_key(booking_id):
+    return f'reroute_latest_{booking_id}'
+
+
+def _reroute_scheduled_key(booking_id):
+    return f'reroute_scheduled_{booking_id}'
 
 
 @shared_task
-def compute_and_cache_route(booking_id):
+def compute_and_cache_route(booking_id, user_id=None):
+    """
+    Compute the booking's route into the route cache (pickup -> destination
+    before a driver is assigned, driver -> pickup after). With ``user_id``
+    this is a route_info refresh (booking.swr_cache): that viewer's cached
+    payload is rebuilt too.
+    """
     try:
         booking = Booking.objects.get(id=booking_id)
         routing_service = RoutingService()
 
-        # If no driver assigned, compute pickup->destination; otherwise compute driver->pickup
+        start = end = None
         if not booking.driver:
             start = (float(booking.pickup_longitude), float(booking.pickup_latitude))
             end = (float(booking.destination_longitude), float(booking.destination_latitude))
-            route_info = routing_service.calculate_route(start, end)
         else:
             try:
-                from booking.models import DriverLocation
-                dl = DriverLocation.objects.filter(driver=booking.driver).first()
+                dl = get_driver_location(booking.driver_id)
                 if dl:
-                    start = (float(dl.longitude), float(dl.latitude))
+                    start = dl.lonlat
                     end = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-                    route_info = routing_service.calculate_route(start, end)
-                else:
-                    route_info = None
             except Exception:
-                route_info = None
+                start = None
 
-        if route_info:
-            # Save snapshot for history and quick retrieval
-            try:
-                routing_service.save_route_snapshot(booking, route_info)
-            except Exception:
-                pass
-
-            payload = {
-                'status': 'success',
-                'route_payload': {
-                    'route_data': route_info.get('route_data'),
-                    'distance': route_info.get('distance'),
-                    'duration': route_info.get('duration')
-                }
-            }
-            cache_key = f'route_info_{booking_id}_{booking.status}_{booking.driver_id or "none"}'
-            cache.set(cache_key, payload, timeout=int(os.environ.get('ROUTE_CACHE_TTL', 15)))
-            return True
+        # Only a route that wasn't cached yet changes the payload
+        if start and routing_service.peek_route(start, end) is None:
+            route = routing_service.calculate_route(start, end)
+            if route:
+                # Save snapshot for history and quick retrieval
+                try:
+                    routing_service.save_route_snapshot(booking, route)
+                except Exception:
+                    pass
+                # Cached route_info predates this route; a new version makes the next read use it
+                cache_keys.bump_booking(booking_id)
+
+        if user_id is not None:
+            from .route_info import refresh_payload
+            return refresh_payload(booking_id, user_id)
+        return True
     except Booking.DoesNotExist:
         return False
-    except Exception:
+    except Exception as e:
+        print(f"compute_and_cache_route failed for booking {booking_id}: {e}")
+        return False
+
+
+def schedule_reroute(booking_id, latitude, longitude):
+    """Record the driver's latest fix for a booking and make sure a reroute is queued.
+
+    Only the most recent ping is kept. If a reroute task for the booking is
+    already waiting, the new ping is coalesced into it instead of queueing
+    another one. Returns True when a new task was scheduled; without a
+    worker nothing is rerouted.
+    """
+    cache.set(
+        _reroute_latest_key(booking_id),
+        {'latitude': str(latitude), 'longitude': str(longitude), 'received_at': time.time()},
+        timeout=300,
+    )
+
+    scheduled_key = _reroute_scheduled_key(booking_id)
+    if not cache.add(scheduled_key, 1, timeout=int(REROUTE_DEBOUNCE_SECONDS) + 60):
+        return False
+
+    if not enqueue(reroute_booking, booking_id, countdown=REROUTE_DEBOUNCE_SECONDS):
+        # No worker (e.g. local dev): skip this reroute rather than calling ORS
+        # inside the location request. The flag now only spaces out retries,
+        # so a ping after the debounce window tries the broker again.
+        cache.set(scheduled_key, 1, timeout=max(int(REROUTE_DEBOUNCE_SECONDS), 1))
         return False
+    return True
+
+
+@shared_task
+def reroute_booking(booking_id):
+    """Reroute a booking from the latest recorded driver fix, if it has deviated."""
+    # Clear the flag first so pings arriving while we work schedule a fresh run.
+    cache.delete(_reroute_scheduled_key(booking_id))
 
-    return False
+    latest = cache.get(_reroute_latest_key(booking_id))
+    if not latest:
+        return False
+
+    booking = Booking.objects.filter(
+        id=booking_id,
+        status__in=['accepted', 'on_the_way', 'started']
+    ).first()
+    if not booking or not booking.driver_id:
+        return False
+
+    location = DriverLocation(
+        driver_id=booking.driver_id,
+        latitude=Decimal(latest['latitude']),
+        longitude=Decimal(latest['longitude']),
+    )
+    try:
+        check_and_reroute(booking, location)
+    except Exception as e:
+        print(f"Reroute failed for booking {booking_id}: {e}")
+        return False
+    return True
+
+
+@shared_task
+def flush_driver_locations():
+    """Periodic flush of buffered driver fixes, so quiet periods still reach the database."""
+    from .location_buffer import flush_all
+    return flush_all()
+
+
+@shared_task
+def prune_route_snapshots():
+    """Periodic route snapshot retention: trim live histories, compact finished trips."""
+    from .route_retention import prune
+    return prune()
+
+
+@shared_task
+def refresh_driver_itinerary(driver_id):
+    """Rebuild and cache a driver's itinerary after a booking or location event."""
+    from django.contrib.auth import get_user_model
+    from .itinerary import refresh_itinerary
+
+    driver = get_user_model().objects.filter(id=driver_id).first()
+    if driver is None:
+        return False
+    refresh_itinerary(driver)
+    return True
+
+
+@shared_task
+def estimate_booking_fare(booking_id):
+    """Route and price a booking that was created without a quote."""
+    from .quotes import estimate_booking
+
+    booking = Booking.objects.filter(id=booking_id, fare__isnull=True).first()
+    if booking is None:
+        return False
+    try:
+        return estimate_booking(booking)
+    except Exception as e:
+        print(f"Fare estimate failed for booking {booking_id}: {e}")
+        return False
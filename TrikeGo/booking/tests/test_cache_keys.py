@@ -0,0 +1,83 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking import cache_keys, itinerary, location_buffer
+from booking.models import Booking, BookingStop
+from user.models import Driver, Tricycle
+
+User = get_user_model()
+
+
+class CacheVersionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        location_buffer._dirty = None
+        cache.add(location_buffer.FLUSH_LOCK_KEY, 1, timeout=60)
+        self.driver = User.objects.create_user(username='drv-ver', password='pass', trikego_user='D')
+        self.profile = Driver.objects.create(user=self.driver, license_number='12345678901', license_expiry='2099-01-01',
+                                             date_hired='2020-01-01', years_of_service=1)
+        self.rider = User.objects.create_user(username='rdr-ver', password='pass', trikego_user='R')
+        self.booking = Booking.objects.create(
+            rider=self.rider, driver=self.driver, status='accepted',
+            pickup_address='A', pickup_latitude=10.3050, pickup_longitude=123.9000,
+            destination_address='B', destination_latitude=10.3200, destination_longitude=123.9100,
+        )
+
+    def key(self):
+        return cache_keys.route_info_key(self.booking)
+
+    def test_bump_moves_the_key(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        cache_keys.bump_booking(self.booking.id)
+        self.assertNotEqual(self.key(), key)
+
+        key = self.key()
+        cache_keys.bump_driver(self.driver.id)
+        self.assertNotEqual(self.key(), key)
+
+    def test_booking_and_stop_writes_bump_after_commit(self):
+        key = self.key()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.booking.status = 'on_the_way'
+            self.booking.save()
+        # Not before commit: a reader could still see the old row
+        self.assertEqual(self.key(), key)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(self.key(), key)
+
+        key = self.key()
+        with self.captureOnCommitCallbacks(execute=True):
+            BookingStop.objects.create(booking=self.booking, sequence=1, stop_type='PICKUP',
+                                       latitude=10.3050, longitude=123.9000)
+        self.assertNotEqual(self.key(), key)
+
+    def test_driver_events_bump_the_driver_version(self):
+        # Positions are added on read, so pings keep the key
+        key = self.key()
+        location_buffer.record_fix(self.driver.id, 10.3010, 123.9010)
+        self.assertEqual(self.key(), key)
+
+        itinerary.invalidate(self.driver.id)
+        self.assertNotEqual(self.key(), key)
+
+        key = self.key()
+        with self.captureOnCommitCallbacks(execute=True):
+            Tricycle.objects.create(plate_number='VER123', color='Red', driver=self.profile, max_capacity=3)
+        self.assertNotEqual(self.key(), key)
+
+    def test_other_bookings_keep_their_key(self):
+        other = Booking.objects.create(
+            rider=self.rider, status='pending',
+            pickup_address='C', pickup_latitude=10.31, pickup_longitude=123.91,
+            destination_address='D', destination_latitude=10.33, destination_longitude=123.92,
+        )
+        key = cache_keys.route_info_key(other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.booking.status = 'on_the_way'
+            self.booking.save()
+        location_buffer.record_fix(self.driver.id, 10.3010, 123.9010)
+        self.assertEqual(cache_keys.route_info_key(other), key)
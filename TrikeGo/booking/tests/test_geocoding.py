@@ -0,0 +1,114 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from booking import geocoding
+
+User = get_user_model()
+
+ORS_RESULTS = [
+    {'formatted': 'Ayala Center Cebu, Cebu City', 'name': 'Ayala Center Cebu', 'lat': 10.3180, 'lon': 123.9050},
+    {'formatted': 'Ayala Business Park, Cebu City', 'name': 'Ayala Business Park', 'lat': 10.3170, 'lon': 123.9060},
+    {'formatted': 'Ayala Malls Central Bloc, Cebu City', 'name': 'Central Bloc', 'lat': 10.3290, 'lon': 123.9060},
+    # Outside the service area: returned, never indexed
+    {'formatted': 'Ayala Center, Makati', 'name': 'Ayala Center', 'lat': 14.5510, 'lon': 121.0240},
+]
+
+
+class GeocodingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        geocoding.index.reset()
+
+    def ors(self, results=ORS_RESULTS):
+        return mock.patch('booking.services.RoutingService.geocode_address', return_value=results)
+
+    def test_normalize(self):
+        self.assertEqual(geocoding.normalize('  Ayala,  CENTER  Cebú. '), 'ayala center cebu')
+
+    def test_trie_matches_every_word_by_prefix(self):
+        trie = geocoding.PlaceTrie()
+        for place in ORS_RESULTS[:3]:
+            trie.add(geocoding.place_key(place), place)
+        self.assertEqual({p['name'] for p in trie.search('aya cen')}, {'Ayala Center Cebu', 'Central Bloc'})
+        self.assertEqual([p['name'] for p in trie.search('business')], ['Ayala Business Park'])
+        self.assertEqual(trie.search('sm seaside'), [])
+
+    def test_resolved_places_answer_later_queries_locally(self):
+        with self.ors() as geocode:
+            results, source = geocoding.autocomplete('Ayala')
+        self.assertEqual((source, geocode.call_count), ('ors', 1))
+        self.assertEqual(len(results), 4)
+
+        with self.ors() as geocode:
+            for query in ['ayala', 'Ayal', 'AYALA  cebu', 'ayala c']:
+                results, source = geocoding.autocomplete(query)
+                self.assertEqual(source, 'local', query)
+        geocode.assert_not_called()
+        self.assertNotIn('Ayala Center, Makati', [r['label'] for r in results])
+
+    def test_normalized_query_cache(self):
+        with self.ors(ORS_RESULTS[3:]) as geocode:
+            geocoding.autocomplete('Makati Ayala')
+            results, source = geocoding.autocomplete('  makati, AYALA ')
+        self.assertEqual((source, geocode.call_count), ('cache', 1))
+        self.assertEqual(results[0]['label'], 'Ayala Center, Makati')
+
+    def test_results_ranked_by_distance(self):
+        with self.ors():
+            geocoding.autocomplete('ayala')
+        results, _ = geocoding.autocomplete('ayala', near=(10.3290, 123.9061))
+        self.assertEqual(results[0]['name'], 'Central Bloc')
+        self.assertEqual([r['distance_m'] for r in results], sorted(r['distance_m'] for r in results))
+
+    def test_other_workers_pick_up_learned_places(self):
+        with self.ors():
+            geocoding.autocomplete('ayala')
+        other = geocoding.PlaceIndex()
+        self.assertEqual(len(other.search('ayala')), 3)
+
+    def test_concurrent_learns_keep_each_others_places(self):
+        other = geocoding.PlaceIndex()
+        geocoding.index.learn(ORS_RESULTS[:1])
+        other.learn(ORS_RESULTS[1:3])
+        self.assertEqual(len(cache.get(geocoding.PLACES_KEY)), 3)
+
+        # Another worker holds the lock: places stay local and nothing is overwritten
+        cache.add(geocoding.PLACES_LOCK_KEY, 1)
+        with mock.patch('booking.geocoding.GEOCODE_INDEX_LOCK_WAIT', 0):
+            self.assertEqual(other.learn([dict(ORS_RESULTS[0], lat=10.3, formatted='Fuente Circle')]), 1)
+        self.assertEqual(len(cache.get(geocoding.PLACES_KEY)), 3)
+
+    def test_cache_outage_falls_through_to_ors(self):
+        with self.ors() as geocode, \
+                mock.patch('booking.geocoding.cache.get', side_effect=ConnectionError), \
+                mock.patch('booking.geocoding.cache.set', side_effect=ConnectionError):
+            results, source = geocoding.autocomplete('ayala')
+        self.assertEqual((source, geocode.call_count, len(results)), ('ors', 1, 4))
+
+    def test_reverse_is_cached_per_cell(self):
+        url = reverse('booking:reverse_geocode')
+        user = User.objects.create_user(username='rdr-rev', password='pass', trikego_user='R')
+        self.client.force_login(user)
+        place = {'formatted': 'Fuente Osmeña Circle, Cebu City', 'name': 'Fuente Osmeña', 'lat': 10.3105, 'lon': 123.8930}
+        with mock.patch('booking.services.RoutingService.reverse_geocode', return_value=place) as ors:
+            first = self.client.get(url, {'lat': '10.31051', 'lon': '123.89302'}).json()
+            second = self.client.get(url, {'lat': '10.31049', 'lon': '123.89298'}).json()
+        self.assertEqual(first, second)
+        self.assertEqual(first['result']['formatted'], place['formatted'])
+        ors.assert_called_once()
+        self.assertEqual(self.client.get(url, {'lat': 'x'}).status_code, 400)
+
+    def test_endpoint(self):
+        url = reverse('booking:geocode')
+        self.assertIn(self.client.get(url, {'q': 'ayala'}).status_code, (401, 403))
+        user = User.objects.create_user(username='rdr-geo', password='pass', trikego_user='R')
+        self.client.force_login(user)
+        with self.ors():
+            data = self.client.get(url, {'q': 'ayala', 'lat': '10.318', 'lon': '123.905'}).json()
+        self.assertEqual(data['source'], 'ors')
+        self.assertEqual(data['results'][0]['name'], 'Ayala Center Cebu')
+        self.assertEqual(self.client.get(url, {'q': 'ay'}).json()['results'], [])
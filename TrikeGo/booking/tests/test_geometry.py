@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from booking import geometry, route_index
+
+
+def _reference_haversine_m(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 6371000 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+class GeometryTest(SimpleTestCase):
+    def test_scalar_and_vector_paths_agree(self):
+        expected = _reference_haversine_m(14.5995, 120.9842, 14.6030, 120.9900)
+        self.assertAlmostEqual(geometry.haversine_m(14.5995, 120.9842, 14.6030, 120.9900), expected, places=6)
+        vec = geometry.haversine_m(np.array([14.5995]), np.array([120.9842]), 14.6030, 120.9900)
+        self.assertAlmostEqual(float(vec[0]), expected, places=6)
+
+    def test_pairwise_matrix(self):
+        pts = [(10.30, 123.90), (10.31, 123.91), (10.29, 123.88)]
+        matrix = geometry.pairwise_matrix_m(pts)
+        self.assertEqual(matrix.shape, (3, 3))
+        self.assertTrue(np.allclose(np.diag(matrix), 0))
+        self.assertTrue(np.allclose(matrix, matrix.T))
+        self.assertAlmostEqual(matrix[0, 2], _reference_haversine_m(10.30, 123.90, 10.29, 123.88), places=6)
+
+    def test_point_to_points(self):
+        d = geometry.point_to_points_m(10.30, 123.90, [(10.30, 123.90), (10.31, 123.90)])
+        self.assertAlmostEqual(d[0], 0.0)
+        self.assertAlmostEqual(d[1], _reference_haversine_m(10.30, 123.90, 10.31, 123.90), places=6)
+
+    def test_point_to_polyline_measures_to_segments(self):
+        # A long straight east-west segment ~2.2km; the point sits 50m north of its middle.
+        line = [(10.30, 123.89), (10.30, 123.91)]
+        north_offset_deg = 50 / 111195.0
+        dist, idx = geometry.point_to_polyline_m(10.30 + north_offset_deg, 123.90, line)
+        self.assertEqual(idx, 0)
+        self.assertAlmostEqual(dist, 50.0, delta=0.5)
+        # The nearest vertex is over a kilometer away, which is what the old check measured.
+        self.assertGreater(min(geometry.point_to_points_m(10.30 + north_offset_deg, 123.90, line)), 1000)
+
+    def test_point_to_polyline_lonlat_order(self):
+        dist, _ = geometry.point_to_polyline_m(10.30, 123.90, [[123.89, 10.30], [123.91, 10.30]], lonlat=True)
+        self.assertAlmostEqual(dist, 0.0, delta=0.01)
+
+    def test_simplify_polyline_respects_tolerance(self):
+        rng = np.random.default_rng(5)
+        line = np.column_stack((np.linspace(10.30, 10.32, 400), np.linspace(123.90, 123.92, 400)))
+        noisy = line + rng.normal(scale=0.000005, size=line.shape)  # ~0.5 m jitter
+        simplified = geometry.simplify_polyline(noisy, 3.0)
+        self.assertLess(len(simplified), 20)
+        self.assertEqual(tuple(simplified[0]), tuple(noisy[0]))
+        self.assertEqual(tuple(simplified[-1]), tuple(noisy[-1]))
+        for lat, lon in noisy[::17]:
+            self.assertLessEqual(geometry.point_to_polyline_m(lat, lon, simplified)[0], 3.05)
+
+
+class PolylineIndexTest(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        # A wandering ~1000-vertex route around Cebu City, in GeoJSON (lon, lat) order
+        steps = rng.normal(scale=0.0004, size=(1000, 2)) + [0.0002, 0.0001]
+        self.lonlat = np.cumsum(steps, axis=0) + [123.88, 10.29]
+        self.index = route_index.PolylineIndex.from_lonlat(self.lonlat.tolist())
+
+    def test_grid_query_matches_full_scan(self):
+        rng = np.random.default_rng(11)
+        for lon, lat in self.lonlat[rng.integers(0, len(self.lonlat), 50)] + rng.normal(scale=0.001, size=(50, 2)):
+            full, _ = geometry.point_to_polyline_m(lat, lon, self.lonlat.tolist(), lonlat=True)
+            self.assertEqual(self.index.is_within(lat, lon, 100), full <= 100)
+            if full <= 100:
+                self.assertAlmostEqual(self.index.distance_m(lat, lon, 100), full, delta=0.5)
+
+    def test_far_point_is_outside(self):
+        self.assertEqual(self.index.distance_m(11.0, 124.5, 100), float('inf'))
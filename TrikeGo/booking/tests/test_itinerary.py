@@ -0,0 +1,81 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking import itinerary
+from booking.models import Booking, DriverLocation
+from user.models import Driver, Tricycle
+
+User = get_user_model()
+
+
+# Keep rebuilds off the network: straight-line planning and route legs
+@mock.patch('booking.utils.ROAD_AWARE_PLANNING', False)
+@mock.patch('booking.services.RoutingService._request_legs', mock.Mock(return_value=None))
+class ItineraryCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Keep the tests off the network: treat the Celery broker as down
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        self.driver = User.objects.create_user(username='drv-itin', password='pass', trikego_user='D')
+        profile = Driver.objects.create(user=self.driver, license_number='12345678901', license_expiry='2099-01-01',
+                                        date_hired='2020-01-01', years_of_service=1, status='In_trip')
+        Tricycle.objects.create(plate_number='ITN123', color='Red', driver=profile, max_capacity=3)
+        self.rider = User.objects.create_user(username='rdr-itin', password='pass', trikego_user='R')
+        DriverLocation.objects.create(driver=self.driver, latitude=10.3000, longitude=123.9000)
+        self.booking = Booking.objects.create(
+            rider=self.rider, driver=self.driver, status='accepted',
+            pickup_address='A', pickup_latitude=10.3050, pickup_longitude=123.9000,
+            destination_address='B', destination_latitude=10.3200, destination_longitude=123.9100,
+        )
+
+    def test_reads_are_served_from_cache(self):
+        first = itinerary.get_itinerary(self.driver)
+        self.assertEqual(len(first['itinerary']['stops']), 2)
+        with self.assertNumQueries(0):
+            second = itinerary.get_itinerary(self.driver)
+        self.assertEqual(second, first)
+
+    def test_miss_with_a_worker_serves_the_last_itinerary_and_queues_a_rebuild(self):
+        built = itinerary.get_itinerary(self.driver)
+        itinerary.invalidate(self.driver.id)
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            with mock.patch('booking.itinerary.refresh_itinerary', side_effect=AssertionError('inline rebuild')):
+                with self.assertNumQueries(0):
+                    payload = itinerary.get_itinerary(self.driver)
+                itinerary.get_itinerary(self.driver)
+        self.assertTrue(payload['stale'])
+        self.assertEqual(payload['itinerary'], built['itinerary'])
+        self.assertEqual(enqueue.call_count, 1)
+
+        cache.clear()
+        with mock.patch('booking.tasks.enqueue', return_value=True):
+            self.assertEqual(itinerary.get_itinerary(self.driver), {'status': 'pending', 'itinerary': None})
+
+    def test_booking_event_invalidates(self):
+        version = itinerary.get_itinerary(self.driver)['itinerary']['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.booking.status = 'cancelled'
+            self.booking.save()
+        payload = itinerary.get_itinerary(self.driver)
+        self.assertGreater(payload['itinerary']['version'], version)
+        self.assertEqual(payload['itinerary']['stops'], [])
+
+    def test_unassigning_driver_invalidates_previous_driver(self):
+        version = itinerary.get_itinerary(self.driver)['itinerary']['version']
+        booking = Booking.objects.get(id=self.booking.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.driver = None
+            booking.status = 'pending'
+            booking.save()
+        self.assertGreater(itinerary.current_version(self.driver.id), version)
+
+    def test_only_significant_moves_trigger_refresh(self):
+        itinerary.get_itinerary(self.driver)
+        version = itinerary.current_version(self.driver.id)
+        self.assertFalse(itinerary.note_driver_moved(self.driver.id, 10.3005, 123.9000))
+        self.assertEqual(itinerary.current_version(self.driver.id), version)
+        self.assertTrue(itinerary.note_driver_moved(self.driver.id, 10.3030, 123.9000))
+        self.assertEqual(itinerary.current_version(self.driver.id), version + 1)
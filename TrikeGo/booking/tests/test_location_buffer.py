@@ -0,0 +1,112 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from booking import location_buffer
+from booking.models import DriverLocation
+from user.models import Driver
+
+User = get_user_model()
+
+
+class LocationBufferTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_buffer._dirty = None
+        self.drivers = []
+        for i in range(3):
+            user = User.objects.create_user(username=f'drv-buf-{i}', password='pass', trikego_user='D')
+            Driver.objects.create(user=user, license_number=f'1234567890{i}', license_expiry='2099-01-01',
+                                  date_hired='2020-01-01', years_of_service=1, status='Online')
+            self.drivers.append(user)
+        # Hold the interval lock so pings only buffer until we flush explicitly
+        cache.add(location_buffer.FLUSH_LOCK_KEY, 1, timeout=60)
+
+    def test_pings_buffer_until_flush(self):
+        for step in range(5):
+            for user in self.drivers:
+                location_buffer.record_fix(user.id, 10.30 + step * 0.001, 123.90, speed=4)
+        self.assertFalse(DriverLocation.objects.exists())
+        self.assertEqual(cache.get(location_buffer.fix_key(self.drivers[0].id))['latitude'], '10.304')
+
+        with self.assertNumQueries(1):
+            written = location_buffer.flush()
+        self.assertEqual(written, 3)
+        self.assertEqual(DriverLocation.objects.count(), 3)
+        location = DriverLocation.objects.get(driver=self.drivers[0])
+        self.assertEqual(location.latitude, Decimal('10.304'))
+        self.assertEqual(location.speed, Decimal('4'))
+
+        stats = location_buffer.buffer_stats()
+        self.assertEqual(stats['received'], 15)
+        self.assertEqual(stats['flushed'], 3)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_flush_upserts_existing_rows(self):
+        DriverLocation.objects.create(driver=self.drivers[0], latitude=1, longitude=1)
+        location_buffer.record_fix(self.drivers[0].id, 10.31, 123.91)
+        location_buffer.flush()
+        self.assertEqual(DriverLocation.objects.filter(driver=self.drivers[0]).count(), 1)
+        self.assertEqual(DriverLocation.objects.get(driver=self.drivers[0]).longitude, Decimal('123.91'))
+
+    def test_flush_keeps_the_time_of_the_fix(self):
+        fix = location_buffer.record_fix(self.drivers[0].id, 10.30, 123.90)
+        later = timezone.now() + timedelta(seconds=30)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            location_buffer.flush()
+        self.assertEqual(DriverLocation.objects.get(driver=self.drivers[0]).timestamp.isoformat(), fix['timestamp'])
+
+    def shared_set(self):
+        # Stands in for the Redis set the worker can see
+        dirty = location_buffer._LocalDirtySet()
+        dirty.shared = True
+        location_buffer._dirty = dirty
+        return dirty
+
+    def test_shared_set_is_flushed_by_the_worker(self):
+        self.shared_set()
+        cache.delete(location_buffer.FLUSH_LOCK_KEY)
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            location_buffer.record_fix(self.drivers[0].id, 10.30, 123.90)
+        self.assertEqual(enqueue.call_args.args[0].name, 'booking.tasks.flush_driver_locations')
+        self.assertFalse(DriverLocation.objects.exists())
+        self.assertEqual(location_buffer.buffer_stats()['pending'], 1)
+
+    def test_without_a_broker_the_ping_flushes(self):
+        self.shared_set()
+        cache.delete(location_buffer.FLUSH_LOCK_KEY)
+        with mock.patch('booking.tasks.enqueue', return_value=False):
+            location_buffer.record_fix(self.drivers[0].id, 10.30, 123.90)
+        self.assertEqual(DriverLocation.objects.count(), 1)
+
+    def test_per_process_set_is_flushed_by_the_ping(self):
+        # The worker can't see this process's set, so nothing is queued
+        cache.delete(location_buffer.FLUSH_LOCK_KEY)
+        with mock.patch('booking.tasks.enqueue', side_effect=AssertionError('queued')):
+            for user in self.drivers:
+                location_buffer.record_fix(user.id, 10.30, 123.90)
+        # The first ping flushed; the others wait for the next interval
+        self.assertEqual(DriverLocation.objects.count(), 1)
+        self.assertEqual(location_buffer.buffer_stats()['pending'], 2)
+
+    def test_backlog_over_limit_queues_a_flush(self):
+        self.shared_set()
+        original = location_buffer.LOCATION_BUFFER_MAX_PENDING
+        location_buffer.LOCATION_BUFFER_MAX_PENDING = 2
+        try:
+            with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+                location_buffer.record_fix(self.drivers[0].id, 10.30, 123.90)
+                enqueue.assert_not_called()
+                for user in self.drivers:
+                    location_buffer.record_fix(user.id, 10.30, 123.90)
+        finally:
+            location_buffer.LOCATION_BUFFER_MAX_PENDING = original
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(enqueue.call_args.args[0].name, 'booking.tasks.flush_driver_locations')
+        self.assertFalse(DriverLocation.objects.exists())
+        self.assertEqual(location_buffer.buffer_stats()['forced_flushes'], 1)
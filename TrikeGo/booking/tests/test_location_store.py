@@ -0,0 +1,58 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking import location_buffer, location_store
+from booking.models import DriverLocation
+
+User = get_user_model()
+
+
+class LocationStoreTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        location_buffer._dirty = None
+        cache.add(location_buffer.FLUSH_LOCK_KEY, 1, timeout=60)
+        self.users = [
+            User.objects.create_user(username=f'drv-store-{i}', password='pass', trikego_user='D')
+            for i in range(3)
+        ]
+
+    def test_buffered_fix_is_served_before_flush(self):
+        location_buffer.record_fix(self.users[0].id, 10.31, 123.91, heading=90, speed=5)
+        with self.assertNumQueries(0):
+            fix = location_store.get_driver_location(self.users[0].id)
+        self.assertEqual(fix.latlon, (10.31, 123.91))
+        self.assertEqual(fix.heading, 90.0)
+        self.assertEqual(fix.speed, 5.0)
+        self.assertIsNotNone(fix.timestamp)
+
+    def test_batch_read_through(self):
+        DriverLocation.objects.create(driver=self.users[0], latitude=10.30, longitude=123.90)
+        location_buffer.record_fix(self.users[1].id, 10.32, 123.92)
+        ids = [u.id for u in self.users]
+
+        with self.assertNumQueries(1):
+            fixes = location_store.get_driver_locations(ids)
+        self.assertEqual(set(fixes), {self.users[0].id, self.users[1].id})
+        self.assertEqual(fixes[self.users[0].id].lonlat, (123.90, 10.30))
+
+        # Hits and the remembered miss are all served from the cache now
+        with self.assertNumQueries(0):
+            self.assertEqual(location_store.get_driver_locations(ids), fixes)
+
+    def test_backfill_never_overwrites_a_newer_fix(self):
+        DriverLocation.objects.create(driver=self.users[0], latitude=10.30, longitude=123.90)
+        location_buffer.record_fix(self.users[0].id, 10.35, 123.95)
+        # The ping lands between the cache read and the DriverLocation query
+        with mock.patch.object(cache, 'get_many', return_value={}):
+            fix = location_store.get_driver_location(self.users[0].id)
+        self.assertEqual(fix.latlon, (10.35, 123.95))
+        self.assertEqual(cache.get(location_buffer.fix_key(self.users[0].id))['latitude'], '10.35')
+
+    def test_direct_save_invalidates_cached_fix(self):
+        self.assertIsNone(location_store.get_driver_location(self.users[2].id))
+        DriverLocation.objects.create(driver=self.users[2], latitude=10.33, longitude=123.93)
+        self.assertEqual(location_store.get_driver_location(self.users[2].id).latlon, (10.33, 123.93))
@@ -0,0 +1,100 @@
+import os
+import random
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from booking import offline_routing
+from booking.offline_routing import RoadGraph
+from booking.services import RoutingService
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="10.3000" lon="123.9000"/>
+  <node id="2" lat="10.3000" lon="123.9050"/>
+  <node id="3" lat="10.3050" lon="123.9050"/>
+  <node id="4" lat="10.3050" lon="123.9000"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="primary"/></way>
+  <way id="11"><nd ref="3"/><nd ref="4"/><tag k="highway" v="residential"/><tag k="oneway" v="yes"/></way>
+  <way id="12"><nd ref="4"/><nd ref="1"/><tag k="highway" v="footway"/></way>
+</osm>
+"""
+
+
+def grid_graph(size=15, spacing=0.002, seed=3):
+    rng = random.Random(seed)
+    lat, lon, edges = [], [], []
+    for r in range(size):
+        for c in range(size):
+            lat.append(10.30 + r * spacing)
+            lon.append(123.90 + c * spacing)
+    for r in range(size):
+        for c in range(size):
+            u = r * size + c
+            for dr, dc in ((0, 1), (1, 0)):
+                if r + dr < size and c + dc < size:
+                    v = (r + dr) * size + c + dc
+                    length = 220.0
+                    for a, b in ((u, v), (v, u)):
+                        edges.append((a, b, length, length / rng.uniform(4, 12)))
+    return RoadGraph.from_edges(lat, lon, edges)
+
+
+class OfflineRoutingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.graph = grid_graph()
+
+    def tearDown(self):
+        offline_routing.set_graph(None)
+
+    def test_astar_matches_dijkstra(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            source, target = rng.randrange(len(self.graph)), rng.randrange(len(self.graph))
+            nodes, length, duration = self.graph.shortest_path(source, target)
+            _, durations = self.graph.one_to_many(source, [target])
+            self.assertAlmostEqual(duration, durations[0], places=3)
+            self.assertEqual((nodes[0], nodes[-1]), (source, target))
+            self.assertAlmostEqual(length, 220.0 * (len(nodes) - 1), places=2)
+
+    def test_route_matches_calculate_route_shape(self):
+        result = offline_routing.route((123.9001, 10.3001), (123.9200, 10.3200), graph=self.graph)
+        coordinates = result['route_data']['features'][0]['geometry']['coordinates']
+        self.assertEqual(coordinates[0], [123.9001, 10.3001])
+        self.assertEqual(coordinates[-1], [123.92, 10.32])
+        self.assertGreater(result['distance'], 4.0)
+        self.assertFalse(result['too_close'])
+        self.assertIsNone(offline_routing.route((124.5, 11.0), (123.92, 10.32), graph=self.graph))
+
+    def test_service_falls_back_when_ors_fails(self):
+        offline_routing.set_graph(self.graph)
+        service = RoutingService()
+        with mock.patch.object(offline_routing, 'ROUTING_BACKEND', 'fallback'), \
+                mock.patch.object(service, 'client') as client:
+            client.directions.side_effect = Exception('rate limited')
+            client.distance_matrix.side_effect = Exception('rate limited')
+            route = service.calculate_route((123.9001, 10.3001), (123.9200, 10.3200))
+            matrix = service.calculate_matrix([(123.9001, 10.3001)], [(123.9200, 10.3200), (123.9100, 10.3100)])
+        self.assertEqual(route['route_data']['features'][0]['properties']['engine'], 'offline')
+        self.assertEqual(matrix['durations'].shape, (1, 2))
+        self.assertFalse(any(v != v for v in matrix['durations'][0]))
+
+    def test_build_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'area.osm')
+            output = os.path.join(tmp, 'graph.npz')
+            with open(source, 'w') as fh:
+                fh.write(OSM_XML)
+            call_command('build_routing_graph', source, output, stdout=open(os.devnull, 'w'))
+            graph = RoadGraph.load(output)
+        # footway dropped; primary both ways (2 segments x 2), residential one way
+        self.assertEqual(len(graph), 4)
+        self.assertEqual(len(graph.indices), 5)
+        start, _ = graph.nearest_node(10.3050, 123.9000)
+        end, _ = graph.nearest_node(10.3050, 123.9050)
+        self.assertIsNone(graph.shortest_path(start, end))
+        self.assertIsNotNone(graph.shortest_path(end, start))
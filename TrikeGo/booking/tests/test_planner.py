@@ -0,0 +1,66 @@
+import itertools
+import random
+
+from django.test import SimpleTestCase
+
+from booking import planner
+from booking.planner import DROPOFF, PICKUP, PlanStop, PlanningProblem
+
+
+def _random_problem(rng, bookings, onboard_bookings=0, capacity=None):
+    stops = []
+    onboard = 0
+    for b in range(bookings):
+        load = rng.randint(1, 2)
+        pickup = (10.30 + rng.uniform(-0.03, 0.03), 123.90 + rng.uniform(-0.03, 0.03))
+        dropoff = (10.30 + rng.uniform(-0.03, 0.03), 123.90 + rng.uniform(-0.03, 0.03))
+        if b < onboard_bookings:
+            onboard += load
+        else:
+            stops.append(PlanStop(f'p{b}', b, PICKUP, load, pickup))
+        stops.append(PlanStop(f'd{b}', b, DROPOFF, load, dropoff))
+    return PlanningProblem(stops, start=(10.30, 123.90), capacity=capacity, onboard=onboard)
+
+
+def _brute_force(problem):
+    best = float('inf')
+    for order in itertools.permutations(range(len(problem))):
+        if problem.feasible(order):
+            best = min(best, problem.cost(order))
+    return best
+
+
+class PlannerTest(SimpleTestCase):
+    def test_exact_matches_brute_force(self):
+        rng = random.Random(5)
+        for _ in range(5):
+            problem = _random_problem(rng, bookings=4, onboard_bookings=1, capacity=3)
+            order = planner.ExactPlanner().solve(problem)
+            self.assertTrue(problem.feasible(order))
+            self.assertAlmostEqual(problem.cost(order), _brute_force(problem), places=9)
+
+    def test_heuristics_respect_constraints(self):
+        rng = random.Random(9)
+        problem = _random_problem(rng, bookings=15, onboard_bookings=2, capacity=4)
+        insertion = planner.InsertionPlanner().solve(problem)
+        local = planner.LocalSearchPlanner(time_budget_ms=500).solve(problem)
+        for order in (insertion, local):
+            self.assertEqual(sorted(order), list(range(len(problem))))
+            self.assertTrue(problem.feasible(order))
+        self.assertLessEqual(problem.cost(local), problem.cost(insertion) + 1e-9)
+
+    def test_single_seat_serves_bookings_one_at_a_time(self):
+        stops = [
+            PlanStop('p1', 1, PICKUP, 1, (10.300, 123.900)),
+            PlanStop('p2', 2, PICKUP, 1, (10.301, 123.900)),
+            PlanStop('d1', 1, DROPOFF, 1, (10.320, 123.900)),
+            PlanStop('d2', 2, DROPOFF, 1, (10.321, 123.900)),
+        ]
+        unconstrained = planner.plan(PlanningProblem(stops, start=(10.299, 123.900)), 'exact')
+        self.assertEqual(unconstrained, ['p1', 'p2', 'd1', 'd2'])
+        single = planner.plan(PlanningProblem(stops, start=(10.299, 123.900), capacity=1), 'exact')
+        self.assertEqual(single, ['p1', 'd1', 'p2', 'd2'])
+
+    def test_oversized_booking_relaxes_capacity(self):
+        stops = [PlanStop('p', 1, PICKUP, 3, (10.30, 123.90)), PlanStop('d', 1, DROPOFF, 3, (10.31, 123.90))]
+        self.assertEqual(planner.plan(PlanningProblem(stops, capacity=1), 'insertion'), ['p', 'd'])
@@ -0,0 +1,85 @@
+import importlib
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking import polyline, route_index
+from booking.models import Booking, RouteSnapshot
+from booking.services import RoutingService
+
+User = get_user_model()
+
+
+class PolylineTest(TestCase):
+    def test_reference_encoding(self):
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(polyline.encode(points), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(polyline.decode('_p~iF~ps|U_ulLnnqC_mqNvxq`@'), points)
+
+    def test_round_trip_keeps_five_decimals(self):
+        points = [(10.300001 + i * 0.00013, 123.900004 - i * 0.00021) for i in range(200)]
+        decoded = polyline.decode(polyline.encode(points))
+        self.assertEqual(len(decoded), 200)
+        for (lat, lon), (dlat, dlon) in zip(points, decoded):
+            self.assertAlmostEqual(lat, dlat, places=5)
+            self.assertAlmostEqual(lon, dlon, places=5)
+
+
+class CompactSnapshotTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        rider = User.objects.create_user(username='rdr-poly', password='pass', trikego_user='R')
+        self.booking = Booking.objects.create(
+            rider=rider, status='pending',
+            pickup_address='A', pickup_latitude=10.3000, pickup_longitude=123.9000,
+            destination_address='B', destination_latitude=10.3200, destination_longitude=123.9200,
+        )
+        coordinates = [[123.9000 + i * 0.0001, 10.3000 + i * 0.0001] for i in range(201)]
+        step = {'instruction': 'Head north', 'name': 'Osmeña Blvd', 'type': 11,
+                'distance': 3100.0, 'duration': 420.0, 'way_points': [0, 200],
+                'exit_number': None, 'maneuver': {'bearing_after': 45}}
+        self.route_info = {
+            'route_data': {
+                'type': 'FeatureCollection',
+                'features': [{
+                    'type': 'Feature',
+                    'geometry': {'type': 'LineString', 'coordinates': coordinates},
+                    'properties': {'segments': [{'distance': 3100.0, 'duration': 420.0, 'steps': [step]}]},
+                }],
+            },
+            'distance': 3.1, 'duration': 420, 'too_close': False,
+        }
+
+    def test_snapshot_stores_encoded_geometry_and_steps(self):
+        snapshot = RoutingService().save_route_snapshot(self.booking, self.route_info)
+        snapshot = RouteSnapshot.objects.get(pk=snapshot.pk)
+        self.assertIsNone(snapshot.route_data)
+        self.assertEqual(snapshot.steps[0], {'instruction': 'Head north', 'name': 'Osmeña Blvd', 'type': 11,
+                                             'distance': 3100.0, 'duration': 420.0, 'way_points': [0, 200]})
+        self.assertLess(len(snapshot.geometry) * 10, len(str(self.route_info['route_data'])))
+
+        self.assertEqual(len(snapshot.coordinates), 201)
+        self.assertEqual(snapshot.coordinates[-1], (10.32, 123.92))
+        geojson = snapshot.as_geojson()
+        self.assertEqual(geojson['features'][0]['geometry']['coordinates'][0], [123.9, 10.3])
+        # Steps sit where ORS puts them, so compact_route reads them back
+        self.assertEqual(geojson['features'][0]['properties']['segments'][0]['steps'], snapshot.steps)
+        self.assertEqual(polyline.compact_route(geojson), {'geometry': snapshot.geometry, 'steps': snapshot.steps})
+
+        index = route_index.for_snapshot(snapshot)
+        self.assertTrue(index.is_within(10.3101, 123.9100, 50))
+        route_index.discard(snapshot.pk)
+
+    def test_legacy_snapshot_decodes_from_route_data(self):
+        snapshot = RouteSnapshot.objects.create(
+            booking=self.booking, route_data=self.route_info['route_data'], distance=3.1, duration=420,
+        )
+        self.assertEqual(len(snapshot.coordinates), 201)
+        self.assertEqual(snapshot.as_geojson(), self.route_info['route_data'])
+
+    def test_migration_compacts_like_the_module(self):
+        migration = importlib.import_module('booking.migrations.0010_routesnapshot_compact_geometry')
+        self.assertEqual(migration.compact_route(self.route_info['route_data']),
+                         polyline.compact_route(self.route_info['route_data']))
@@ -0,0 +1,121 @@
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from booking import quotes, transport
+from booking.models import Booking
+from booking.route_cache import route_cache
+from booking.tasks import estimate_booking_fare
+from user.models import Rider
+
+User = get_user_model()
+
+PICKUP = (123.9000, 10.3000)
+DESTINATION = (123.9200, 10.3200)
+
+
+def ors_route(distance_m=3400, duration_s=600):
+    return {'features': [{
+        'geometry': {'type': 'LineString', 'coordinates': [list(PICKUP), list(DESTINATION)]},
+        'properties': {'segments': [{'distance': distance_m, 'duration': duration_s}]},
+    }]}
+
+
+class QuoteTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        route_cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        self.rider = User.objects.create_user(username='rdr-quote', password='pass', trikego_user='R')
+        Rider.objects.create(user=self.rider)
+        self.client.force_login(self.rider)
+
+    def ors(self, **kwargs):
+        return mock.patch.object(transport.get_client(), 'directions', **kwargs)
+
+    def quote(self):
+        with self.ors(return_value=ors_route()):
+            response = self.client.post(reverse('booking:create_quote'), {
+                'pickup_latitude': PICKUP[1], 'pickup_longitude': PICKUP[0],
+                'destination_latitude': DESTINATION[1], 'destination_longitude': DESTINATION[0],
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def book(self, quote_id='', destination=DESTINATION):
+        return self.client.post(reverse('user:rider_dashboard'), {
+            'pickup_address': 'A', 'pickup_latitude': PICKUP[1], 'pickup_longitude': PICKUP[0],
+            'destination_address': 'B', 'destination_latitude': destination[1], 'destination_longitude': destination[0],
+            'passengers': 1, 'quote_id': quote_id,
+        })
+
+    def test_quote_is_priced_like_a_booking(self):
+        quote = self.quote()
+        expected = Booking(estimated_distance=Decimal('3.4'), estimated_duration=10).calculate_fare()
+        self.assertEqual(Decimal(quote['fare']), expected)
+        self.assertEqual(quote['duration_min'], 10)
+        self.assertTrue(quote['geometry'])
+        self.assertNotIn('rider_id', quote)
+
+    def test_booking_uses_the_quote_without_routing(self):
+        quote = self.quote()
+        with self.ors(side_effect=AssertionError('ORS call')):
+            self.book(quote['quote_id'])
+        booking = Booking.objects.get(rider=self.rider)
+        self.assertEqual(booking.fare, Decimal(quote['fare']))
+        self.assertEqual(booking.estimated_duration, 10)
+
+    def test_quote_route_serves_the_rider_preview(self):
+        quote = self.quote()
+        self.book(quote['quote_id'])
+        booking = Booking.objects.get(rider=self.rider)
+        with self.ors(side_effect=AssertionError('ORS call')):
+            info = self.client.get(reverse('user:get_route_info', args=[booking.id])).json()
+        self.assertEqual(info['route_payload']['distance'], 3.4)
+
+    def test_mismatched_quote_is_ignored_and_booking_priced_later(self):
+        quote = self.quote()
+        elsewhere = (123.9300, 10.3300)
+        with self.ors(side_effect=AssertionError('ORS call')):
+            with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+                self.book(quote['quote_id'], destination=elsewhere)
+        booking = Booking.objects.get(rider=self.rider)
+        self.assertIsNone(booking.fare)
+        self.assertEqual(enqueue.call_args.args[1:], (booking.id,))
+
+        # What the queued task does
+        with self.ors(return_value=ors_route(distance_m=5000, duration_s=900)):
+            self.assertTrue(estimate_booking_fare(booking.id))
+        booking.refresh_from_db()
+        self.assertEqual(booking.estimated_duration, 15)
+        self.assertEqual(booking.fare, Booking(estimated_distance=Decimal('5'), estimated_duration=15).calculate_fare())
+
+    def test_without_a_worker_the_dashboard_retries_from_the_route_cache(self):
+        elsewhere = (123.9300, 10.3300)
+        with self.ors(side_effect=AssertionError('ORS call')):
+            self.book(destination=elsewhere)
+            self.assertIsNone(Booking.objects.get(rider=self.rider).fare)
+
+            route_cache.set(PICKUP, elsewhere, {'route_data': None, 'distance': 5.0, 'duration': 900, 'too_close': False})
+            self.client.get(reverse('user:rider_dashboard'))
+        booking = Booking.objects.get(rider=self.rider)
+        self.assertEqual(booking.fare, Booking(estimated_distance=Decimal('5'), estimated_duration=15).calculate_fare())
+
+    def test_other_riders_cannot_use_a_quote(self):
+        quote = self.quote()
+        other = User.objects.create_user(username='rdr-quote-2', password='pass', trikego_user='R')
+        self.assertIsNone(quotes.get_quote(quote['quote_id'], other.id, PICKUP, DESTINATION))
+        self.assertIsNotNone(quotes.get_quote(quote['quote_id'], self.rider.id, PICKUP, DESTINATION))
+
+    def test_quote_requires_rider_and_coordinates(self):
+        response = self.client.post(reverse('booking:create_quote'), {'pickup_latitude': 'x'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        driver = User.objects.create_user(username='drv-quote', password='pass', trikego_user='D')
+        self.client.force_login(driver)
+        response = self.client.post(reverse('booking:create_quote'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,31 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from booking import tasks
+
+
+class ScheduleRerouteTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_pings_coalesce_into_one_task(self):
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            self.assertTrue(tasks.schedule_reroute(7, '10.3', '123.9'))
+            self.assertFalse(tasks.schedule_reroute(7, '10.31', '123.9'))
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(cache.get(tasks._reroute_latest_key(7))['latitude'], '10.31')
+
+    def test_no_worker_never_reroutes_inline(self):
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        with mock.patch('booking.tasks.check_and_reroute', side_effect=AssertionError('inline reroute')):
+            self.assertFalse(tasks.schedule_reroute(7, '10.3', '123.9'))
+            self.assertFalse(tasks.schedule_reroute(7, '10.31', '123.9'))
+
+        # Once the debounce window passes, the broker is tried again
+        cache.delete(tasks._reroute_scheduled_key(7))
+        cache.delete('celery_broker_unavailable')
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            self.assertTrue(tasks.schedule_reroute(7, '10.32', '123.9'))
+        enqueue.assert_called_once()
@@ -0,0 +1,101 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking.route_cache import RouteCache
+from booking.services import RoutingService
+
+
+class RouteCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.rc = RouteCache(maxsize=2, ttl=60, precision=4, prefix='test-routecache')
+        self.route = {'route_data': {'features': []}, 'distance': 1.2, 'duration': 300, 'too_close': False}
+
+    def test_quantized_endpoints_share_an_entry(self):
+        self.rc.set((120.98421, 14.59951), (120.99, 14.61), self.route)
+        # within the ~11m quantization cell -> same key
+        self.assertEqual(self.rc.get((120.98419, 14.59949), (120.99, 14.61)), self.route)
+        # different profile -> different key
+        self.assertIsNone(self.rc.get((120.98421, 14.59951), (120.99, 14.61), profile='foot-walking'))
+
+    def test_shared_tier_survives_local_eviction(self):
+        self.rc.set((1, 1), (2, 2), self.route)
+        self.rc.set((3, 3), (4, 4), self.route)
+        self.rc.set((5, 5), (6, 6), self.route)
+        self.assertEqual(self.rc.stats['evictions'], 1)
+        self.assertEqual(self.rc.get((1, 1), (2, 2)), self.route)
+        self.assertEqual(self.rc.stats['shared_hits'], 1)
+
+    def test_evict_removes_both_tiers(self):
+        self.rc.set((1, 1), (2, 2), self.route)
+        self.rc.evict((1, 1), (2, 2))
+        self.assertIsNone(self.rc.get((1, 1), (2, 2)))
+
+    def test_calculate_route_hits_ors_once_per_pair(self):
+        ors_route = {'features': [{'properties': {'segments': [{'distance': 2500.0, 'duration': 420.0}]}}]}
+        service = RoutingService()
+        with mock.patch('booking.services.route_cache', self.rc), \
+                mock.patch.object(service, 'client') as client:
+            client.directions.return_value = ors_route
+            first = service.calculate_route((120.9842, 14.5995), (121.0, 14.62))
+            second = service.calculate_route((120.9842, 14.5995), (121.0, 14.62))
+        self.assertEqual(client.directions.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first['distance'], 2.5)
+
+    def _multi_route(self, waypoints):
+        # One straight-ish geometry with a midpoint per leg, like ORS's way_points layout
+        coords, way_points, segments = [list(waypoints[0])], [0], []
+        for (lon1, lat1), (lon2, lat2) in zip(waypoints, waypoints[1:]):
+            coords += [[(lon1 + lon2) / 2, (lat1 + lat2) / 2], [lon2, lat2]]
+            way_points.append(len(coords) - 1)
+            segments.append({'distance': 1000.0, 'duration': 120.0})
+        return {'features': [{
+            'geometry': {'coordinates': coords},
+            'properties': {'way_points': way_points, 'segments': segments},
+        }]}
+
+    def test_route_legs_use_one_request_and_reuse_cached_legs(self):
+        stops = [(123.90, 10.30), (123.91, 10.31), (123.92, 10.30), (123.93, 10.32)]
+        service = RoutingService()
+        with mock.patch('booking.services.leg_cache', self.rc), \
+                mock.patch.object(service, 'client') as client:
+            self.rc.maxsize = 16
+            client.directions.side_effect = lambda coordinates, **kwargs: self._multi_route(coordinates)
+            legs = service.calculate_route_legs([(123.89, 10.29)] + stops)
+            self.assertEqual(client.directions.call_count, 1)
+            self.assertEqual(len(legs), 4)
+            self.assertTrue(all(leg['precise'] and len(leg['points']) == 3 for leg in legs))
+            self.assertEqual(legs[1]['points'][0], [10.30, 123.90])
+
+            # Driver moved: only the first leg is requested again
+            moved = service.calculate_route_legs([(123.885, 10.285)] + stops)
+        self.assertEqual(client.directions.call_count, 2)
+        self.assertEqual(len(client.directions.call_args.kwargs['coordinates']), 2)
+        self.assertEqual(moved[1:], legs[1:])
+
+    def test_matrix_requests_only_missing_cells(self):
+        def fake_matrix(locations, sources, destinations, **kwargs):
+            rows = [[float(s + d) for d in destinations] for s in sources]
+            return {'distances': rows, 'durations': [[v * 60 for v in row] for row in rows]}
+
+        points = [(123.90, 10.30), (123.91, 10.31), (123.92, 10.32)]
+        service = RoutingService()
+        self.rc.maxsize = 64
+        with mock.patch('booking.services.matrix_cache', self.rc), \
+                mock.patch.object(service, 'client') as client:
+            client.distance_matrix.side_effect = fake_matrix
+            first = service.calculate_matrix(points)
+            self.assertEqual(first['distances'].shape, (3, 3))
+            self.assertEqual(first['distances'][1, 1], 0.0)
+
+            # A new origin against the same stops: one request for that row only
+            second = service.calculate_matrix([(123.95, 10.35)], points)
+            self.assertEqual(client.distance_matrix.call_count, 2)
+            self.assertEqual(client.distance_matrix.call_args.kwargs['sources'], [0])
+            again = service.calculate_matrix(points)
+        self.assertEqual(client.distance_matrix.call_count, 2)
+        self.assertTrue((again['durations'] == first['durations']).all())
+        self.assertEqual(second['durations'].shape, (1, 3))
@@ -0,0 +1,99 @@
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from booking import polyline, route_retention
+from booking.models import Booking, RouteSnapshot
+
+User = get_user_model()
+
+
+def _route(start, end, n=50):
+    """GeoJSON-ish route_data for a straight line between two (lat, lon) points."""
+    coords = [[start[1] + (end[1] - start[1]) * i / (n - 1), start[0] + (end[0] - start[0]) * i / (n - 1)]
+              for i in range(n)]
+    step = {'instruction': 'Continue', 'distance': 1000.0, 'duration': 120.0, 'way_points': [0, n - 1]}
+    return {'features': [{'geometry': {'coordinates': coords},
+                          'properties': {'segments': [{'steps': [step]}]}}]}
+
+
+class RouteRetentionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        self.rider = User.objects.create_user(username='rdr-retain', password='pass', trikego_user='R')
+
+    def _booking(self, status):
+        return Booking.objects.create(
+            rider=self.rider, status=status,
+            pickup_address='A', pickup_latitude=10.30, pickup_longitude=123.90,
+            destination_address='B', destination_latitude=10.33, destination_longitude=123.93,
+        )
+
+    def _snapshot(self, booking, start, end, **kwargs):
+        compact = polyline.compact_route(_route(start, end))
+        RouteSnapshot.objects.filter(booking=booking, is_active=True).update(is_active=False)
+        return RouteSnapshot.objects.create(booking=booking, geometry=compact['geometry'], steps=compact['steps'],
+                                            distance=1, duration=600, **kwargs)
+
+    def test_finished_trip_is_compacted_to_driven_path(self):
+        booking = self._booking('completed')
+        # Driver drifted off twice; each reroute starts part-way along the previous route
+        self._snapshot(booking, (10.30, 123.90), (10.33, 123.93))
+        self._snapshot(booking, (10.31, 123.911), (10.33, 123.93))
+        self._snapshot(booking, (10.32, 123.921), (10.33, 123.93))
+        legacy = RouteSnapshot.objects.create(booking=booking, route_data=_route((10.325, 123.926), (10.33, 123.93)),
+                                              distance=1, duration=60, is_active=False)
+
+        report = route_retention.prune()
+
+        snapshots = list(RouteSnapshot.objects.filter(booking=booking))
+        self.assertEqual(len(snapshots), 1)
+        compacted = snapshots[0]
+        self.assertEqual(compacted.pk, legacy.pk)
+        self.assertIsNone(compacted.steps)
+        self.assertIsNone(compacted.route_data)
+        self.assertTrue(compacted.is_active)
+        # The straight driven path simplifies to a handful of vertices from start to end
+        self.assertEqual(compacted.coordinates[0], (10.30, 123.90))
+        self.assertEqual(compacted.coordinates[-1], (10.33, 123.93))
+        self.assertLess(len(compacted.coordinates), 10)
+        self.assertAlmostEqual(float(compacted.distance), 4.75, delta=0.15)
+        self.assertEqual(report['deleted'], 3)
+        self.assertEqual((report['bookings'], report['rewritten']), (1, 1))
+        self.assertGreater(report['bytes_reclaimed'], 0)
+        self.assertEqual(route_retention.last_report()['deleted'], 3)
+
+        # Already compact: nothing left to do
+        self.assertEqual(route_retention.prune()['bookings'], 0)
+
+    def test_live_history_is_downsampled_and_aged(self):
+        booking = self._booking('started')
+        history = [self._snapshot(booking, (10.30 + i * 0.001, 123.90), (10.33, 123.93)) for i in range(12)]
+        RouteSnapshot.objects.filter(pk=history[0].pk).update(created_at=timezone.now() - timedelta(days=3))
+
+        route_retention.prune()
+
+        remaining = list(RouteSnapshot.objects.filter(booking=booking).order_by('created_at', 'id'))
+        active = [s for s in remaining if s.is_active]
+        kept = [s for s in remaining if not s.is_active]
+        self.assertEqual([s.pk for s in active], [history[-1].pk])
+        self.assertEqual(len(kept), route_retention.ROUTE_HISTORY_KEEP)
+        self.assertEqual(kept[0].pk, history[1].pk)   # the expired one is gone, the next oldest stays
+        self.assertEqual(kept[-1].pk, history[-2].pk)
+        self.assertTrue(all(s.steps is None for s in kept))
+        self.assertIsNotNone(active[0].steps)
+
+    def test_dry_run_changes_nothing(self):
+        booking = self._booking('cancelled_by_rider')
+        self._snapshot(booking, (10.30, 123.90), (10.33, 123.93))
+        self._snapshot(booking, (10.31, 123.911), (10.33, 123.93))
+
+        report = route_retention.prune(dry_run=True)
+
+        self.assertEqual(report['deleted'], 1)
+        self.assertEqual(RouteSnapshot.objects.filter(booking=booking).count(), 2)
+        self.assertIsNone(route_retention.last_report())
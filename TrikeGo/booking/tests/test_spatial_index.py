@@ -0,0 +1,85 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking.models import Booking, DriverLocation
+from booking.spatial_index import GridIndex, SpatialRegistry, registry, pending_bookings_near_driver, drivers_near_pickup
+from booking.utils import calculate_distance
+from user.models import Driver
+
+User = get_user_model()
+
+
+class GridIndexTest(TestCase):
+    def test_query_radius_matches_brute_force(self):
+        rng = random.Random(7)
+        index = GridIndex(cell_deg=0.01)
+        points = {}
+        for i in range(500):
+            lat = 10.25 + rng.uniform(-0.1, 0.1)
+            lon = 123.85 + rng.uniform(-0.1, 0.1)
+            points[i] = (lat, lon)
+            index.upsert(i, lat, lon)
+
+        center = (10.25, 123.85)
+        expected = sorted(
+            i for i, (lat, lon) in points.items()
+            if calculate_distance(center[0], center[1], lat, lon) <= 3.0
+        )
+        found = index.query_radius(center[0], center[1], 3.0)
+        self.assertEqual(sorted(i for i, _ in found), expected)
+        distances = [d for _, d in found]
+        self.assertEqual(distances, sorted(distances))
+
+    def test_upsert_moves_point_between_cells(self):
+        index = GridIndex(cell_deg=0.01)
+        index.upsert('a', 10.0, 123.0)
+        index.upsert('a', 10.5, 123.5)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.query_radius(10.0, 123.0, 1.0), [])
+        self.assertEqual([i for i, _ in index.query_radius(10.5, 123.5, 1.0)], ['a'])
+        index.remove('a')
+        self.assertEqual(len(index), 0)
+
+
+class SpatialRegistryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.driver = User.objects.create_user(username='drv-spatial', password='pass', trikego_user='D')
+        Driver.objects.create(user=self.driver, license_number='12345678901', license_expiry='2099-01-01',
+                              date_hired='2020-01-01', years_of_service=1, status='Online')
+        self.rider = User.objects.create_user(username='rdr-spatial', password='pass', trikego_user='R')
+        registry.rebuild()
+
+    def _booking(self, lat, lon, **kwargs):
+        return Booking.objects.create(rider=self.rider, pickup_address='A', destination_address='B',
+                                      pickup_latitude=lat, pickup_longitude=lon, **kwargs)
+
+    def test_pending_bookings_near_driver(self):
+        DriverLocation.objects.create(driver=self.driver, latitude=10.3000, longitude=123.9000)
+        near = self._booking(10.3050, 123.9000)
+        far = self._booking(10.5000, 123.9000)
+        taken = self._booking(10.3010, 123.9000)
+        taken.driver = self.driver
+        taken.status = 'accepted'
+        taken.save()
+
+        ids = pending_bookings_near_driver(self.driver, 2.0)
+        self.assertEqual(ids, [near.id])
+        self.assertNotIn(far.id, ids)
+
+    def test_removal_elsewhere_moves_the_shared_version(self):
+        version = cache.get(SpatialRegistry.VERSION_KEY)
+        # This worker never indexed the booking, another one did
+        SpatialRegistry().remove_pickup(12345)
+        self.assertNotEqual(cache.get(SpatialRegistry.VERSION_KEY), version)
+
+    def test_unknown_driver_position_returns_none(self):
+        self.assertIsNone(pending_bookings_near_driver(self.driver, 2.0))
+
+    def test_drivers_near_pickup(self):
+        DriverLocation.objects.create(driver=self.driver, latitude=10.3000, longitude=123.9000)
+        self.assertEqual([d for d, _ in drivers_near_pickup(10.3020, 123.9000, 1.0)], [self.driver.id])
+        self.assertEqual(drivers_near_pickup(10.4000, 123.9000, 1.0), [])
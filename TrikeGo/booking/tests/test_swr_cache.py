@@ -0,0 +1,88 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from booking import swr_cache
+
+
+class SwrCacheTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.builds = 0
+        self.refreshes = 0
+
+    def build(self):
+        self.builds += 1
+        return {'n': self.builds}
+
+    def refresh(self):
+        self.refreshes += 1
+        return True
+
+    def get(self, **kwargs):
+        return swr_cache.get_or_build('k', self.build, ttl=10, refresh=self.refresh, **kwargs)
+
+    def expire(self):
+        entry = cache.get('k')
+        entry['fresh_until'] = 0
+        cache.set('k', entry)
+
+    def test_fresh_entries_are_served(self):
+        self.assertEqual(self.get(), {'n': 1})
+        self.assertEqual(self.get(), {'n': 1})
+        self.assertEqual((self.builds, self.refreshes), (1, 0))
+
+    def test_stale_entry_is_served_while_one_refresh_runs(self):
+        self.get()
+        self.expire()
+        for _ in range(5):
+            self.assertEqual(self.get(), {'n': 1})
+        self.assertEqual((self.builds, self.refreshes), (1, 1))
+
+        # The refresh lands
+        swr_cache.store('k', {'n': 'fresh'}, ttl=10)
+        self.assertEqual(self.get(), {'n': 'fresh'})
+
+    def test_stale_entry_rebuilt_inline_without_a_worker(self):
+        self.get()
+        self.expire()
+        self.assertEqual(swr_cache.get_or_build('k', self.build, ttl=10, refresh=lambda: False), {'n': 2})
+        self.assertEqual(self.get(), {'n': 2})
+
+    def test_previous_version_is_served_stale_across_a_version_bump(self):
+        swr_cache.get_or_build('k:v1', self.build, ttl=10, refresh=self.refresh, stale_key='k:latest')
+        for _ in range(3):
+            self.assertEqual(swr_cache.get_or_build('k:v2', self.build, ttl=10, refresh=self.refresh,
+                                                    stale_key='k:latest'), {'n': 1})
+        self.assertEqual((self.builds, self.refreshes), (1, 1))
+
+        swr_cache.store('k:v2', {'n': 'v2'}, ttl=10, stale_key='k:latest')
+        self.assertEqual(cache.get('k:latest')['payload'], {'n': 'v2'})
+
+    def test_cold_miss_waits_for_the_builder(self):
+        cache.add(swr_cache.lock_key('k'), 1, timeout=30)
+
+        def builder_lands(_seconds):
+            cache.set('k', {'payload': {'n': 'other'}, 'fresh_until': float('inf')})
+
+        with mock.patch('booking.swr_cache.time.sleep', side_effect=builder_lands):
+            self.assertEqual(self.get(), {'n': 'other'})
+        self.assertEqual(self.builds, 0)
+
+    def test_cold_miss_builds_when_the_builder_never_lands(self):
+        cache.add(swr_cache.lock_key('k'), 1, timeout=30)
+        with mock.patch.object(swr_cache, 'SWR_WAIT_SECONDS', 0.01):
+            self.assertEqual(self.get(), {'n': 1})
+        # Not stored: the lock holder's result is the one that counts
+        self.assertIsNone(cache.get('k'))
+
+    def test_outdated_builds_are_not_stored(self):
+        self.assertEqual(self.get(is_current=lambda: False), {'n': 1})
+        self.assertIsNone(cache.get('k'))
+        self.assertEqual(self.get(), {'n': 2})
+
+    def test_failed_build_releases_the_lock(self):
+        with self.assertRaises(ValueError):
+            swr_cache.get_or_build('k', mock.Mock(side_effect=ValueError), ttl=10)
+        self.assertIsNone(cache.get(swr_cache.lock_key('k')))
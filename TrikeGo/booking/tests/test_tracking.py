@@ -0,0 +1,184 @@
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.routing import URLRouter
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from booking import location_buffer, routing, tracking, tracking_protocol
+from booking.models import Booking
+
+User = get_user_model()
+
+
+class Socket(ApplicationCommunicator):
+    """Minimal websocket client for a consumer (channels.testing needs daphne)."""
+
+    def __init__(self, path, user):
+        path, _, query = path.partition('?')
+        scope = {'type': 'websocket', 'path': path, 'query_string': query.encode(),
+                 'headers': [], 'subprotocols': [], 'user': user}
+        super().__init__(URLRouter(routing.websocket_urlpatterns), scope)
+
+    async def connect(self):
+        await self.send_input({'type': 'websocket.connect'})
+        response = await self.receive_output(1)
+        return response['type'] == 'websocket.accept'
+
+    async def receive_json(self):
+        response = await self.receive_output(1)
+        return tracking_protocol.decode(response['text'] if response.get('text') is not None else response['bytes'])
+
+    async def disconnect(self):
+        await self.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await self.wait(1)
+
+
+class TrackingConsumerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        location_buffer._dirty = None
+        cache.add(location_buffer.FLUSH_LOCK_KEY, 1, timeout=60)
+        self.driver = User.objects.create_user(username='drv-track', password='pass', trikego_user='D')
+        self.rider = User.objects.create_user(username='rdr-track', password='pass', trikego_user='R')
+        self.stranger = User.objects.create_user(username='rdr-other', password='pass', trikego_user='R')
+        self.booking = Booking.objects.create(
+            rider=self.rider, status='pending',
+            pickup_address='A', pickup_latitude=10.30, pickup_longitude=123.90,
+            destination_address='B', destination_latitude=10.32, destination_longitude=123.92,
+        )
+
+    async def _connect(self, path, user):
+        socket = Socket(path, user)
+        return socket, await socket.connect()
+
+    async def test_rider_follows_driver_once_assigned(self):
+        rider, connected = await self._connect(f'/ws/tracking/booking/{self.booking.id}/', self.rider)
+        self.assertTrue(connected)
+        keyframe = await rider.receive_json()
+        self.assertEqual(keyframe, {'t': 'k', 's': 1, 'b': self.booking.id, 'st': 'pending', 'dr': None})
+
+        # Not following anyone yet: driver fixes don't reach the rider
+        await sync_to_async(location_buffer.record_fix)(self.driver.id, 10.301, 123.901)
+        self.assertTrue(await rider.receive_nothing(0.2))
+
+        self.booking.status = 'accepted'
+        self.booking.driver = self.driver
+        await sync_to_async(tracking.publish_status)(self.booking)
+        self.assertEqual(await rider.receive_json(), {'t': 'd', 's': 2, 'st': 'accepted', 'dr': self.driver.id})
+
+        await sync_to_async(location_buffer.record_fix)(self.driver.id, 10.302, 123.902, heading=45)
+        self.assertEqual(await rider.receive_json(), {'t': 'd', 's': 3, 'p': [1030200, 12390200], 'h': 45})
+        await sync_to_async(location_buffer.record_fix)(self.driver.id, 10.30205, 123.90199, heading=45)
+        self.assertEqual(await rider.receive_json(), {'t': 'd', 's': 4, 'p': [5, -1]})
+
+        await sync_to_async(tracking.publish_eta)(self.booking.id, 1.8, 300)
+        self.assertEqual(await rider.receive_json(), {'t': 'd', 's': 5, 'e': 300, 'm': 1800})
+
+        # A client that lost track asks for a keyframe
+        await rider.send_input({'type': 'websocket.receive', 'text': '{"t":"r"}'})
+        keyframe = await rider.receive_json()
+        self.assertEqual((keyframe['t'], keyframe['s'], keyframe['p'], keyframe['e']), ('k', 6, [1030205, 12390199], 300))
+        await rider.disconnect()
+
+    async def test_driver_channel_gets_itinerary_versions(self):
+        driver, connected = await self._connect('/ws/tracking/driver/?format=msgpack', self.driver)
+        self.assertTrue(connected)
+        keyframe = await driver.receive_json()
+        self.assertEqual(keyframe['t'], 'k')
+        self.assertIn('i', keyframe)
+
+        await sync_to_async(tracking.publish_itinerary_version)(self.driver.id, 7, {'a1': 'PENDING', 'b2': 'PENDING'})
+        self.assertEqual(await driver.receive_json(), {'t': 'd', 's': 2, 'i': 7, 'x': {'a1': 'PENDING', 'b2': 'PENDING'}})
+        await sync_to_async(tracking.publish_itinerary_version)(self.driver.id, 8, {'a1': 'COMPLETED', 'b2': 'PENDING'})
+        self.assertEqual(await driver.receive_json(), {'t': 'd', 's': 3, 'i': 8, 'x': {'a1': 'COMPLETED'}})
+        await driver.disconnect()
+
+    async def test_riders_never_see_the_shared_itinerary(self):
+        self.booking.status = 'accepted'
+        self.booking.driver = self.driver
+        await sync_to_async(self.booking.save)()
+        rider, connected = await self._connect(f'/ws/tracking/booking/{self.booking.id}/', self.rider)
+        self.assertTrue(connected)
+        keyframe = await rider.receive_json()
+        self.assertNotIn('i', keyframe)
+
+        await sync_to_async(tracking.publish_itinerary_version)(self.driver.id, 7, {'a1': 'PENDING', 'b2': 'PENDING'})
+        self.assertTrue(await rider.receive_nothing(0.2))
+        # Still following the driver's position
+        await sync_to_async(location_buffer.record_fix)(self.driver.id, 10.302, 123.902)
+        frame = await rider.receive_json()
+        self.assertIn('p', frame)
+        self.assertNotIn('x', frame)
+        await rider.disconnect()
+
+    async def test_only_participants_can_subscribe(self):
+        _, connected = await self._connect(f'/ws/tracking/booking/{self.booking.id}/', self.stranger)
+        self.assertFalse(connected)
+        _, connected = await self._connect('/ws/tracking/driver/', self.rider)
+        self.assertFalse(connected)
+
+    def test_status_changes_are_published_on_commit(self):
+        with mock.patch('booking.signals.tracking.publish_status') as publish:
+            booking = Booking.objects.get(pk=self.booking.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                booking.fare = 50
+                booking.save()
+            publish.assert_not_called()
+            with self.captureOnCommitCallbacks(execute=True):
+                booking.status = 'accepted'
+                booking.driver = self.driver
+                booking.save()
+        publish.assert_called_once_with(booking)
+
+
+class TrackingProtocolTest(SimpleTestCase):
+    def test_decoder_follows_deltas(self):
+        stream = tracking_protocol.TrackingStream(keyframe_interval=100)
+        decoder = tracking_protocol.TrackingDecoder()
+        stream.apply('status', {'booking_id': 5, 'status': 'started', 'driver_id': 9})
+        decoder.feed(stream.keyframe())
+        lat, lon = 10.30000, 123.90000
+        for i in range(40):
+            lat += 0.00003
+            lon -= 0.00002
+            frame = stream.push('location', {'lat': lat, 'lon': lon, 'heading': 90})
+            if i:  # after the first fix, only the position offset travels
+                self.assertLessEqual(len(tracking_protocol.encode(frame)), 30)
+            self.assertTrue(decoder.feed(frame))
+        self.assertAlmostEqual(decoder.position[0], lat, places=5)
+        self.assertAlmostEqual(decoder.position[1], lon, places=5)
+        self.assertEqual(decoder.state['st'], 'started')
+        # Unchanged state produces no frame at all
+        self.assertIsNone(stream.push('location', {'lat': lat, 'lon': lon, 'heading': 90}))
+
+    def test_gap_requires_resync(self):
+        stream = tracking_protocol.TrackingStream()
+        decoder = tracking_protocol.TrackingDecoder()
+        stream.apply('itinerary', {'version': 1})
+        decoder.feed(stream.keyframe())
+        stream.push('itinerary', {'version': 2})  # lost in transit
+        self.assertFalse(decoder.feed(stream.push('itinerary', {'version': 3})))
+        self.assertFalse(decoder.feed(stream.push('eta', {'duration': 60})))
+        self.assertTrue(decoder.feed(stream.keyframe()))
+        self.assertEqual((decoder.state['i'], decoder.state['e']), (3, 60))
+
+    def test_periodic_and_forced_keyframes(self):
+        stream = tracking_protocol.TrackingStream(keyframe_interval=3)
+        stream.keyframe()
+        kinds = [stream.push('eta', {'duration': d})['t'] for d in range(1, 7)]
+        self.assertEqual(kinds, ['d', 'd', 'k', 'd', 'd', 'k'])
+
+        stream.push('location', {'lat': 10.3, 'lon': 123.9})
+        stream.forget('p')
+        self.assertEqual(stream.push('eta', {'duration': 99}), {'t': 'k', 's': stream.seq, 'e': 99})
+
+    def test_msgpack_framing_is_smaller(self):
+        frame = {'t': 'd', 's': 812, 'p': [3, -2]}
+        binary = tracking_protocol.encode(frame, binary=True)
+        self.assertIsInstance(binary, bytes)
+        self.assertLess(len(binary), len(tracking_protocol.encode(frame)))
+        self.assertEqual(tracking_protocol.decode(binary), frame)
@@ -1,7 +1,11 @@
+from unittest import mock
+
+import numpy as np
 from django.test import TestCase
 from django.contrib.auth import get_user_model
-from booking.utils import seats_available, pickup_within_detour
-from booking.models import Booking
+from booking import geometry
+from booking.utils import seats_available, pickup_within_detour, plan_driver_stops, ensure_booking_stops
+from booking.models import Booking, DriverLocation
 from user.models import Driver, Tricycle
 
 User = get_user_model()
@@ -24,17 +28,51 @@ class UtilsTestCase(TestCase):
         # cannot accept 2 more
         self.assertFalse(seats_available(self.user, additional_seats=2))
 
-    def test_pickup_within_detour(self):
+    @mock.patch('booking.services.RoutingService.calculate_matrix', return_value=None)
+    def test_pickup_within_detour(self, matrix):
         # Set driver current location
-        self.driver_profile.current_latitude = 14.5995
-        self.driver_profile.current_longitude = 120.9842
-        self.driver_profile.save()
+        DriverLocation.objects.create(driver=self.user, latitude=14.5995, longitude=120.9842)
         # pickup within ~300m
         ok = pickup_within_detour(self.user, 14.6020, 120.9842, max_km=0.5)
         self.assertTrue(ok)
         # pickup far > 0.5km
         far = pickup_within_detour(self.user, 14.6200, 120.9842, max_km=0.5)
         self.assertFalse(far)
+        # Only the nearby pickup was worth a road distance lookup
+        self.assertEqual(matrix.call_count, 1)
+
+    def test_detour_uses_road_distance(self):
+        DriverLocation.objects.create(driver=self.user, latitude=14.5995, longitude=120.9842)
+        # ~300m in a straight line, but 900m by road (e.g. across a river)
+        road = {'distances': np.array([[0.9]]), 'durations': np.array([[180.0]])}
+        with mock.patch('booking.services.RoutingService.calculate_matrix', return_value=road):
+            self.assertFalse(pickup_within_detour(self.user, 14.6020, 120.9842, max_km=0.5))
+
+    def test_plan_uses_road_durations(self):
+        DriverLocation.objects.create(driver=self.user, latitude=10.3000, longitude=123.9000)
+        near = self._accepted_booking(10.3010, 10.3100)
+        far = self._accepted_booking(10.3020, 10.3110)
+
+        def road_matrix(points, destinations=None, profile='driving-car'):
+            durations = geometry.pairwise_matrix_m([(lat, lon) for lon, lat in points]) / 5.0
+            # No direct road from the driver to the nearest pickup
+            durations[0, [i for i, (lon, lat) in enumerate(points) if lat == 10.3010]] = 10000
+            return {'distances': durations / 1000, 'durations': durations}
+
+        with mock.patch('booking.utils.ROAD_AWARE_PLANNING', False):
+            first = plan_driver_stops(self.user)[0]
+        self.assertEqual((first.booking_id, first.stop_type), (near.id, 'PICKUP'))
+        with mock.patch('booking.services.RoutingService.calculate_matrix', side_effect=road_matrix):
+            first = plan_driver_stops(self.user)[0]
+        self.assertEqual((first.booking_id, first.stop_type), (far.id, 'PICKUP'))
+
+    def _accepted_booking(self, pickup_lat, dropoff_lat):
+        booking = Booking.objects.create(rider=self._create_rider(), driver=self.user, status='accepted',
+                                         pickup_address='A', pickup_latitude=pickup_lat, pickup_longitude=123.9,
+                                         destination_address='B', destination_latitude=dropoff_lat,
+                                         destination_longitude=123.9)
+        ensure_booking_stops(booking)
+        return booking
 
     def _create_rider(self):
         r = User.objects.create_user(username='r1'+self._rand(), password='p', trikego_user='R')
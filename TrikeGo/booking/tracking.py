@@ -0,0 +1,84 @@
+"""
+Server push for live trip tracking.
+
+Events are published to Channels groups and forwarded to browsers by
+``booking.consumers.TrackingConsumer``:
+
+* ``tracking_driver_<driver id>`` - driver location fixes. The driver joins
+  it, and so do riders while the driver is assigned to their booking;
+* ``tracking_itinerary_<driver id>`` - itinerary versions and stop statuses,
+  joined only by the driver's own socket: the stops belong to every
+  passenger on the trip, so riders never see them;
+* ``tracking_booking_<booking id>`` - status changes and ETA updates for one
+  booking, joined by its rider and driver.
+
+Publishing never raises: without a channel layer (or with Redis down) the
+event is dropped and clients keep their polling fallback.
+"""
+from typing import Dict, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+ACTIVE_STATUSES = ['accepted', 'on_the_way', 'started']
+
+
+def driver_group(driver_id) -> str:
+    return f'tracking_driver_{driver_id}'
+
+
+def itinerary_group(driver_id) -> str:
+    return f'tracking_itinerary_{driver_id}'
+
+
+def booking_group(booking_id) -> str:
+    return f'tracking_booking_{booking_id}'
+
+
+def publish(group: str, event: str, data: Dict[str, object]) -> bool:
+    """Send one tracking event to a group; returns False when it couldn't be delivered to the layer."""
+    layer = get_channel_layer()
+    if layer is None:
+        return False
+    try:
+        async_to_sync(layer.group_send)(group, {'type': 'tracking.event', 'event': event, 'data': data})
+        return True
+    except Exception as e:
+        print(f"Tracking publish to {group} failed: {e}")
+        return False
+
+
+def publish_location(driver_id, latitude, longitude, heading=None, speed=None, timestamp: Optional[str] = None) -> bool:
+    return publish(driver_group(driver_id), 'location', {
+        'driver_id': driver_id,
+        'lat': float(latitude),
+        'lon': float(longitude),
+        'heading': None if heading is None else float(heading),
+        'speed': None if speed is None else float(speed),
+        'timestamp': timestamp,
+    })
+
+
+def publish_status(booking) -> bool:
+    return publish(booking_group(booking.id), 'status', {
+        'booking_id': booking.id,
+        'status': booking.status,
+        'driver_id': booking.driver_id,
+    })
+
+
+def publish_eta(booking_id, distance_km, duration_s) -> bool:
+    return publish(booking_group(booking_id), 'eta', {
+        'booking_id': booking_id,
+        'distance': None if distance_km is None else float(distance_km),
+        'duration': None if duration_s is None else int(duration_s),
+    })
+
+
+def publish_itinerary_version(driver_id, version, stops: Optional[Dict[str, str]] = None) -> bool:
+    """``stops`` maps stop id to status, so clients see stop progress without refetching."""
+    return publish(itinerary_group(driver_id), 'itinerary', {
+        'driver_id': driver_id,
+        'version': int(version),
+        'stops': stops,
+    })
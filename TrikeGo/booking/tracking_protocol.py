@@ -0,0 +1,193 @@
+"""
+Compact wire format for the tracking socket.
+
+A connection receives one keyframe with the full tracking state, then deltas
+holding only what changed. Every frame carries a sequence number ``s``; a
+client that sees a gap (or reconnects) sends ``{"t": "r"}`` and gets a fresh
+keyframe. The server also sends a keyframe every KEYFRAME_INTERVAL frames so
+a client that silently lost a delta converges anyway.
+
+Frame fields (absent fields are unchanged):
+
+====  =====================================================================
+t     ``k`` keyframe, ``d`` delta
+s     sequence number, per connection
+b     booking id
+st    booking status
+dr    assigned driver id (null when unassigned)
+p     driver position in 1e-5 degrees: absolute ``[lat, lon]`` in keyframes,
+      the change since the previous frame in deltas
+h     heading, whole degrees
+v     speed, one decimal
+e     ETA in seconds
+m     remaining route distance in meters
+i     itinerary version
+x     stop statuses ``{stop id: status}``; deltas only list changed stops
+====  =====================================================================
+
+Frames are JSON text by default, or msgpack binary when the client connects
+with ``?format=msgpack`` and the ``msgpack`` package is installed.
+
+A driver position change is a ~25 byte JSON delta (~15 bytes in msgpack)
+instead of a full route_info payload.
+"""
+import json
+import os
+from typing import Dict, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # optional: binary framing is unavailable, JSON still works
+    msgpack = None
+
+KEYFRAME_INTERVAL = int(os.environ.get('TRACKING_KEYFRAME_INTERVAL', 50))
+POSITION_SCALE = 100000
+
+KEYFRAME = 'k'
+DELTA = 'd'
+RESYNC = 'r'
+
+
+def _position(lat, lon):
+    return [int(round(float(lat) * POSITION_SCALE)), int(round(float(lon) * POSITION_SCALE))]
+
+
+class TrackingStream:
+    """Per-connection encoder turning tracking events into keyframes and deltas."""
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.state: Dict[str, object] = {}
+        self.sent: Dict[str, object] = {}
+        self.seq = 0
+        self.since_keyframe = 0
+        self.force_keyframe = False
+
+    def apply(self, event: str, data: Dict[str, object]) -> None:
+        """Fold one booking.tracking event into the current state."""
+        state = self.state
+        if event == 'location':
+            if data.get('lat') is not None and data.get('lon') is not None:
+                state['p'] = _position(data['lat'], data['lon'])
+            if data.get('heading') is not None:
+                state['h'] = int(round(float(data['heading']))) % 360
+            if data.get('speed') is not None:
+                state['v'] = round(float(data['speed']), 1)
+        elif event == 'status':
+            if data.get('booking_id') is not None:
+                state['b'] = data['booking_id']
+            state['st'] = data.get('status')
+            state['dr'] = data.get('driver_id')
+        elif event == 'eta':
+            if data.get('duration') is not None:
+                state['e'] = int(data['duration'])
+            if data.get('distance') is not None:
+                state['m'] = int(round(float(data['distance']) * 1000))
+        elif event == 'itinerary':
+            if data.get('version') is not None:
+                state['i'] = int(data['version'])
+            if data.get('stops') is not None:
+                state['x'] = {str(k): v for k, v in data['stops'].items()}
+
+    def forget(self, *keys: str) -> None:
+        """Drop fields (e.g. a driver no longer followed); the next frame is a keyframe."""
+        for key in keys:
+            if self.state.pop(key, None) is not None:
+                self.force_keyframe = True
+
+    def keyframe(self) -> Dict[str, object]:
+        self.seq += 1
+        self.since_keyframe = 0
+        self.force_keyframe = False
+        frame = {'t': KEYFRAME, 's': self.seq}
+        frame.update(self.state)
+        self.sent = {k: (dict(v) if isinstance(v, dict) else v) for k, v in self.state.items()}
+        return frame
+
+    def delta(self) -> Optional[Dict[str, object]]:
+        """Changes since the last frame sent, or None when there are none."""
+        changes = {}
+        for key, value in self.state.items():
+            previous = self.sent.get(key)
+            if value == previous:
+                continue
+            if key == 'p' and previous is not None:
+                changes[key] = [value[0] - previous[0], value[1] - previous[1]]
+            elif key == 'x' and isinstance(previous, dict):
+                changes[key] = {k: v for k, v in value.items() if previous.get(k) != v}
+            else:
+                changes[key] = value
+        if self.force_keyframe:
+            return self.keyframe()
+        if not changes:
+            return None
+        if 'x' in self.sent and 'x' in self.state and set(self.sent['x']) - set(self.state['x']):
+            # A stop disappeared; deltas can't express removals
+            return self.keyframe()
+        if self.since_keyframe + 1 >= self.keyframe_interval:
+            return self.keyframe()
+        self.seq += 1
+        self.since_keyframe += 1
+        self.sent = {k: (dict(v) if isinstance(v, dict) else v) for k, v in self.state.items()}
+        frame = {'t': DELTA, 's': self.seq}
+        frame.update(changes)
+        return frame
+
+    def push(self, event: str, data: Dict[str, object]) -> Optional[Dict[str, object]]:
+        """Apply an event and return the frame to send, if anything changed."""
+        self.apply(event, data)
+        return self.delta()
+
+
+class TrackingDecoder:
+    """Reference client: rebuilds the state from frames and detects gaps."""
+
+    def __init__(self):
+        self.state: Dict[str, object] = {}
+        self.seq: Optional[int] = None
+        self.needs_resync = True
+
+    def feed(self, frame: Dict[str, object]) -> bool:
+        """Apply a frame; returns False when a resync is needed."""
+        if frame.get('t') == KEYFRAME:
+            self.state = {k: v for k, v in frame.items() if k not in ('t', 's')}
+            self.seq = frame['s']
+            self.needs_resync = False
+            return True
+        if self.needs_resync or self.seq is None or frame.get('s') != self.seq + 1:
+            self.needs_resync = True
+            return False
+        self.seq = frame['s']
+        for key, value in frame.items():
+            if key in ('t', 's'):
+                continue
+            if key == 'p' and self.state.get('p') is not None:
+                self.state['p'] = [self.state['p'][0] + value[0], self.state['p'][1] + value[1]]
+            elif key == 'x' and isinstance(self.state.get('x'), dict):
+                self.state['x'] = dict(self.state['x'], **value)
+            else:
+                self.state[key] = value
+        return True
+
+    @property
+    def position(self):
+        p = self.state.get('p')
+        return None if p is None else (p[0] / POSITION_SCALE, p[1] / POSITION_SCALE)
+
+
+def binary_available() -> bool:
+    return msgpack is not None
+
+
+def encode(frame: Dict[str, object], binary: bool = False) -> Union[str, bytes]:
+    if binary and msgpack is not None:
+        return msgpack.packb(frame, use_bin_type=True)
+    return json.dumps(frame, separators=(',', ':'))
+
+
+def decode(message: Union[str, bytes]) -> Dict[str, object]:
+    if isinstance(message, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return msgpack.unpackb(message, raw=False)
+    return json.loads(message)
@@ -0,0 +1,111 @@
+"""
+Process-wide pooled HTTP transport for OpenRouteService calls.
+
+Every RoutingService instance shares one requests.Session (keep-alive, bounded
+per-host connection pool, strict connect/read timeouts) and one
+openrouteservice.Client built on top of it, so views that create a new
+RoutingService per request no longer pay a fresh TCP+TLS handshake.
+"""
+import os
+import threading
+
+import openrouteservice
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ORS_BASE_URL = 'https://api.openrouteservice.org'
+
+# (connect, read) timeouts in seconds, applied to every ORS call
+CONNECT_TIMEOUT = float(os.environ.get('ORS_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('ORS_READ_TIMEOUT', 10))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Number of distinct host pools to keep, and the maximum number of connections
+# kept per host. With POOL_BLOCK enabled callers wait for a free connection
+# instead of opening extra ones, which makes POOL_MAXSIZE a hard per-host limit.
+POOL_CONNECTIONS = int(os.environ.get('ORS_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('ORS_POOL_MAXSIZE', 10))
+POOL_BLOCK = os.environ.get('ORS_POOL_BLOCK', 'True') == 'True'
+
+# Total time the ORS client may spend retrying 5xx/429 responses. Kept short so
+# a struggling upstream can't hold request threads for the library's 60s default.
+RETRY_TIMEOUT = int(os.environ.get('ORS_RETRY_TIMEOUT', 10))
+RETRY_OVER_QUERY_LIMIT = os.environ.get('ORS_RETRY_OVER_QUERY_LIMIT', 'False') == 'True'
+
+_lock = threading.Lock()
+_session = None
+_client = None
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=POOL_BLOCK,
+        # Only retry failed connects; never replay a request the server may have processed
+        max_retries=Retry(total=1, connect=1, read=0, status=0, backoff_factor=0.2),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the shared keep-alive session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get_client() -> openrouteservice.Client:
+    """Return the shared openrouteservice.Client bound to the pooled session."""
+    global _client
+    if _client is None:
+        session = get_session()
+        with _lock:
+            if _client is None:
+                client = openrouteservice.Client(
+                    key=settings.OPENROUTESERVICE_API_KEY,
+                    base_url=ORS_BASE_URL,
+                    timeout=TIMEOUT,
+                    retry_timeout=RETRY_TIMEOUT,
+                    retry_over_query_limit=RETRY_OVER_QUERY_LIMIT,
+                )
+                # The client creates its own Session; swap in the pooled one so
+                # directions/matrix calls reuse the same connections as geocoding.
+                client._session = session
+                _client = client
+    return _client
+
+
+def get_json(path: str, params=None):
+    """GET an ORS endpoint (e.g. '/geocode/search') and return the decoded JSON body."""
+    response = get_session().get(f"{ORS_BASE_URL}{path}", params=params, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+async def aget_json(path: str, params=None):
+    """Asyncio variant of get_json for the ASGI/Channels path.
+
+    The request runs on a worker thread over the same pooled session, so async
+    callers share keep-alive connections and limits with the sync views.
+    """
+    return await sync_to_async(get_json, thread_sensitive=False)(path, params)
+
+
+def reset() -> None:
+    """Drop the shared session and client (used after fork or in tests)."""
+    global _session, _client
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _client = None
@@ -10,8 +10,12 @@ urlpatterns = [
     
     # Real-time tracking API endpoints
     path('api/location/update/', api_views.update_driver_location, name='update_driver_location'),
+    path('api/location/buffer_stats/', api_views.location_buffer_stats, name='location_buffer_stats'),
     path('api/location/<int:booking_id>/', api_views.get_driver_location, name='get_driver_location'),
     path('api/route/<int:booking_id>/', api_views.get_current_route, name='get_current_route'),
+    path('api/quote/', api_views.create_quote, name='create_quote'),
+    path('api/geocode/', api_views.geocode, name='geocode'),
+    path('api/geocode/reverse/', api_views.reverse_geocode, name='reverse_geocode'),
     path('api/reroute/<int:booking_id>/', api_views.manual_reroute, name='manual_reroute'),
     path('api/driver/itinerary/', api_views.driver_itinerary, name='driver_itinerary'),
     path('api/itinerary/complete_stop/', api_views.complete_itinerary_stop, name='complete_itinerary_stop'),
@@ -1,9 +1,17 @@
+import os
 from typing import Dict, List, Optional, Tuple
 
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from django.utils import timezone
 
-import math
+import numpy as np
+
+from . import geometry, planner
+
+# Use ORS matrix durations/distances for stop planning and detour checks;
+# disable to stay on straight-line estimates (no ORS calls).
+ROAD_AWARE_PLANNING = os.environ.get('ROAD_AWARE_PLANNING', 'True') == 'True'
+ROAD_AWARE_DETOUR = os.environ.get('ROAD_AWARE_DETOUR', 'True') == 'True'
 
 
 def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -12,17 +20,10 @@ def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     Parameters are latitude and longitude in decimal degrees: (lat1, lon1, lat2, lon2).
     Returns distance in kilometers as a float.
     """
-    # Earth radius in kilometers
-    radius = 6371.0
-    ph1 = math.radians(lat1)
-    ph2 = math.radians(lat2)
-    d_phi = math.radians(lat2 - lat1)
-    d_lambda = math.radians(lon2 - lon1)
-    a = math.sin(d_phi / 2) ** 2 + math.cos(ph1) * math.cos(ph2) * math.sin(d_lambda / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return radius * c
-
-from .models import Booking, BookingStop, DriverLocation
+    return float(geometry.haversine_km(lat1, lon1, lat2, lon2))
+
+from .models import Booking, BookingStop
+from .location_store import get_driver_location
 from .services import RoutingService
 from user.models import Driver, Tricycle
 
@@ -52,15 +53,11 @@ def pickup_within_detour(driver_user, pickup_lat: float, pickup_lon: float, max_
     """Simple option A detour check: return True if pickup is within `max_km` of any point on the driver's
     current route approximation (driver current location + active bookings' pickup/destination points).
     """
-    driver_profile = Driver.objects.filter(user=driver_user).first()
     points = []  # list of (lat, lon)
 
-    if driver_profile:
-        if driver_profile.current_latitude is not None and driver_profile.current_longitude is not None:
-            try:
-                points.append((float(driver_profile.current_latitude), float(driver_profile.current_longitude)))
-            except Exception:
-                pass
+    location = get_driver_location(driver_user.id)
+    if location is not None:
+        points.append(location.latlon)
 
     # include active bookings' waypoints
     active_bookings = Booking.objects.filter(driver=driver_user, status__in=['accepted', 'on_the_way', 'started'])
@@ -80,15 +77,32 @@ def pickup_within_detour(driver_user, pickup_lat: float, pickup_lon: float, max_
     if not points:
         return True
 
-    for pt_lat, pt_lon in points:
-        try:
-            d = calculate_distance(pt_lat, pt_lon, float(pickup_lat), float(pickup_lon))
-            if d <= float(max_km):
-                return True
-        except Exception:
-            continue
+    try:
+        distances_km = geometry.point_to_points_m(float(pickup_lat), float(pickup_lon), points) / 1000.0
+    except (TypeError, ValueError):
+        return False
 
-    return False
+    # Road distance is never shorter than the straight line, so only points
+    # that pass the haversine check are worth a matrix lookup.
+    candidates = [points[i] for i in (distances_km <= float(max_km)).nonzero()[0]]
+    if not candidates:
+        return False
+    if not ROAD_AWARE_DETOUR:
+        return True
+
+    try:
+        matrix = RoutingService().calculate_matrix(
+            [(lon, lat) for lat, lon in candidates],
+            [(float(pickup_lon), float(pickup_lat))],
+        )
+    except Exception:
+        matrix = None
+    if matrix is None:
+        return True
+    road_km = matrix['distances'][:, 0]
+    road_km = road_km[~np.isnan(road_km)]
+    # All cells unroutable: keep the straight-line answer
+    return bool(road_km.size == 0 or (road_km <= float(max_km)).any())
 
 
 # ---- Multi-stop itinerary helpers ----
@@ -152,17 +166,8 @@ def resequence_driver_stops(driver_user) -> None:
 
 
 def _driver_start_location(driver_user) -> Optional[Tuple[float, float]]:
-    try:
-        location = DriverLocation.objects.get(driver=driver_user)
-        return (float(location.latitude), float(location.longitude))
-    except DriverLocation.DoesNotExist:
-        pass
-
-    driver_profile = Driver.objects.filter(user=driver_user).first()
-    if driver_profile and driver_profile.current_latitude and driver_profile.current_longitude:
-        return (float(driver_profile.current_latitude), float(driver_profile.current_longitude))
-
-    return None
+    location = get_driver_location(driver_user.id)
+    return location.latlon if location is not None else None
 
 
 def _stop_coordinates(stop: BookingStop) -> Optional[Tuple[float, float]]:
@@ -188,132 +193,92 @@ def _append_unique_point(polyline: List[List[float]], lat: float, lon: float, ep
         polyline.append([lat_f, lon_f])
 
 
-def _segment_route(
-    start: Tuple[float, float],
-    end: Tuple[float, float],
-    routing_service: Optional[RoutingService],
-    cache: Dict[Tuple[float, float, float, float], Tuple[Optional[List[List[float]]], bool]],
-) -> Tuple[Optional[List[List[float]]], bool]:
-    """Return route points for a segment along with a flag indicating if ORS provided geometry."""
-
-    if routing_service is None:
-        return None, False
-
-    key = (
-        round(start[0], 5),
-        round(start[1], 5),
-        round(end[0], 5),
-        round(end[1], 5),
-    )
-
-    if key in cache:
-        return cache[key]
-
-    try:
-        route_info = routing_service.calculate_route(
-            (start[1], start[0]),
-            (end[1], end[0]),
-            profile='driving-car'
-        )
-    except Exception:
-        cache[key] = (None, False)
-        return cache[key]
-
-    if not route_info:
-        cache[key] = (None, False)
-        return cache[key]
-
-    if route_info.get('too_close'):
-        segment = [[float(start[0]), float(start[1])], [float(end[0]), float(end[1])]]
-        cache[key] = (segment, False)
-        return cache[key]
-
-    route_data = route_info.get('route_data') or {}
-    features = route_data.get('features') or []
-    if not features:
-        cache[key] = (None, False)
-        return cache[key]
-
-    geometry = features[0].get('geometry') or {}
-    coordinates = geometry.get('coordinates') or []
-    if len(coordinates) < 2:
-        cache[key] = (None, False)
-        return cache[key]
-
-    segment = [[float(coord[1]), float(coord[0])] for coord in coordinates]
-    cache[key] = (segment, True)
-    return cache[key]
-
-
 def _build_route_polyline(
     start_coord: Optional[Tuple[float, float]],
     stops: List[BookingStop]
 ) -> Tuple[List[List[float]], bool, List[Dict[str, object]]]:
-    """Construct a polyline for the full itinerary using ORS routes when possible."""
+    """Construct a polyline for the full itinerary from one multi-waypoint ORS request."""
 
     polyline: List[List[float]] = []
     used_precise_route = False
     segments: List[Dict[str, object]] = []
 
-    try:
-        routing_service = RoutingService()
-    except Exception:
-        routing_service = None
-
-    segment_cache: Dict[Tuple[float, float, float, float], Tuple[Optional[List[List[float]]], bool]] = {}
-
-    previous_coord = start_coord if start_coord else None
+    # Waypoints in (lat, lon); each leg ends at the stop it leads to.
+    waypoints: List[Tuple[float, float]] = []
+    leg_stops: List[BookingStop] = []
     if start_coord:
-        _append_unique_point(polyline, start_coord[0], start_coord[1])
-
+        waypoints.append(start_coord)
     for stop in stops:
-        next_coord = _stop_coordinates(stop)
-        if next_coord is None:
+        coord = _stop_coordinates(stop)
+        if coord is None:
             # Skip stops without coordinates, but preserve the last known point
             continue
+        if waypoints:
+            leg_stops.append(stop)
+        waypoints.append(coord)
 
-        if previous_coord is None:
-            _append_unique_point(polyline, next_coord[0], next_coord[1])
-            previous_coord = next_coord
-            continue
+    if waypoints:
+        _append_unique_point(polyline, waypoints[0][0], waypoints[0][1])
 
-        segment, precise = _segment_route(previous_coord, next_coord, routing_service, segment_cache)
-        used_precise_route = used_precise_route or precise
-        segment_points: Optional[List[List[float]]] = None
-        if segment:
-            segment_points = [[float(lat), float(lon)] for lat, lon in segment]
-            for lat, lon in segment_points:
-                _append_unique_point(polyline, lat, lon)
+    legs: List[Dict[str, object]] = []
+    if len(waypoints) > 1:
+        try:
+            legs = RoutingService().calculate_route_legs(
+                [(lon, lat) for lat, lon in waypoints],
+                profile='driving-car'
+            )
+        except Exception as e:
+            print(f"Itinerary routing error: {e}")
+            legs = []
+
+    for idx, stop in enumerate(leg_stops):
+        leg = legs[idx] if idx < len(legs) else None
+        if leg and leg.get('points'):
+            segment_points = [[float(lat), float(lon)] for lat, lon in leg['points']]
+            precise = bool(leg.get('precise'))
         else:
-            fallback_segment = [
+            previous_coord, next_coord = waypoints[idx], waypoints[idx + 1]
+            segment_points = [
                 [float(previous_coord[0]), float(previous_coord[1])],
                 [float(next_coord[0]), float(next_coord[1])],
             ]
-            for lat, lon in fallback_segment:
-                _append_unique_point(polyline, lat, lon)
-            segment_points = fallback_segment
             precise = False
 
-        if segment_points:
-            segments.append({
-                'type': stop.stop_type,
-                'points': segment_points,
-                'precise': precise,
-            })
+        used_precise_route = used_precise_route or precise
+        for lat, lon in segment_points:
+            _append_unique_point(polyline, lat, lon)
+        segments.append({
+            'type': stop.stop_type,
+            'points': segment_points,
+            'precise': precise,
+        })
+
+    return polyline, used_precise_route, segments
 
-        previous_coord = next_coord
 
-    if not polyline and start_coord:
-        _append_unique_point(polyline, start_coord[0], start_coord[1])
+def _road_cost_matrix(start: Optional[Tuple[float, float]], problem: 'planner.PlanningProblem'):
+    """Driving durations between the planner's nodes, falling back to the problem's haversine matrix."""
+    points = ([start] if start else []) + [stop.coord for stop in problem.stops]
+    try:
+        matrix = RoutingService().calculate_matrix([(lon, lat) for lat, lon in points])
+    except Exception:
+        matrix = None
+    if matrix is None or np.isnan(matrix['durations']).any():
+        return problem.matrix
 
-    return polyline, used_precise_route, segments
+    durations = matrix['durations']
+    if start is None:
+        # Node 0 (no known start) costs nothing to leave
+        durations = np.pad(durations, ((1, 0), (1, 0)))
+    return durations
 
 
 def plan_driver_stops(driver_user) -> List[BookingStop]:
     """
     Generate an optimized ordered list of stops for the driver's active bookings.
-    Uses a greedy algorithm that considers complete trips (pickup + dropoff together)
-    to minimize total travel distance.
+    Completed stops keep their order; pending stops are ordered by
+    booking.planner, which keeps each pickup before its dropoff and the load
+    within the tricycle's capacity.
     """
     stops = list(
         BookingStop.objects.filter(
@@ -335,137 +300,47 @@ def plan_driver_stops(driver_user) -> List[BookingStop]:
 
     order: List[BookingStop] = ordered_completed.copy()
 
-    # Track which pickups have been completed
-    completed_pickups = {
-        stop.booking_id
-        for stop in ordered_completed
-        if stop.stop_type == 'PICKUP'
-    }
-
     current_location = _driver_start_location(driver_user)
     if current_location is None and ordered_completed:
         coord = _stop_coordinates(ordered_completed[-1])
         if coord:
             current_location = coord
 
-    # Group pending stops by booking
-    pending_by_booking = {}
+    # Bookings with a stop lacking coordinates can't be costed; they keep
+    # pickup-then-dropoff order after the planned stops.
+    pending_by_booking: Dict[int, List[BookingStop]] = {}
     for stop in pending:
-        if stop.booking_id not in pending_by_booking:
-            pending_by_booking[stop.booking_id] = {'pickup': None, 'dropoff': None}
-        if stop.stop_type == 'PICKUP':
-            pending_by_booking[stop.booking_id]['pickup'] = stop
-        else:
-            pending_by_booking[stop.booking_id]['dropoff'] = stop
+        pending_by_booking.setdefault(stop.booking_id, []).append(stop)
 
-    # Separate bookings that still need pickup vs those already picked up
-    needs_pickup = []
-    needs_dropoff_only = []
-    
-    for booking_id, pair in pending_by_booking.items():
-        if booking_id in completed_pickups:
-            # Already picked up, just need dropoff
-            if pair['dropoff']:
-                needs_dropoff_only.append(pair['dropoff'])
+    plannable: List[BookingStop] = []
+    unplannable: List[BookingStop] = []
+    for booking_stops in pending_by_booking.values():
+        if all(_stop_coordinates(stop) is not None for stop in booking_stops):
+            plannable.extend(booking_stops)
         else:
-            # Still needs pickup
-            if pair['pickup']:
-                needs_pickup.append(pair)
-
-    # Optimize route using greedy nearest-neighbor with trip completion preference
-    pending_work = needs_pickup.copy()
-    pending_dropoffs = needs_dropoff_only.copy()
-
-    while pending_work or pending_dropoffs:
-        candidates = []
-        
-        # For bookings we haven't picked up yet, consider the full trip cost
-        for pair in pending_work:
-            pickup = pair['pickup']
-            dropoff = pair['dropoff']
-            if pickup is None:
-                continue
-                
-            pickup_coord = _stop_coordinates(pickup)
-            if pickup_coord is None:
-                continue
-            
-            # Calculate: current -> pickup -> dropoff
-            if current_location:
-                dist_to_pickup = calculate_distance(
-                    current_location[0], current_location[1],
-                    pickup_coord[0], pickup_coord[1]
+            unplannable.extend(sorted(booking_stops, key=lambda s: (s.stop_type != 'PICKUP', s.sequence, s.id)))
+
+    if plannable:
+        capacity = Tricycle.objects.filter(driver__user=driver_user).values_list('max_capacity', flat=True).first()
+        problem = planner.PlanningProblem(
+            [
+                planner.PlanStop(
+                    key=stop.id,
+                    group=stop.booking_id,
+                    kind=stop.stop_type,
+                    load=int(stop.passenger_count or 1),
+                    coord=_stop_coordinates(stop),
                 )
-            else:
-                dist_to_pickup = 0
-            
-            # If we have a dropoff, include its distance too
-            if dropoff:
-                dropoff_coord = _stop_coordinates(dropoff)
-                if dropoff_coord:
-                    dist_pickup_to_dropoff = calculate_distance(
-                        pickup_coord[0], pickup_coord[1],
-                        dropoff_coord[0], dropoff_coord[1]
-                    )
-                    # Prefer completing full trips
-                    total_cost = dist_to_pickup + (dist_pickup_to_dropoff * 0.5)
-                else:
-                    total_cost = dist_to_pickup
-            else:
-                total_cost = dist_to_pickup
-            
-            candidates.append(('pickup_pair', pair, total_cost, pickup_coord))
-        
-        # Also consider dropoffs for already-picked-up passengers
-        for dropoff in pending_dropoffs:
-            dropoff_coord = _stop_coordinates(dropoff)
-            if dropoff_coord is None:
-                continue
-            
-            if current_location:
-                dist = calculate_distance(
-                    current_location[0], current_location[1],
-                    dropoff_coord[0], dropoff_coord[1]
-                )
-            else:
-                dist = 0
-            
-            # Prioritize dropoffs (passengers already in vehicle)
-            candidates.append(('dropoff', dropoff, dist * 0.8, dropoff_coord))
-        
-        if not candidates:
-            # No valid candidates with coordinates, just add remaining stops
-            for pair in pending_work:
-                if pair['pickup']:
-                    order.append(pair['pickup'])
-                    if pair['dropoff']:
-                        order.append(pair['dropoff'])
-            for dropoff in pending_dropoffs:
-                order.append(dropoff)
-            break
-        
-        # Pick the best candidate (lowest cost)
-        candidates.sort(key=lambda x: x[2])
-        best_type, best_item, best_cost, best_coord = candidates[0]
-        
-        if best_type == 'pickup_pair':
-            # Add pickup, then immediately add its dropoff if available
-            pair = best_item
-            order.append(pair['pickup'])
-            completed_pickups.add(pair['pickup'].booking_id)
-            
-            if pair['dropoff']:
-                order.append(pair['dropoff'])
-                pending_dropoffs = [d for d in pending_dropoffs if d.id != pair['dropoff'].id]
-            
-            pending_work.remove(pair)
-            current_location = _stop_coordinates(pair['dropoff']) if pair['dropoff'] else _stop_coordinates(pair['pickup'])
-        else:
-            # Add dropoff
-            dropoff = best_item
-            order.append(dropoff)
-            pending_dropoffs.remove(dropoff)
-            current_location = best_coord
+                for stop in plannable
+            ],
+            start=current_location,
+            capacity=capacity,
+            onboard=compute_current_capacity(ordered_completed),
+        )
+        problem.matrix = _road_cost_matrix(current_location, problem) if ROAD_AWARE_PLANNING else problem.matrix
+        by_id = {stop.id: stop for stop in plannable}
+        order.extend(by_id[key] for key in planner.plan(problem))
+    order.extend(unplannable)
 
     # Update sequences and statuses
     first_incomplete_found = False
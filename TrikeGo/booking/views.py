@@ -5,9 +5,9 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST
 from django.http import JsonResponse, HttpResponseForbidden
 from django.utils import timezone
-from django.core.cache import cache
 from .forms import BookingForm
 from .models import Booking
+from . import quotes
 from user.models import CustomUser
 
 @login_required
@@ -18,7 +18,10 @@ def create_booking(request):
         booking = form.save(commit=False)
         booking.rider = request.user  # Set the rider to the logged-in user
         booking.status = 'pending'    # Set the initial status
+        priced = quotes.price_booking(booking, form.cleaned_data.get('quote_id'))
         booking.save()
+        if priced is None:
+            quotes.schedule_pricing(booking)
         # Redirect to the new booking detail page to show status
         return redirect('booking:booking_detail', booking_id=booking.id)
     else:
@@ -34,6 +37,12 @@ def booking_detail(request, booking_id):
     if request.user != booking.rider and request.user != booking.driver:
         return HttpResponseForbidden("You do not have permission to view this booking.")
 
+    if booking.fare is None:
+        try:
+            quotes.retry_pricing(booking)
+        except Exception as e:
+            print(f"Fare retry failed for booking {booking.id}: {e}")
+
     context = {
         'booking': booking
     }
@@ -49,9 +58,6 @@ def cancel_booking(request, booking_id):
         return JsonResponse({'status': 'error', 'message': 'Permission denied.'}, status=403)
 
     if booking.status in ['pending', 'accepted', 'on_the_way']:
-        old_status = booking.status
-        old_driver_id = booking.driver_id
-        
         if request.user == booking.rider:
             # When rider cancels, just revert to pending and clear driver assignment
             booking.status = 'pending'
@@ -60,21 +66,9 @@ def cancel_booking(request, booking_id):
             # When driver cancels, revert to pending so another driver can accept
             booking.status = 'pending'
             booking.driver = None
+        # Saving bumps the booking's cache version (booking.cache_keys), dropping cached route info
         booking.save()
-        
-        # Clear all possible cache entries for this booking
-        cache_keys = [
-            f'route_info_{booking_id}_{old_status}_{old_driver_id or "none"}',
-            f'route_info_{booking_id}_pending_none',
-            f'route_info_{booking_id}_accepted_{old_driver_id or "none"}',
-            f'route_info_{booking_id}_on_the_way_{old_driver_id or "none"}',
-        ]
-        for key in cache_keys:
-            try:
-                cache.delete(key)
-            except Exception:
-                pass
-        
+
         return JsonResponse({'status': 'success', 'message': 'Booking cancelled successfully.'})
     else:
         return JsonResponse({'status': 'error', 'message': 'This booking can no longer be cancelled.'}, status=400)
@@ -4,92 +4,75 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 
-from .models import ChatMessage
+from . import history, services, writer
 from booking.models import Booking
 
 
+def _cursor(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_messages(request, booking_id):
-    """Return messages visible to everyone in the driver's active trip."""
-    booking = get_object_or_404(Booking, id=booking_id)
+    """Return messages visible to everyone in the driver's active trip.
+
+    Without parameters this is the newest page. ``after=<id>`` returns only
+    messages newer than the one the client already has (what a reconnect
+    asks for), ``before=<id>`` pages back through older history and
+    ``limit`` sets the page size. ``cursor`` is the id to pass as ``after``
+    next time; ``has_more`` says whether the page was cut short.
+
+    Messages still in a shared (Redis) write buffer show up once the worker
+    flushes them; live clients already got them over the chat socket. A
+    per-process buffer is flushed here first, since no worker can see it.
+    """
+    booking = get_object_or_404(Booking.objects.select_related('rider'), id=booking_id)
 
     # Permission: only the rider tied to the booking, or the driver handling it.
-    if request.user not in [booking.rider, booking.driver]:
-        return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
-
-    allowed_statuses = ['accepted', 'on_the_way', 'started']
-    if booking.status not in allowed_statuses:
-        return Response({'error': 'Chat not available for this booking status'}, status=status.HTTP_403_FORBIDDEN)
-
-    # Determine the current trip scope: all active bookings with the same driver.
-    linked_bookings = Booking.objects.filter(
-        driver=booking.driver,
-        status__in=allowed_statuses
-    ) if booking.driver else Booking.objects.filter(id=booking.id)
-
-    messages = (
-        ChatMessage.objects.filter(booking__in=linked_bookings)
-        .select_related('booking', 'booking__rider', 'booking__driver', 'sender')
-        .order_by('timestamp')
+    error = services.chat_error(request.user, booking)
+    if error:
+        return Response({'error': error}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        after = _cursor(request.query_params.get('after'))
+        before = _cursor(request.query_params.get('before'))
+        limit = _cursor(request.query_params.get('limit')) or history.CHAT_PAGE_SIZE
+    except ValueError:
+        return Response({'error': 'after, before and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+
+    writer.flush_local()
+    messages, has_more = history.page(
+        booking, services.trip_booking_ids(booking), after=after, before=before, limit=limit,
     )
-
-    data = []
-    for msg in messages:
-        sender_display = msg.sender.get_full_name() or msg.sender.username
-        trip_driver = msg.booking.driver
-        sender_role = 'Driver' if trip_driver and msg.sender_id == trip_driver.id else 'Passenger'
-        rider_name = msg.booking.rider.get_full_name() or msg.booking.rider.username if msg.booking.rider else 'Passenger'
-        data.append({
-            'id': msg.id,
-            'message': msg.message,
-            'timestamp': msg.timestamp.isoformat(),
-            'sender_id': msg.sender.id,
-            'sender_username': msg.sender.username,
-            'sender_display_name': sender_display,
-            'sender_role': sender_role,
-            'booking_id': msg.booking_id,
-            'booking_label': rider_name,
-        })
-
-    return Response({'messages': data})
+    cursor = messages[-1]['id'] if messages and before is None else after
+    return Response({'messages': messages, 'has_more': has_more, 'cursor': cursor})
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def post_message(request, booking_id):
-    """Create a message for a booking (only rider or driver may post)."""
-    booking = get_object_or_404(Booking, id=booking_id)
+    """Send a message for a booking (only rider or driver may post).
 
-    if request.user not in [booking.rider, booking.driver]:
-        return Response({'error': 'Permission denied'}, status=status.HTTP_403_FORBIDDEN)
+    Fallback for clients without a chat socket: the message takes the same
+    buffered path as one sent over ChatConsumer, so ``id`` is null until the
+    next flush; ``uid`` identifies it.
+    """
+    booking = get_object_or_404(Booking.objects.select_related('rider'), id=booking_id)
 
-    allowed_statuses = ['accepted', 'on_the_way', 'started']
-    if booking.status not in allowed_statuses:
-        return Response({'error': 'Chat not available for this booking status'}, status=status.HTTP_403_FORBIDDEN)
+    error = services.chat_error(request.user, booking)
+    if error:
+        return Response({'error': error}, status=status.HTTP_403_FORBIDDEN)
 
     message_text = (request.data.get('message') or '').strip()
     if not message_text:
         return Response({'error': 'Message is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-    msg = ChatMessage.objects.create(
-        message=message_text,
-        booking=booking,
-        sender=request.user
+    entry = writer.enqueue(booking.id, request.user.id, message_text)
+    data = services.message_payload(
+        booking, request.user, uid=entry['uid'], message=message_text, timestamp=entry['timestamp'],
     )
-
-    sender_display = msg.sender.get_full_name() or msg.sender.username
-    sender_role = 'Driver' if booking.driver and msg.sender_id == booking.driver.id else 'Passenger'
-    rider_name = booking.rider.get_full_name() or booking.rider.username if booking.rider else 'Passenger'
-
-    return Response({
-        'id': msg.id,
-        'message': msg.message,
-        'timestamp': msg.timestamp.isoformat(),
-        'sender_id': msg.sender.id,
-        'sender_username': msg.sender.username,
-        'sender_display_name': sender_display,
-        'sender_role': sender_role,
-        'booking_id': msg.booking_id,
-        'booking_label': rider_name,
-    }, status=status.HTTP_201_CREATED)
+    services.broadcast(booking, data)
+    return Response(data, status=status.HTTP_201_CREATED)
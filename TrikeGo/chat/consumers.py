@@ -1,69 +1,113 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from channels.db import database_sync_to_async
-from .models import ChatMessage
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from booking.models import Booking
+from . import services, writer
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        # Expect booking_id in the URL route kwargs
-        self.booking_id = self.scope['url_route']['kwargs'].get('booking_id')
-        self.group_name = f'chat_{self.booking_id}'
+    """
+    Trip chat for one booking (``ws/chat/<booking_id>/``), open to its rider
+    and driver while the booking is active.
 
-        # Only allow authenticated users
+    The socket joins the driver's trip group, so a message is sent once and
+    reaches every participant of the trip, the same scope
+    chat.api_views.get_messages returns. It also joins its booking's group,
+    through which chat.signals moves it to another trip or closes it when
+    the booking ends (see chat.services). Sent messages are broadcast straight
+    away and persisted through chat.writer; history is loaded over REST.
+    """
+
+    async def connect(self):
+        self.trip_group = None
+        self.booking_id = None
         user = self.scope.get('user')
         if not user or not user.is_authenticated:
             await self.close()
             return
 
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.booking_id = self.scope['url_route']['kwargs'].get('booking_id')
+        self.booking = await database_sync_to_async(self._load_booking)(user)
+        if self.booking is None:
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(services.chat_group(self.booking.id), self.channel_name)
+        await self._join_trip(services.conversation_group(self.booking))
         await self.accept()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if self.booking_id is not None:
+            await self.channel_layer.group_discard(services.chat_group(self.booking_id), self.channel_name)
+        await self._join_trip(None)
+
+    async def _join_trip(self, group):
+        if self.trip_group and self.trip_group != group:
+            await self.channel_layer.group_discard(self.trip_group, self.channel_name)
+        if group and group != self.trip_group:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.trip_group = group
 
     async def receive(self, text_data=None, bytes_data=None):
         if text_data is None:
             return
         try:
             payload = json.loads(text_data)
-            message = payload.get('message')
-            if not message:
-                return
-            user = self.scope.get('user')
-
-            # Save message to DB
-            chat_obj = await database_sync_to_async(self._save_message)(user.id, self.booking_id, message)
+        except ValueError:
+            return  # Ignore malformed messages
+        if payload.get('type') == 'ping':
+            await self.send(text_data=json.dumps({'type': 'pong'}))
+            return
+        message = payload.get('message')
+        message = message.strip() if isinstance(message, str) else ''
+        if not message:
+            return
 
-            # Broadcast to group
-            await self.channel_layer.group_send(
-                self.group_name,
-                {
-                    'type': 'chat.message',
-                    'message': message,
-                    'sender': user.username,
-                    'timestamp': str(chat_obj.timestamp)
-                }
-            )
-        except Exception:
-            # Ignore malformed messages
+        if self.trip_group is None or self.booking is None:
             return
+        user = self.scope['user']
+        entry = await database_sync_to_async(writer.enqueue)(self.booking.id, user.id, message)
+        data = services.message_payload(
+            self.booking, user, uid=entry['uid'], message=message, timestamp=entry['timestamp'],
+        )
+        await self.channel_layer.group_send(self.trip_group, {'type': 'chat.message', 'data': data})
 
     async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'message': event['message'],
-            'sender': event['sender'],
-            'timestamp': event['timestamp']
-        }))
+        data = event['data']
+        # 'sender' is kept for clients written against the original frame
+        await self.send(text_data=json.dumps(dict(data, type='message', sender=data['sender_username'])))
 
-    def _save_message(self, user_id, booking_id, message):
-        try:
-            user = User.objects.get(id=user_id)
-            chat = ChatMessage.objects.create(message=message, booking_id=booking_id, sender=user)
-            return chat
-        except Exception:
+    async def chat_trip(self, event):
+        """A booking joined another trip or left chat (sent to its own group and its old trip's)."""
+        if self.trip_group is None:
+            return  # already closed; the event can arrive through both groups
+        user = self.scope['user']
+        if user.id == self.booking.driver_id:
+            # The driver's socket follows their own trip, which outlives any one booking
+            trip = await database_sync_to_async(services.driver_trip)(user.id)
+            if trip:
+                if self.booking.id not in trip:
+                    # Keep sending on a booking that is still part of the trip
+                    self.booking = await database_sync_to_async(self._load_booking)(user, trip[0])
+                    if self.booking is not None:
+                        return
+                else:
+                    return
+        elif event['booking_id'] != self.booking.id:
+            return  # another passenger's booking
+        elif event['group'] is not None:
+            # Reassigned to another driver's trip
+            self.booking = await database_sync_to_async(self._load_booking)(user)
+            if self.booking is not None:
+                await self._join_trip(services.conversation_group(self.booking))
+                return
+        await self._join_trip(None)
+        await self.send(text_data=json.dumps({'type': 'closed'}))
+        await self.close()
+
+    def _load_booking(self, user, booking_id=None):
+        booking = Booking.objects.select_related('rider').filter(id=booking_id or self.booking_id).first()
+        if booking is None or services.chat_error(user, booking):
             return None
+        return booking
@@ -0,0 +1,102 @@
+"""
+Incremental chat history.
+
+Clients load the newest page when a chat opens and afterwards only ask for
+messages after the last id they hold (``?after=<id>``), or page backwards
+with ``?before=<id>``. chat.writer serializes its flushes, so ids follow
+the order messages were queued in and double as the cursor; queries run on
+the (booking, id) index.
+
+The newest CHAT_TAIL_SIZE messages of each trip are cached, so an
+incremental fetch or reconnect is served without touching the message
+table. The writer drops the affected tails after every flush, and a tail is
+rebuilt when the set of bookings on the trip changes.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+from django.core.cache import cache
+
+from booking.models import Booking
+from . import services
+from .models import ChatMessage
+
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', 50))
+CHAT_PAGE_MAX = int(os.environ.get('CHAT_PAGE_MAX', 200))
+# Newest messages kept in the per-trip cache.
+CHAT_TAIL_SIZE = int(os.environ.get('CHAT_TAIL_SIZE', 100))
+CHAT_TAIL_TTL = int(os.environ.get('CHAT_TAIL_TTL', 10 * 60))
+
+
+def tail_key(driver_id, booking_id) -> str:
+    if driver_id:
+        return f'chat_tail:driver:{driver_id}'
+    return f'chat_tail:booking:{booking_id}'
+
+
+def _messages(booking_ids):
+    return ChatMessage.objects.filter(booking_id__in=booking_ids).select_related('booking', 'booking__rider', 'sender')
+
+
+def _serialize(messages) -> List[Dict[str, object]]:
+    return [
+        services.message_payload(
+            msg.booking, msg.sender,
+            uid=msg.uid, message=msg.message, timestamp=msg.timestamp, message_id=msg.id,
+        )
+        for msg in messages
+    ]
+
+
+def get_tail(booking, booking_ids: List[int]) -> Dict[str, object]:
+    """Newest messages of the trip, oldest first; ``complete`` when that is the whole conversation."""
+    key = tail_key(booking.driver_id, booking.id)
+    tail = cache.get(key)
+    if tail is not None and tail['booking_ids'] == sorted(booking_ids):
+        return tail
+    newest = list(_messages(booking_ids).order_by('-id')[:CHAT_TAIL_SIZE])
+    tail = {
+        'booking_ids': sorted(booking_ids),
+        'messages': _serialize(reversed(newest)),
+        'complete': len(newest) < CHAT_TAIL_SIZE,
+    }
+    cache.set(key, tail, timeout=CHAT_TAIL_TTL)
+    return tail
+
+
+def invalidate(booking_ids) -> None:
+    """Drop the cached tails of the trips these bookings belong to."""
+    try:
+        rows = Booking.objects.filter(id__in=set(booking_ids)).values_list('id', 'driver_id')
+        cache.delete_many({tail_key(driver_id, booking_id) for booking_id, driver_id in rows})
+    except Exception as e:
+        print(f"Chat tail invalidation failed: {e}")
+
+
+def page(booking, booking_ids: List[int], after: Optional[int] = None, before: Optional[int] = None,
+         limit: int = CHAT_PAGE_SIZE) -> Tuple[List[Dict[str, object]], bool]:
+    """
+    One page of the trip's messages, oldest first, and whether more exist
+    beyond it: newer than the page for ``after``, older otherwise.
+    """
+    limit = max(1, min(limit, CHAT_PAGE_MAX))
+
+    if before is not None:
+        older = list(_messages(booking_ids).filter(id__lt=before).order_by('-id')[:limit + 1])
+        return _serialize(reversed(older[:limit])), len(older) > limit
+
+    tail = get_tail(booking, booking_ids)
+    cached = tail['messages']
+    if after is None:
+        if tail['complete'] or len(cached) >= limit:
+            newest = cached[-limit:]
+            return newest, len(cached) > limit or not tail['complete']
+        older = list(_messages(booking_ids).order_by('-id')[:limit + 1])
+        return _serialize(reversed(older[:limit])), len(older) > limit
+
+    if tail['complete'] or (cached and cached[0]['id'] <= after):
+        newer = [m for m in cached if m['id'] > after]
+        return newer[:limit], len(newer) > limit
+    # The client is further behind than the cached tail
+    newer = list(_messages(booking_ids).filter(id__gt=after).order_by('id')[:limit + 1])
+    return _serialize(newer[:limit]), len(newer) > limit
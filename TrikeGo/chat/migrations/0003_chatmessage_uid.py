@@ -0,0 +1,43 @@
+import uuid
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def assign_uids(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    batch = []
+    for message in ChatMessage.objects.filter(uid__isnull=True).only('id').iterator(chunk_size=500):
+        message.uid = uuid.uuid4()
+        batch.append(message)
+        if len(batch) >= 500:
+            ChatMessage.objects.bulk_update(batch, ['uid'])
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_update(batch, ['uid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_chatmessage_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(assign_uids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='uid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
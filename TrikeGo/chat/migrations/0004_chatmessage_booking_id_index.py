@@ -0,0 +1,20 @@
+# Generated by Django 5.2.6 on 2026-10-18 08:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_routesnapshot_compact_geometry'),
+        ('chat', '0003_chatmessage_uid'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['booking', 'id'], name='chat_msg_booking_id_idx'),
+        ),
+    ]
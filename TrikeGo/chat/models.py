@@ -1,17 +1,27 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 from user.models import CustomUser
 from booking.models import Booking
 
 
 class ChatMessage(models.Model):
+    # Assigned when the message is sent, before the buffered write reaches the
+    # database, so clients can de-duplicate pushed and fetched copies.
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     message = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE)
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
 
     class Meta:
         db_table = 'chat_chatmessage'
         ordering = ['timestamp']
+        indexes = [
+            # Cursor pagination in chat.history: booking_id IN (...) AND id > cursor
+            models.Index(fields=['booking', 'id'], name='chat_msg_booking_id_idx'),
+        ]
     # Let Django manage the chat table (create migrations & migrate) so it is
     # tracked by migrations. If your production DB already has the table and
     # you don't want Django to alter it, set managed = False instead.
@@ -0,0 +1,122 @@
+"""
+Chat rules shared by the REST views and ChatConsumer: who may chat on a
+booking, which bookings share a conversation and how a message is serialized.
+
+Everyone on a driver's current trip shares one conversation and one channel
+group, ``chat_trip_<driver id>``, so a message is sent to the layer once.
+Each socket also joins ``chat_<booking id>``, which chat.signals uses to
+move it to another trip group or close it when the booking is accepted,
+reassigned, completed or cancelled. The trip's booking ids are cached and
+refreshed by the same signals instead of being queried per message.
+"""
+import os
+from typing import Dict, List, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from booking.models import Booking
+
+CHAT_STATUSES = ['accepted', 'on_the_way', 'started']
+# Safety net only: membership is refreshed whenever a booking joins or leaves a trip.
+CHAT_TRIP_TTL = int(os.environ.get('CHAT_TRIP_TTL', 60 * 60))
+
+
+def chat_group(booking_id) -> str:
+    return f'chat_{booking_id}'
+
+
+def trip_group(driver_id) -> str:
+    return f'chat_trip_{driver_id}'
+
+
+def conversation_group(booking) -> str:
+    """The group a booking's messages are sent to."""
+    return trip_group(booking.driver_id) if booking.driver_id else chat_group(booking.id)
+
+
+def _trip_key(driver_id) -> str:
+    return f'chat_trip:{driver_id}'
+
+
+def chat_error(user, booking) -> Optional[str]:
+    """Why ``user`` may not chat on ``booking``, or None when they may."""
+    if user.id not in (booking.rider_id, booking.driver_id):
+        return 'Permission denied'
+    if booking.status not in CHAT_STATUSES:
+        return 'Chat not available for this booking status'
+    return None
+
+
+def refresh_trip(driver_id) -> List[int]:
+    """Recompute and cache the active bookings on a driver's trip."""
+    ids = sorted(
+        Booking.objects.filter(driver_id=driver_id, status__in=CHAT_STATUSES).values_list('id', flat=True)
+    )
+    cache.set(_trip_key(driver_id), ids, timeout=CHAT_TRIP_TTL)
+    return ids
+
+
+def driver_trip(driver_id) -> List[int]:
+    """Cached active bookings on a driver's trip."""
+    ids = cache.get(_trip_key(driver_id))
+    if ids is None:
+        ids = refresh_trip(driver_id)
+    return ids
+
+
+def trip_booking_ids(booking) -> List[int]:
+    """Bookings in the same conversation: every active booking of the driver's trip."""
+    if not booking.driver_id:
+        return [booking.id]
+    return driver_trip(booking.driver_id) or [booking.id]
+
+
+def display_name(user) -> str:
+    return user.get_full_name() or user.username
+
+
+def message_payload(booking, sender, *, uid, message, timestamp, message_id=None) -> Dict[str, object]:
+    """Wire form of one message; ``booking.rider`` should already be loaded."""
+    return {
+        'id': message_id,
+        'uid': str(uid),
+        'message': message,
+        'timestamp': timestamp if isinstance(timestamp, str) else timestamp.isoformat(),
+        'sender_id': sender.id,
+        'sender_username': sender.username,
+        'sender_display_name': display_name(sender),
+        'sender_role': 'Driver' if booking.driver_id and sender.id == booking.driver_id else 'Passenger',
+        'booking_id': booking.id,
+        'booking_label': display_name(booking.rider) if booking.rider else 'Passenger',
+    }
+
+
+def _group_send(group: str, event: Dict[str, object]) -> bool:
+    layer = get_channel_layer()
+    if layer is None:
+        return False
+    try:
+        async_to_sync(layer.group_send)(group, event)
+        return True
+    except Exception as e:
+        print(f"Chat send to {group} failed: {e}")
+        return False
+
+
+def broadcast(booking, data: Dict[str, object]) -> bool:
+    """Push a message to everyone on the booking's trip (see ChatConsumer); never raises."""
+    return _group_send(conversation_group(booking), {'type': 'chat.message', 'data': data})
+
+
+def move_booking(booking_id, group: Optional[str], old_group: Optional[str] = None) -> None:
+    """
+    Tell sockets that a booking now belongs to ``group`` (None once chat is
+    closed for it). Sent to the booking's own group and to the trip group it
+    left, whose driver socket may have been using it.
+    """
+    event = {'type': 'chat.trip', 'booking_id': booking_id, 'group': group}
+    _group_send(chat_group(booking_id), event)
+    if old_group and old_group != group:
+        _group_send(old_group, event)
@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from booking.models import Booking
+from . import services
+
+
+def _chat_open(status, driver_id) -> bool:
+    return status in services.CHAT_STATUSES and driver_id is not None
+
+
+@receiver(post_init, sender=Booking)
+def remember_chat_state(sender, instance, **kwargs):
+    # booking.signals resets its own _loaded_* markers before this app's receivers run
+    instance._chat_driver_id = instance.__dict__.get('driver_id')
+    instance._chat_active = _chat_open(instance.__dict__.get('status'), instance._chat_driver_id)
+
+
+@receiver(post_save, sender=Booking)
+def maintain_trip_chat(sender, instance, created, **kwargs):
+    """Keep trip membership and the sockets' trip groups in step with accept, complete and cancel."""
+    old_driver_id = None if created else getattr(instance, '_chat_driver_id', None)
+    was_active = False if created else getattr(instance, '_chat_active', False)
+    active = _chat_open(instance.status, instance.driver_id)
+    instance._chat_driver_id = instance.driver_id
+    instance._chat_active = active
+    if old_driver_id == instance.driver_id and was_active == active:
+        return
+
+    def apply():
+        for driver_id in {old_driver_id, instance.driver_id} - {None}:
+            services.refresh_trip(driver_id)
+        # Sockets of this booking move to the new trip group, or leave once chat is closed
+        services.move_booking(
+            instance.id,
+            services.trip_group(instance.driver_id) if active else None,
+            services.trip_group(old_driver_id) if old_driver_id and was_active else None,
+        )
+
+    transaction.on_commit(apply)
+
+
+@receiver(post_delete, sender=Booking)
+def forget_trip_booking(sender, instance, **kwargs):
+    if instance.driver_id:
+        transaction.on_commit(lambda: services.refresh_trip(instance.driver_id))
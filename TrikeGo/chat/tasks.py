@@ -0,0 +1,8 @@
+from celery import shared_task
+
+
+@shared_task
+def flush_chat_messages():
+    """Periodic flush of buffered chat messages, so a quiet chat still reaches the database."""
+    from .writer import flush_all
+    return flush_all()
@@ -0,0 +1,350 @@
+import json
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.routing import URLRouter
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+
+from booking.models import Booking
+from chat import history, routing, services, writer
+from chat.models import ChatMessage
+
+User = get_user_model()
+# The real timer scheduler; ChatTestCase patches it out
+schedule_flush = writer._schedule_flush
+
+
+class Socket(ApplicationCommunicator):
+    """Minimal websocket client for ChatConsumer (channels.testing needs daphne)."""
+
+    def __init__(self, path, user):
+        scope = {'type': 'websocket', 'path': path, 'query_string': b'',
+                 'headers': [], 'subprotocols': [], 'user': user}
+        super().__init__(URLRouter(routing.websocket_urlpatterns), scope)
+
+    async def connect(self):
+        await self.send_input({'type': 'websocket.connect'})
+        response = await self.receive_output(1)
+        return response['type'] == 'websocket.accept'
+
+    async def send_json(self, data):
+        await self.send_input({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+    async def receive_json(self):
+        response = await self.receive_output(1)
+        return json.loads(response['text'])
+
+    async def disconnect(self):
+        await self.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await self.wait(1)
+
+
+class ChatTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        writer._queue = None
+        # Hold the flush lock so messages stay buffered until a test flushes
+        cache.add(writer.FLUSH_LOCK_KEY, 1, timeout=60)
+        # No timer threads: tests flush explicitly
+        patcher = mock.patch('chat.writer._schedule_flush')
+        self.schedule_flush = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.driver = User.objects.create_user(username='drv-chat', password='pass', trikego_user='D')
+        self.rider = User.objects.create_user(username='rdr-chat', password='pass', trikego_user='R',
+                                              first_name='Ana')
+        self.other_rider = User.objects.create_user(username='rdr-chat2', password='pass', trikego_user='R')
+        self.stranger = User.objects.create_user(username='rdr-chat3', password='pass', trikego_user='R')
+        self.booking = self._booking(self.rider, 'accepted')
+        self.shared = self._booking(self.other_rider, 'started')
+
+    def tearDown(self):
+        writer._queue = None
+
+    def _booking(self, rider, status):
+        return Booking.objects.create(
+            rider=rider, driver=self.driver, status=status,
+            pickup_address='A', pickup_latitude=10.30, pickup_longitude=123.90,
+            destination_address='B', destination_latitude=10.32, destination_longitude=123.92,
+        )
+
+
+class ChatConsumerTest(ChatTestCase):
+    async def test_only_participants_of_active_bookings_connect(self):
+        self.assertFalse(await Socket(f'/ws/chat/{self.booking.id}/', self.stranger).connect())
+        pending = await sync_to_async(Booking.objects.create)(
+            rider=self.stranger, status='pending',
+            pickup_address='A', pickup_latitude=10.30, pickup_longitude=123.90,
+            destination_address='B', destination_latitude=10.32, destination_longitude=123.92,
+        )
+        self.assertFalse(await Socket(f'/ws/chat/{pending.id}/', self.stranger).connect())
+
+        socket = Socket(f'/ws/chat/{self.booking.id}/', self.rider)
+        self.assertTrue(await socket.connect())
+        await socket.disconnect()
+
+    async def test_message_reaches_the_whole_trip_before_it_is_persisted(self):
+        rider = Socket(f'/ws/chat/{self.booking.id}/', self.rider)
+        driver = Socket(f'/ws/chat/{self.shared.id}/', self.driver)
+        other = Socket(f'/ws/chat/{self.shared.id}/', self.other_rider)
+        for socket in (rider, driver, other):
+            self.assertTrue(await socket.connect())
+
+        await rider.send_json({'message': '  On my way down  '})
+        frames = [await socket.receive_json() for socket in (rider, driver, other)]
+        self.assertEqual(frames[0], frames[1])
+        self.assertEqual(frames[0], frames[2])
+        frame = frames[0]
+        self.assertEqual(frame['type'], 'message')
+        self.assertEqual(frame['message'], 'On my way down')
+        self.assertEqual(frame['sender_display_name'], 'Ana')
+        self.assertEqual(frame['sender_role'], 'Passenger')
+        self.assertEqual(frame['booking_id'], self.booking.id)
+        self.assertIsNone(frame['id'])
+
+        # Buffered, not yet written
+        self.assertEqual(await sync_to_async(ChatMessage.objects.count)(), 0)
+        self.assertEqual(await sync_to_async(writer.flush_all)(), 1)
+        saved = await sync_to_async(ChatMessage.objects.get)()
+        self.assertEqual(str(saved.uid), frame['uid'])
+        self.assertEqual(saved.timestamp.isoformat(), frame['timestamp'])
+
+        for socket in (rider, driver, other):
+            await socket.disconnect()
+
+    async def test_sending_does_not_query_the_database(self):
+        socket = Socket(f'/ws/chat/{self.booking.id}/', self.driver)
+        self.assertTrue(await socket.connect())
+        with mock.patch('django.db.backends.utils.CursorWrapper.execute') as execute:
+            await socket.send_json({'message': 'Arriving in 2 minutes'})
+            frame = await socket.receive_json()
+        execute.assert_not_called()
+        self.assertEqual(frame['sender_role'], 'Driver')
+        await socket.disconnect()
+
+
+class TripChatTest(ChatTestCase):
+    def _save(self, booking, **changes):
+        for field, value in changes.items():
+            setattr(booking, field, value)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.save()
+
+    async def test_passenger_added_mid_trip_receives_messages_without_reconnecting(self):
+        driver = Socket(f'/ws/chat/{self.booking.id}/', self.driver)
+        self.assertTrue(await driver.connect())
+
+        late = await sync_to_async(Booking.objects.create)(
+            rider=self.stranger, status='pending',
+            pickup_address='A', pickup_latitude=10.30, pickup_longitude=123.90,
+            destination_address='B', destination_latitude=10.32, destination_longitude=123.92,
+        )
+        await sync_to_async(self._save)(late, driver=self.driver, status='accepted')
+        self.assertIn(late.id, await sync_to_async(services.driver_trip)(self.driver.id))
+        passenger = Socket(f'/ws/chat/{late.id}/', self.stranger)
+        self.assertTrue(await passenger.connect())
+
+        await driver.send_json({'message': 'Three of us now'})
+        self.assertEqual((await passenger.receive_json())['message'], 'Three of us now')
+        self.assertEqual((await driver.receive_json())['message'], 'Three of us now')
+        await passenger.disconnect()
+        await driver.disconnect()
+
+    async def test_completed_booking_leaves_the_trip(self):
+        rider = Socket(f'/ws/chat/{self.booking.id}/', self.rider)
+        driver = Socket(f'/ws/chat/{self.booking.id}/', self.driver)
+        other = Socket(f'/ws/chat/{self.shared.id}/', self.other_rider)
+        for socket in (rider, driver, other):
+            self.assertTrue(await socket.connect())
+
+        await sync_to_async(self._save)(self.booking, status='completed')
+        self.assertEqual(await rider.receive_json(), {'type': 'closed'})
+        self.assertEqual((await rider.receive_output(1))['type'], 'websocket.close')
+        self.assertEqual(await sync_to_async(services.driver_trip)(self.driver.id), [self.shared.id])
+
+        # The driver's socket stays on the trip and now sends on the remaining booking
+        await driver.send_json({'message': 'Next stop'})
+        frame = await other.receive_json()
+        self.assertEqual(frame['booking_id'], self.shared.id)
+        self.assertEqual((await driver.receive_json())['message'], 'Next stop')
+        self.assertTrue(await rider.receive_nothing(0.1))
+
+        await sync_to_async(self._save)(self.shared, status='completed')
+        self.assertEqual(await other.receive_json(), {'type': 'closed'})
+        self.assertEqual(await driver.receive_json(), {'type': 'closed'})
+
+    def test_membership_is_cached_and_refreshed_on_cancel(self):
+        self.assertEqual(services.trip_booking_ids(self.booking), sorted([self.booking.id, self.shared.id]))
+        with self.assertNumQueries(0):
+            services.trip_booking_ids(self.shared)
+        self._save(self.shared, status='cancelled_by_rider')
+        with self.assertNumQueries(0):
+            self.assertEqual(services.trip_booking_ids(self.booking), [self.booking.id])
+
+
+class ChatApiTest(ChatTestCase):
+    def test_history_includes_flushed_messages(self):
+        first = writer.enqueue(self.booking.id, self.rider.id, 'Hello')
+        writer.enqueue(self.shared.id, self.driver.id, 'Picking you up next')
+        self.client.force_login(self.rider)
+
+        # A per-process buffer is flushed before reading; no worker can see it
+        response = self.client.get(f'/chat/api/booking/{self.booking.id}/messages/')
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()['messages']
+        self.assertEqual([m['message'] for m in messages], ['Hello', 'Picking you up next'])
+        self.assertEqual(messages[0]['uid'], first['uid'])
+        self.assertIsNotNone(messages[0]['id'])
+        self.assertEqual(writer.pending_count(), 0)
+
+        self.client.force_login(self.stranger)
+        self.assertEqual(self.client.get(f'/chat/api/booking/{self.booking.id}/messages/').status_code, 403)
+
+    def test_reading_leaves_a_shared_buffer_to_the_worker(self):
+        writer.enqueue(self.booking.id, self.rider.id, 'Hello')
+        writer._pending().shared = True
+        self.client.force_login(self.rider)
+        response = self.client.get(f'/chat/api/booking/{self.booking.id}/messages/')
+        self.assertEqual(response.json()['messages'], [])
+        self.assertEqual(writer.pending_count(), 1)
+
+    def test_post_goes_through_the_buffer_and_is_broadcast(self):
+        self.client.force_login(self.rider)
+        with mock.patch('chat.services.broadcast') as broadcast:
+            response = self.client.post(f'/chat/api/booking/{self.booking.id}/messages/send/',
+                                        {'message': 'Near the gate'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ChatMessage.objects.count(), 0)
+        broadcast.assert_called_once()
+        self.assertEqual(broadcast.call_args.args[1], response.json())
+
+        writer.flush_all()
+        self.assertEqual(str(ChatMessage.objects.get().uid), response.json()['uid'])
+
+
+class ChatHistoryTest(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(12):
+            booking = self.booking if i % 2 == 0 else self.shared
+            sender = self.rider if i % 2 == 0 else self.driver
+            writer.enqueue(booking.id, sender.id, f'm{i}')
+        writer.flush_all()
+        self.ids = list(ChatMessage.objects.order_by('id').values_list('id', flat=True))
+        self.url = f'/chat/api/booking/{self.booking.id}/messages/'
+        self.client.force_login(self.rider)
+
+    def _get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_newest_page_then_backwards(self):
+        data = self._get(limit=5)
+        self.assertEqual([m['message'] for m in data['messages']], ['m7', 'm8', 'm9', 'm10', 'm11'])
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['cursor'], self.ids[-1])
+
+        older = self._get(before=data['messages'][0]['id'], limit=5)
+        self.assertEqual([m['message'] for m in older['messages']], ['m2', 'm3', 'm4', 'm5', 'm6'])
+        self.assertTrue(older['has_more'])
+        oldest = self._get(before=older['messages'][0]['id'], limit=5)
+        self.assertEqual([m['message'] for m in oldest['messages']], ['m0', 'm1'])
+        self.assertFalse(oldest['has_more'])
+
+    def test_after_cursor_returns_only_new_messages(self):
+        cursor = self._get()['cursor']
+        self.assertEqual(self._get(after=cursor), {'messages': [], 'has_more': False, 'cursor': cursor})
+
+        writer.enqueue(self.shared.id, self.other_rider.id, 'late')
+        writer.flush_all()
+        data = self._get(after=cursor)
+        self.assertEqual([m['message'] for m in data['messages']], ['late'])
+        self.assertEqual(data['messages'][0]['booking_id'], self.shared.id)
+        self.assertGreater(data['cursor'], cursor)
+
+        data = self._get(after=self.ids[3], limit=4)
+        self.assertEqual([m['message'] for m in data['messages']], ['m4', 'm5', 'm6', 'm7'])
+        self.assertTrue(data['has_more'])
+
+    def test_incremental_fetch_is_served_from_the_tail_cache(self):
+        cursor = self._get()['cursor']
+        # Session, user and booking; trip membership and messages come from the cache
+        with self.assertNumQueries(3):
+            self._get(after=cursor)
+
+    def test_client_behind_the_tail_reads_the_table(self):
+        with mock.patch.object(history, 'CHAT_TAIL_SIZE', 4):
+            cache.clear()
+            data = self._get(after=self.ids[1], limit=3)
+        self.assertEqual([m['message'] for m in data['messages']], ['m2', 'm3', 'm4'])
+        self.assertTrue(data['has_more'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'after': 'x'}).status_code, 400)
+
+
+class ChatWriterTest(ChatTestCase):
+    def test_failed_flush_keeps_messages_queued(self):
+        writer.enqueue(self.booking.id, self.rider.id, 'one')
+        writer.enqueue(self.booking.id, self.rider.id, 'two')
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=Exception('db down')):
+            self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.pending_count(), 2)
+
+        self.assertEqual(writer.flush_all(), 2)
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['one', 'two'])
+
+    def test_one_flush_writes_at_a_time(self):
+        writer.enqueue(self.booking.id, self.rider.id, 'one')
+        cache.add(writer.WRITE_LOCK_KEY, 1, timeout=60)
+        self.assertEqual(writer.flush_all(), 0)
+        self.assertEqual(writer.pending_count(), 1)
+
+        cache.delete(writer.WRITE_LOCK_KEY)
+        self.assertEqual(writer.flush_all(), 1)
+        self.assertIsNone(cache.get(writer.WRITE_LOCK_KEY))
+
+    def test_failed_batch_is_written_before_newer_messages(self):
+        writer.enqueue(self.booking.id, self.rider.id, 'one')
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=Exception('db down')):
+            writer.flush()
+        writer.enqueue(self.booking.id, self.rider.id, 'two')
+        writer.flush_all()
+        self.assertEqual(list(ChatMessage.objects.order_by('id').values_list('message', flat=True)), ['one', 'two'])
+
+    def test_replayed_entries_are_not_duplicated(self):
+        entry = writer.enqueue(self.booking.id, self.rider.id, 'once')
+        writer.flush_all()
+        writer._pending().push(json.dumps(entry))
+        writer.flush_all()
+        self.assertEqual(ChatMessage.objects.count(), 1)
+
+    def test_remainder_of_a_burst_is_flushed_on_a_timer(self):
+        writer.enqueue(self.booking.id, self.rider.id, 'one')
+        writer.enqueue(self.booking.id, self.rider.id, 'two')
+        self.assertEqual(self.schedule_flush.call_count, 2)
+
+        # One timer at a time, however many messages are waiting
+        with mock.patch('chat.writer.threading.Timer') as timer:
+            timer.return_value.is_alive.return_value = True
+            schedule_flush()
+            schedule_flush()
+        timer.assert_called_once_with(writer.CHAT_FLUSH_INTERVAL, writer._flush_remainder)
+        writer._timer = None
+
+        # What the timer runs, minus closing the test's connection
+        with mock.patch('django.db.connection.close'):
+            writer._flush_remainder()
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertEqual(writer.pending_count(), 0)
+
+    def test_backlog_forces_a_flush(self):
+        with mock.patch.object(writer, 'CHAT_BUFFER_MAX_PENDING', 3):
+            for i in range(3):
+                writer.enqueue(self.booking.id, self.rider.id, f'm{i}')
+        self.assertEqual(ChatMessage.objects.count(), 3)
+        self.assertEqual(writer.pending_count(), 0)
@@ -0,0 +1,246 @@
+"""
+Buffered persistence for chat messages.
+
+Sending a message appends it to a queue and returns immediately; the message
+is broadcast to the chat group straight away and written to the database in
+one bulk insert at most every CHAT_FLUSH_INTERVAL seconds (sooner once
+CHAT_BUFFER_MAX_PENDING messages are waiting). Every message carries a uid
+and its send time, so the batched insert keeps the original order and a
+retried flush can't duplicate rows.
+
+Only one flush writes at a time, cluster-wide: the write lock is held from
+taking a batch off the queue until it is inserted (or put back after a
+failure), so ids are assigned in queue order and chat.history can use them
+as cursors.
+
+The queue is a Redis list when django-redis is the cache backend, shared by
+every worker and the Celery flush task; otherwise a per-process deque that
+the worker can't see, so this process flushes whatever is left of a burst on
+a timer CHAT_FLUSH_INTERVAL seconds later.
+"""
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Dict, List
+
+from django.core.cache import cache
+from django.utils import timezone
+
+# Seconds between database flushes.
+CHAT_FLUSH_INTERVAL = float(os.environ.get('CHAT_FLUSH_INTERVAL', 1))
+# Messages written per flush; anything beyond stays queued for the next one.
+CHAT_FLUSH_BATCH_SIZE = int(os.environ.get('CHAT_FLUSH_BATCH_SIZE', 500))
+# Backpressure: once this many messages are waiting, flush immediately.
+CHAT_BUFFER_MAX_PENDING = int(os.environ.get('CHAT_BUFFER_MAX_PENDING', 200))
+# A flush holding the write lock longer than this is presumed dead.
+CHAT_WRITE_LOCK_TTL = int(os.environ.get('CHAT_WRITE_LOCK_TTL', 30))
+
+QUEUE_KEY = 'chat_buffer:queue'
+FLUSH_LOCK_KEY = 'chat_buffer:flush_lock'
+WRITE_LOCK_KEY = 'chat_buffer:write_lock'
+
+
+class _LocalQueue:
+    shared = False
+
+    def __init__(self):
+        self._items = deque()
+        self._lock = threading.Lock()
+
+    def push(self, *items) -> None:
+        with self._lock:
+            self._items.extend(items)
+
+    def push_front(self, items) -> None:
+        with self._lock:
+            self._items.extendleft(reversed(items))
+
+    def pop(self, count: int) -> List[str]:
+        with self._lock:
+            return [self._items.popleft() for _ in range(min(count, len(self._items)))]
+
+    def size(self) -> int:
+        return len(self._items)
+
+
+class _RedisQueue:
+    shared = True
+
+    def __init__(self, connection):
+        self._conn = connection
+
+    def push(self, *items) -> None:
+        if items:
+            self._conn.rpush(QUEUE_KEY, *items)
+
+    def push_front(self, items) -> None:
+        if items:
+            self._conn.lpush(QUEUE_KEY, *reversed(items))
+
+    def pop(self, count: int) -> List[str]:
+        pipe = self._conn.pipeline()
+        pipe.lrange(QUEUE_KEY, 0, count - 1)
+        pipe.ltrim(QUEUE_KEY, count, -1)
+        items, _ = pipe.execute()
+        return [item.decode() if isinstance(item, bytes) else item for item in items]
+
+    def size(self) -> int:
+        return int(self._conn.llen(QUEUE_KEY))
+
+
+def _make_queue():
+    try:
+        from django_redis import get_redis_connection
+        return _RedisQueue(get_redis_connection('default'))
+    except Exception:
+        # django-redis not installed or the default cache isn't Redis
+        return _LocalQueue()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def _pending():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = _make_queue()
+    return _queue
+
+
+def enqueue(booking_id, sender_id, message: str) -> Dict[str, object]:
+    """Queue a message for the next flush and return it with its uid and timestamp."""
+    entry = {
+        'uid': str(uuid.uuid4()),
+        'booking_id': booking_id,
+        'sender_id': sender_id,
+        'message': message,
+        'timestamp': timezone.now().isoformat(),
+    }
+    queue = _pending()
+    queue.push(json.dumps(entry))
+    maybe_flush(queue)
+    if not queue.shared and queue.size():
+        _schedule_flush()
+    return entry
+
+
+def _schedule_flush() -> None:
+    """Flush a per-process queue once the interval has passed, if no timer is already waiting."""
+    global _timer
+    with _timer_lock:
+        if _timer is not None and _timer.is_alive():
+            return
+        _timer = threading.Timer(CHAT_FLUSH_INTERVAL, _flush_remainder)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush_remainder() -> None:
+    from django.db import connection
+
+    try:
+        flush_all()
+    except Exception as e:
+        print(f"Chat buffer timed flush failed: {e}")
+    finally:
+        # The timer thread opened its own connection
+        connection.close()
+    if pending_count():
+        # Another flush held the write lock; try again next interval
+        _schedule_flush()
+
+
+def maybe_flush(queue=None) -> int:
+    """Flush if the interval elapsed (cluster-wide) or the backlog is over the limit."""
+    queue = queue or _pending()
+    try:
+        if cache.add(FLUSH_LOCK_KEY, 1, timeout=max(int(CHAT_FLUSH_INTERVAL), 1)):
+            return flush()
+        if queue.size() >= CHAT_BUFFER_MAX_PENDING:
+            return flush()
+    except Exception as e:
+        print(f"Chat buffer flush check failed: {e}")
+    return 0
+
+
+def flush(batch_size: int = CHAT_FLUSH_BATCH_SIZE) -> int:
+    """
+    Write one batch of queued messages. Returns the number of messages taken
+    off the queue, 0 as well when another flush is writing.
+    """
+    if not cache.add(WRITE_LOCK_KEY, 1, timeout=CHAT_WRITE_LOCK_TTL):
+        return 0
+    try:
+        return _write_batch(batch_size)
+    finally:
+        cache.delete(WRITE_LOCK_KEY)
+
+
+def _write_batch(batch_size: int) -> int:
+    from .models import ChatMessage
+
+    queue = _pending()
+    raw = queue.pop(batch_size)
+    if not raw:
+        return 0
+
+    rows = []
+    for item in raw:
+        try:
+            entry = json.loads(item)
+            rows.append(ChatMessage(
+                uid=entry['uid'],
+                booking_id=entry['booking_id'],
+                sender_id=entry['sender_id'],
+                message=entry['message'],
+                timestamp=datetime.fromisoformat(entry['timestamp']),
+            ))
+        except Exception as e:
+            print(f"Dropping malformed chat buffer entry: {e}")
+
+    try:
+        # uid is unique, so re-flushing a batch that partly landed is harmless
+        ChatMessage.objects.bulk_create(rows, ignore_conflicts=True)
+    except Exception as e:
+        queue.push_front(raw)
+        print(f"Chat buffer flush failed: {e}")
+        return 0
+
+    from .history import invalidate
+    invalidate({row.booking_id for row in rows})
+    return len(raw)
+
+
+def flush_all() -> int:
+    """Drain the whole backlog (periodic task)."""
+    total = 0
+    while True:
+        written = flush()
+        if not written:
+            return total
+        total += written
+
+
+def flush_local() -> int:
+    """Drain a per-process queue before reading history; a shared one is left to the worker."""
+    try:
+        if not _pending().shared:
+            return flush_all()
+    except Exception as e:
+        print(f"Chat buffer flush failed: {e}")
+    return 0
+
+
+def pending_count() -> int:
+    try:
+        return _pending().size()
+    except Exception:
+        return 0
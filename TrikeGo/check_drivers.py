@@ -4,14 +4,19 @@ import django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'trikeGo.settings')
 django.setup()
 
+from booking.location_store import get_driver_locations
 from user.models import Driver
 
-drivers = Driver.objects.all()
+drivers = Driver.objects.select_related('user')
 print(f'Total drivers: {drivers.count()}')
 
+# Positions live in the location store (cache, backed by DriverLocation)
+fixes = get_driver_locations(d.user_id for d in drivers)
+
 for d in drivers:
-    lat = d.current_latitude
-    lon = d.current_longitude
+    fix = fixes.get(d.user_id)
+    lat = fix.latitude if fix else None
+    lon = fix.longitude if fix else None
     username = d.user.username if d.user else f'driver_{d.id}'
     
     if lat is None or lon is None:
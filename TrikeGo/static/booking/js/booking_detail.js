@@ -47,18 +47,15 @@
         }
     });
 
-    // Chat polling logic
+    // Chat: pushed over the chat socket (booking/js/chat_socket.js), REST polling only while it is down
     (function() {
-        if (!bookingId) return;
+        if (!bookingId || !window.ChatSocket) return;
         const messagesEl = document.getElementById('chatMessages');
         const chatForm = document.getElementById('chatForm');
         const chatInput = document.getElementById('chatInput');
 
         if (!messagesEl || !chatForm) return;
 
-        const apiGet = `/chat/api/booking/${bookingId}/messages/`;
-        const apiPost = `/chat/api/booking/${bookingId}/messages/send/`;
-
         function escapeHtml(str) {
             return String(str).replace(/[&<>"']/g, function (s) {
                 return ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'})[s];
@@ -71,41 +68,34 @@
             return `<div class="${cls}" style="margin-bottom:6px;"><small style="color:#666">${m.sender_username} • ${new Date(m.timestamp).toLocaleString()}</small><div>${escapeHtml(m.message)}</div></div>`;
         }
 
-        function loadMessages() {
-            fetch(apiGet, { credentials: 'same-origin' })
-                .then(r => { if (!r.ok) throw r; return r.json(); })
-                .then(data => {
-                    messagesEl.innerHTML = '';
-                    if (!data.messages || data.messages.length === 0) {
-                        messagesEl.innerHTML = '<p class="muted">No messages yet.</p>';
-                        return;
-                    }
-                    data.messages.forEach(m => messagesEl.insertAdjacentHTML('beforeend', formatMessage(m)));
-                    messagesEl.scrollTop = messagesEl.scrollHeight;
-                })
-                .catch(err => { console.error('Failed to load messages', err); messagesEl.innerHTML = '<p class="muted">Unable to load messages.</p>'; });
+        function renderMessages(messages) {
+            messagesEl.innerHTML = '';
+            if (!messages.length) {
+                messagesEl.innerHTML = '<p class="muted">No messages yet.</p>';
+                return;
+            }
+            messages.forEach(m => messagesEl.insertAdjacentHTML('beforeend', formatMessage(m)));
+            messagesEl.scrollTop = messagesEl.scrollHeight;
         }
 
-    // Initial load & polling (reduced frequency to lower server load)
-    loadMessages();
-    setInterval(loadMessages, 6000);
+        const chat = new ChatSocket(bookingId, {
+            onMessages: renderMessages,
+            onError: (err) => {
+                console.error('Failed to load messages', err);
+                if (!chat.messages.length) messagesEl.innerHTML = '<p class="muted">Unable to load messages.</p>';
+            },
+        });
 
         chatForm.addEventListener('submit', function(ev) {
             ev.preventDefault();
             const text = (chatInput.value || '').trim();
             if (!text) return;
-            fetch(apiPost, {
-                method: 'POST', credentials: 'same-origin', headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
-                body: JSON.stringify({ message: text })
-            })
-            .then(r => r.json())
-            .then(data => {
-                if (data.error) { alert(data.error); return; }
-                messagesEl.insertAdjacentHTML('beforeend', formatMessage(data));
-                messagesEl.scrollTop = messagesEl.scrollHeight;
-                chatInput.value = '';
-            })
-            .catch(err => { console.error('Send failed', err); alert('Failed to send message.'); });
+            chat.send(text)
+                .then(sent => {
+                    if (!sent) { alert('Failed to send message.'); return; }
+                    chatInput.value = '';
+                })
+                .catch(err => { console.error('Send failed', err); alert('Failed to send message.'); });
         });
     })();
 })();
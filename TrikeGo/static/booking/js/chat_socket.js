@@ -0,0 +1,144 @@
+// Chat client for chat.consumers.ChatConsumer.
+// The newest page of history is fetched over REST when the chat opens; after a reconnect only
+// messages past the last cursor are fetched (?after=<id>). New messages are pushed over the
+// socket. Messages are keyed by uid, so a pushed copy and a fetched copy of the same message
+// collapse into one. REST polling only runs while the socket is down.
+(function(){
+    const FALLBACK_POLL_MS = 6000;
+
+    function readCookie(name) {
+        const match = document.cookie.split(';').map((c) => c.trim()).find((c) => c.startsWith(name + '='));
+        return match ? decodeURIComponent(match.slice(name.length + 1)) : null;
+    }
+
+    class ChatSocket {
+        // handlers: onMessages(messages, added), onError(), onEnded()
+        constructor(bookingId, handlers) {
+            this.bookingId = bookingId;
+            this.handlers = handlers || {};
+            this.messages = [];
+            this.byUid = new Map();
+            this.socket = null;
+            this.closed = false;
+            this.reconnectDelay = 1000;
+            this.fallbackTimer = null;
+            this.cursor = null;
+            this.loading = false;
+            this.load();
+            if ('WebSocket' in window) this.open(); else this.startFallback();
+        }
+
+        isOpen() {
+            return !!(this.socket && this.socket.readyState === WebSocket.OPEN);
+        }
+
+        open() {
+            if (this.closed) return;
+            const proto = window.location.protocol === 'https:' ? 'wss' : 'ws';
+            const socket = new WebSocket(`${proto}://${window.location.host}/ws/chat/${this.bookingId}/`);
+            this.socket = socket;
+            socket.onopen = () => {
+                const reconnected = this.fallbackTimer !== null;
+                this.reconnectDelay = 1000;
+                this.stopFallback();
+                if (reconnected) this.load();
+            };
+            socket.onmessage = (ev) => {
+                let frame = null;
+                try { frame = JSON.parse(ev.data); } catch (e) { return; }
+                if (!frame) return;
+                if (frame.type === 'message') this.add([frame]);
+                if (frame.type === 'closed') {
+                    // The booking completed or was cancelled: chat is over, don't reconnect
+                    this.close();
+                    if (this.handlers.onEnded) this.handlers.onEnded();
+                }
+            };
+            socket.onclose = () => {
+                if (this.socket !== socket) return;
+                this.socket = null;
+                if (this.closed) return;
+                this.startFallback();
+                setTimeout(() => { if (!this.socket) this.open(); }, this.reconnectDelay);
+                this.reconnectDelay = Math.min(this.reconnectDelay * 2, 30000);
+            };
+        }
+
+        close() {
+            this.closed = true;
+            this.stopFallback();
+            if (this.socket) { try { this.socket.close(); } catch (e) {} }
+            this.socket = null;
+        }
+
+        startFallback() {
+            if (this.fallbackTimer === null) this.fallbackTimer = setInterval(() => this.load(), FALLBACK_POLL_MS);
+        }
+
+        stopFallback() {
+            if (this.fallbackTimer !== null) clearInterval(this.fallbackTimer);
+            this.fallbackTimer = null;
+        }
+
+        async load() {
+            if (this.loading) return;
+            this.loading = true;
+            try {
+                let more = true;
+                while (more && !this.closed) {
+                    const query = this.cursor !== null ? `?after=${this.cursor}` : '';
+                    const res = await fetch(`/chat/api/booking/${this.bookingId}/messages/${query}`, { credentials: 'same-origin' });
+                    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+                    const data = await res.json();
+                    if (this.closed) return;
+                    const initial = this.cursor === null;
+                    if (data.cursor !== null && data.cursor !== undefined) this.cursor = data.cursor;
+                    this.add(data.messages || [], initial);
+                    // The first page is the newest one; older history isn't needed to catch up
+                    more = !initial && !!data.has_more;
+                }
+            } catch (e) {
+                if (this.handlers.onError) this.handlers.onError(e);
+            } finally {
+                this.loading = false;
+            }
+        }
+
+        add(list, initial) {
+            const added = [];
+            list.forEach((m) => {
+                const key = m.uid || `id:${m.id}`;
+                const known = this.byUid.get(key);
+                if (known) {
+                    if (m.id && !known.id) known.id = m.id;
+                    return;
+                }
+                this.byUid.set(key, m);
+                this.messages.push(m);
+                added.push(m);
+            });
+            if (!added.length && !(initial && !this.messages.length)) return;
+            this.messages.sort((a, b) => new Date(a.timestamp) - new Date(b.timestamp));
+            if (this.handlers.onMessages) this.handlers.onMessages(this.messages, added);
+        }
+
+        // Resolves to true once the message is on its way; the pushed copy renders it.
+        async send(text) {
+            if (this.isOpen()) {
+                this.socket.send(JSON.stringify({ message: text }));
+                return true;
+            }
+            const res = await fetch(`/chat/api/booking/${this.bookingId}/messages/send/`, {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: { 'Content-Type': 'application/json', 'X-CSRFToken': readCookie('csrftoken') },
+                body: JSON.stringify({ message: text }),
+            });
+            if (!res.ok) return false;
+            this.add([await res.json()]);
+            return true;
+        }
+    }
+
+    window.ChatSocket = ChatSocket;
+})();
@@ -39,6 +39,8 @@
     let currentStopIndex = 0;
     let itineraryExpanded = false;
     let itineraryTimer = null;
+    // Itinerary versions are pushed over ws/tracking/driver/; polling is only a fallback
+    let trackingSocket = null;
     let itineraryMarkers = [];
     let itineraryRouteLayer = null;
     let itineraryRouteSignature = null;
@@ -157,7 +159,28 @@
         }
 
         fetchItineraryData();
-        itineraryTimer = setInterval(fetchItineraryData, 12000);
+        openTrackingSocket();
+        scheduleItineraryPolling();
+    }
+
+    function scheduleItineraryPolling() {
+        if (itineraryTimer) clearInterval(itineraryTimer);
+        const pushed = trackingSocket && trackingSocket.isOpen();
+        itineraryTimer = setInterval(fetchItineraryData, pushed ? 60000 : 12000);
+    }
+
+    function openTrackingSocket() {
+        if (typeof window.TrackingSocket !== 'function') return;
+        trackingSocket = new window.TrackingSocket('/ws/tracking/driver/', {
+            onOpen: scheduleItineraryPolling,
+            onClose: scheduleItineraryPolling,
+            onChange: (state, changed) => {
+                const known = itineraryData && itineraryData.version;
+                if ((changed.includes('i') || changed.includes('x')) && state.i && state.i !== known) {
+                    fetchItineraryData();
+                }
+            },
+        });
     }
 
     function toggleItinerary(expand) {
@@ -785,6 +808,11 @@
                 throw new Error(`Status ${response.status}`);
             }
             const payload = await response.json();
+            if (payload && payload.status === 'pending') {
+                // First itinerary is still being built in the background
+                setTimeout(fetchItineraryData, 3000);
+                return;
+            }
             if (!payload || payload.status !== 'success') {
                 throw new Error('Invalid itinerary payload');
             }
@@ -875,37 +903,17 @@
             `; document.body.appendChild(modal);
         }
 
-        let _driverChatBookingId = null; let _driverChatPolling = null;
-        function getCookie(name) { let cookieValue = null; if (document.cookie && document.cookie !== '') { const cookies = document.cookie.split(';'); for (let i = 0; i < cookies.length; i++) { const cookie = cookies[i].trim(); if (cookie.substring(0, name.length + 1) === (name + '=')) { cookieValue = decodeURIComponent(cookie.substring(name.length + 1)); break; } } } return cookieValue; }
-
-        async function loadDriverMessages() {
-            if (!_driverChatBookingId) {
-                return;
-            }
+        let _driverChatBookingId = null; let _driverChatSocket = null;
 
+        function showDriverChatError() {
             const container = document.getElementById('driverChatMessages');
-            let response;
-            try {
-                response = await fetch(`/chat/api/booking/${_driverChatBookingId}/messages/`, { credentials: 'same-origin' });
-            } catch (fetchErr) {
-                container.innerHTML = '<p class="muted">Unable to load messages.</p>';
-                return;
-            }
-
-            if (!response.ok) {
-                container.innerHTML = '<p class="muted">Unable to load messages.</p>';
-                return;
-            }
-
-            let payload;
-            try {
-                payload = await response.json();
-            } catch (parseErr) {
+            if (container && !(_driverChatSocket && _driverChatSocket.messages.length)) {
                 container.innerHTML = '<p class="muted">Unable to load messages.</p>';
-                return;
             }
+        }
 
-            const messages = Array.isArray(payload.messages) ? payload.messages : [];
+        function renderDriverMessages(messages) {
+            const container = document.getElementById('driverChatMessages');
             if (!messages.length) {
                 container.innerHTML = '<p class="muted">No messages yet.</p>';
                 const titleEl = document.getElementById('driverChatTitle');
@@ -982,23 +990,29 @@
             if (titleEl) {
                 titleEl.textContent = 'Trip Chat';
             }
-            loadDriverMessages();
-            _driverChatPolling = setInterval(loadDriverMessages, 6000);
+            // Messages are pushed over the chat socket; ChatSocket falls back to polling only while it is down
+            if (_driverChatSocket && _driverChatSocket.bookingId !== _driverChatBookingId) {
+                _driverChatSocket.close();
+                _driverChatSocket = null;
+            }
+            if (!_driverChatSocket) {
+                _driverChatSocket = new ChatSocket(_driverChatBookingId, { onMessages: renderDriverMessages, onError: showDriverChatError });
+            }
         }
 
         function closeDriverChatModal() {
             const el = document.getElementById('driverChatModal');
             el.style.display = 'none';
             _driverChatBookingId = null;
-            if (_driverChatPolling) {
-                clearInterval(_driverChatPolling);
-                _driverChatPolling = null;
+            if (_driverChatSocket) {
+                _driverChatSocket.close();
+                _driverChatSocket = null;
             }
         }
 
         // Attach events
         document.getElementById('driverChatClose').addEventListener('click', (e) => { e.preventDefault(); closeDriverChatModal(); });
-        document.getElementById('driverChatForm').addEventListener('submit', async (e) => { e.preventDefault(); if (!_driverChatBookingId) return; const txt = (document.getElementById('driverChatInput').value || '').trim(); if (!txt) return; const res = await fetch(`/chat/api/booking/${_driverChatBookingId}/messages/send/`, { method:'POST', credentials:'same-origin', headers: { 'Content-Type':'application/json','X-CSRFToken': getCookie('csrftoken') }, body: JSON.stringify({ message: txt }) }); if (!res.ok) { alert('Failed to send'); return; } document.getElementById('driverChatInput').value = ''; loadDriverMessages(); });
+        document.getElementById('driverChatForm').addEventListener('submit', async (e) => { e.preventDefault(); if (!_driverChatBookingId) return; const txt = (document.getElementById('driverChatInput').value || '').trim(); if (!txt) return; if (!_driverChatSocket) return; const sent = await _driverChatSocket.send(txt); if (!sent) { alert('Failed to send'); return; } document.getElementById('driverChatInput').value = ''; });
 
         // Expose open function for sidebar button
         window.openDriverChatModal = openDriverChatModal;
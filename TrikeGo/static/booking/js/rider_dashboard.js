@@ -41,12 +41,16 @@
         }
         async search(query) {
             try {
-                const params = new URLSearchParams({ api_key: ORS_API_KEY, text: query, size: 10, 'boundary.country': 'PH' });
-                const url = `https://api.openrouteservice.org/geocode/search?${params.toString()}`;
-                const response = await fetch(url);
+                // Server-side autocomplete (booking.geocoding), ranked by distance from the map centre
+                const params = new URLSearchParams({ q: query });
+                try { if (window.map) { const center = window.map.getCenter(); params.set('lat', center.lat); params.set('lon', center.lng); } } catch(e){}
+                const response = await fetch(`/booking/api/geocode/?${params.toString()}`, { credentials: 'same-origin' });
                 const data = await response.json();
-                let features = data.features || [];
-                try { if (window.map) { const center = window.map.getCenter(); features.forEach(f => { const [lon, lat] = f.geometry.coordinates; f.__distance = window.map.distance(center, L.latLng(lat, lon)); }); features.sort((a,b) => (a.__distance||0) - (b.__distance||0)); } } catch(e){}
+                const features = (data.results || []).map((r) => ({
+                    geometry: { coordinates: [r.lon, r.lat] },
+                    properties: { label: r.label, name: r.name },
+                    __distance: r.distance_m,
+                }));
                 this.displayResults(features);
             } catch (error) {
                 console.error('Autocomplete API error:', error);
@@ -80,7 +84,7 @@
 
     // Chat modal helpers (rider)
     let _chatModalBookingId = null;
-    let _chatModalPolling = null;
+    let _chatModalSocket = null;
     const chatModal = document.getElementById('chatModal');
     const chatModalMessages = document.getElementById('chatModalMessages');
     const chatModalForm = document.getElementById('chatModalForm');
@@ -88,32 +92,23 @@
     const chatModalTitle = document.getElementById('chatModalTitle');
     const chatModalClose = document.getElementById('chatModalClose');
 
-    function getCookie(name) {
-        let cookieValue = null;
-        if (document.cookie && document.cookie !== '') {
-            const cookies = document.cookie.split(';');
-            for (let i = 0; i < cookies.length; i++) {
-                const cookie = cookies[i].trim();
-                if (cookie.substring(0, name.length + 1) === (name + '=')) { cookieValue = decodeURIComponent(cookie.substring(name.length + 1)); break; }
-            }
-        }
-        return cookieValue;
-    }
-
     function openChatModal(bookingId) {
-        _chatModalBookingId = bookingId;
         if (!chatModal) return;
+        if (_chatModalSocket && _chatModalBookingId !== bookingId) { _chatModalSocket.close(); _chatModalSocket = null; }
+        _chatModalBookingId = bookingId;
         chatModal.style.display = 'block';
         chatModal.scrollIntoView({ behavior: 'smooth' });
         if (chatModalTitle) chatModalTitle.textContent = `Chat (Booking ${bookingId})`;
-        loadModalMessages();
-    if (!_chatModalBookingId) return;
-    if (window._chatModalPolling) clearInterval(window._chatModalPolling);
-    // Poll less often for chat; consider switching to WebSockets (Channels) in production
-    window._chatModalPolling = setInterval(loadModalMessages, 6000);
+        // Messages are pushed over the chat socket; ChatSocket falls back to polling only while it is down
+        if (!_chatModalSocket) {
+            _chatModalSocket = new ChatSocket(bookingId, {
+                onMessages: renderModalMessages,
+                onError: () => { if (chatModalMessages && !_chatModalSocket.messages.length) chatModalMessages.innerHTML = '<p class="muted">Unable to load messages.</p>'; },
+            });
+        }
     }
 
-    function closeChatModal() { if (!chatModal) return; chatModal.style.display = 'none'; _chatModalBookingId = null; if (window._chatModalPolling) { clearInterval(window._chatModalPolling); window._chatModalPolling = null; } }
+    function closeChatModal() { if (!chatModal) return; chatModal.style.display = 'none'; _chatModalBookingId = null; if (_chatModalSocket) { _chatModalSocket.close(); _chatModalSocket = null; } }
 
     // ORS / routing rate-limit guard and previous-coords cache to avoid excessive routing requests
     let _orsRateLimitedUntil = 0;
@@ -122,14 +117,12 @@
     let _lastDTData = null;
     let _lastRDData = null;
 
-    async function loadModalMessages() {
-        if (!_chatModalBookingId || !chatModalMessages) return;
-        const res = await fetch(`/chat/api/booking/${_chatModalBookingId}/messages/`, { credentials: 'same-origin' });
-        if (!res.ok) { chatModalMessages.innerHTML = '<p class="muted">Unable to load messages.</p>'; return; }
-        const data = await res.json(); chatModalMessages.innerHTML = '';
-        if (!data.messages || data.messages.length === 0) { chatModalMessages.innerHTML = '<p class="muted">No messages yet.</p>'; return; }
+    function renderModalMessages(messages) {
+        if (!chatModalMessages) return;
+        chatModalMessages.innerHTML = '';
+        if (!messages || messages.length === 0) { chatModalMessages.innerHTML = '<p class="muted">No messages yet.</p>'; return; }
         let lastDate = null;
-        data.messages.forEach(m => {
+        messages.forEach(m => {
             const msgDate = new Date(m.timestamp).toDateString();
             if (msgDate !== lastDate) { const sep = document.createElement('div'); sep.className = 'chat-date-sep'; sep.textContent = new Date(m.timestamp).toLocaleDateString(undefined, { weekday: 'short', month: 'short', day: 'numeric' }); chatModalMessages.appendChild(sep); lastDate = msgDate; }
             const div = document.createElement('div'); const own = (m.sender_id == userId); div.className = own ? 'chat-msg-own' : 'chat-msg-other'; div.innerHTML = `<div class="chat-msg-meta">${m.sender_username} • ${new Date(m.timestamp).toLocaleTimeString()}</div><div>${escapeHtml(m.message)}</div>`; chatModalMessages.appendChild(div);
@@ -141,9 +134,10 @@
 
     if (chatModalForm) chatModalForm.addEventListener('submit', async (e) => {
         e.preventDefault(); if (!_chatModalBookingId) return; const text = (chatModalInput.value || '').trim(); if (!text) return;
-        const res = await fetch(`/chat/api/booking/${_chatModalBookingId}/messages/send/`, { method: 'POST', credentials: 'same-origin', headers: { 'Content-Type': 'application/json', 'X-CSRFToken': getCookie('csrftoken') }, body: JSON.stringify({ message: text }) });
-        if (!res.ok) { alert('Failed to send message'); return; }
-        chatModalInput.value = ''; loadModalMessages();
+        if (!_chatModalSocket) return;
+        const sent = await _chatModalSocket.send(text);
+        if (!sent) { alert('Failed to send message'); return; }
+        chatModalInput.value = '';
     });
 
     // Export small helpers used by other pieces of UI
@@ -180,6 +174,7 @@
                 }
                 try { window.map.setView(latLng, 16); } catch(e){}
             } catch(e) { console.warn('setPickupInputMarker failed', e); }
+            requestQuote();
         }
 
         function setDestinationInputMarker(lat, lon, label) {
@@ -194,6 +189,44 @@
                 }
                 try { window.map.setView(latLng, 16); } catch(e){}
             } catch(e) { console.warn('setDestinationInputMarker failed', e); }
+            requestQuote();
+        }
+
+        // Quote (booking.quotes): priced once both points are set, so submitting the form doesn't wait on routing
+        let quoteTimer = null;
+        let quoteSeq = 0;
+        function requestQuote() {
+            const quoteField = document.getElementById('id_quote_id');
+            const summary = document.getElementById('quote-summary');
+            if (!quoteField) return;
+            quoteField.value = '';
+            const values = ['id_pickup_latitude', 'id_pickup_longitude', 'id_destination_latitude', 'id_destination_longitude']
+                .map((id) => parseFloat(document.getElementById(id)?.value));
+            if (values.some((v) => Number.isNaN(v))) { if (summary) summary.textContent = ''; return; }
+            clearTimeout(quoteTimer);
+            quoteTimer = setTimeout(async () => {
+                const seq = ++quoteSeq;
+                try {
+                    const res = await fetch('/booking/api/quote/', {
+                        method: 'POST',
+                        credentials: 'same-origin',
+                        headers: { 'Content-Type': 'application/json', 'X-CSRFToken': csrfToken },
+                        body: JSON.stringify({
+                            pickup_latitude: values[0], pickup_longitude: values[1],
+                            destination_latitude: values[2], destination_longitude: values[3],
+                        }),
+                    });
+                    if (seq !== quoteSeq) return;
+                    if (!res.ok) { if (summary) summary.textContent = ''; return; }
+                    const quote = await res.json();
+                    quoteField.value = quote.quote_id || '';
+                    if (summary) {
+                        summary.textContent = quote.fare
+                            ? `Estimated fare: ₱${Number(quote.fare).toFixed(2)} · ${Number(quote.distance_km).toFixed(1)} km · ${quote.duration_min} min`
+                            : '';
+                    }
+                } catch (e) { console.warn('Quote request failed', e); }
+            }, 400);
         }
 
         try { new ORSAutocomplete('pickup_location_input', 'pickup-results', 'id_pickup_latitude', 'id_pickup_longitude', (lat, lon) => { try { window.map.setView([lat, lon], 16); setPickupInputMarker(lat, lon); } catch(e){} }); } catch(e){}
@@ -233,16 +266,14 @@
         try {
             if (window.map) {
                 async function reverseGeocodeAndFill(lat, lon) {
-                    const key = ORS_API_KEY || (window.RIDER_DASH_CONFIG && window.RIDER_DASH_CONFIG.ORS_API_KEY) || '';
-                    if (!key) return null;
-                    const url = `https://api.openrouteservice.org/geocode/reverse?api_key=${encodeURIComponent(key)}&point.lat=${encodeURIComponent(lat)}&point.lon=${encodeURIComponent(lon)}&size=1`;
+                    const url = `/booking/api/geocode/reverse/?lat=${encodeURIComponent(lat)}&lon=${encodeURIComponent(lon)}`;
                     try {
-                        const res = await fetch(url);
+                        const res = await fetch(url, { credentials: 'same-origin' });
                         if (!res.ok) return null;
                         const data = await res.json();
-                        const feat = (data.features && data.features[0]) ? data.features[0] : null;
-                        const label = feat?.properties?.label || feat?.properties?.name || null;
-                        return label ? { label, props: feat.properties } : null;
+                        const place = data.result || null;
+                        const label = place?.formatted || place?.name || null;
+                        return label ? { label, props: place } : null;
                     } catch (e) { console.warn('Reverse geocode failed', e); return null; }
                 }
 
@@ -289,6 +320,10 @@
         let initialRouteLoadDone = false;
         let stopMarkers = [];
         let currentTrackedBookingId = null;
+        // Server push (booking.consumers.TrackingConsumer); polling is only a fallback while it's down
+        let trackingSocket = null;
+        let trackingSocketBookingId = null;
+        let trackingRefreshTimer = null;
 
         function clearItineraryRouteLayer() {
             if (itineraryRouteLayer && window.map) {
@@ -752,9 +787,61 @@
                         } catch(e) { console.warn('startTracking UI update failed', e); }
 
                         updateAll(bookingId);
-                        if (trackingInterval) clearInterval(trackingInterval);
-                        // Poll less aggressively to avoid hitting ORS rate limits; update route every 12s
-                        trackingInterval = setInterval(() => updateAll(bookingId), 12000);
+                        openTrackingSocket(bookingId);
+                        schedulePolling(bookingId);
+            }
+
+            function trackingSocketOpen() {
+                return !!(trackingSocket && trackingSocket.isOpen());
+            }
+
+            function schedulePolling(bookingId) {
+                if (trackingInterval) clearInterval(trackingInterval);
+                // Pushed updates make polling a slow safety net; without them poll every 12s (ORS rate limits)
+                const interval = trackingSocketOpen() ? 60000 : 12000;
+                trackingInterval = setInterval(() => updateAll(bookingId), interval);
+            }
+
+            function scheduleTrackingRefresh(bookingId) {
+                // Coalesce bursts of status/ETA/itinerary changes into one route_info fetch
+                if (trackingRefreshTimer) return;
+                trackingRefreshTimer = setTimeout(() => { trackingRefreshTimer = null; updateAll(bookingId); }, 500);
+            }
+
+            function handleTrackingChange(bookingId, state, changed) {
+                if (changed.includes('p') && driverMarker && trackingSocket) {
+                    const pos = trackingSocket.position();
+                    if (pos) driverMarker.setLatLng(pos);
+                }
+                if (changed.includes('st') || changed.includes('dr')) {
+                    const status = String(state.st || '');
+                    if (['accepted', 'on_the_way', 'started'].includes(status) && currentTrackedBookingId !== bookingId) {
+                        startTracking(bookingId);
+                        return;
+                    }
+                }
+                // Position-only deltas are handled above; anything else needs fresh route info
+                if (changed.some((k) => !['p', 'h', 'v'].includes(k))) {
+                    scheduleTrackingRefresh(bookingId);
+                }
+            }
+
+            function openTrackingSocket(bookingId) {
+                if (typeof window.TrackingSocket !== 'function') return;
+                bookingId = String(bookingId);
+                if (trackingSocket && trackingSocketBookingId === bookingId) return;
+                if (trackingSocket) trackingSocket.close();
+                trackingSocketBookingId = bookingId;
+                let initial = true;
+                trackingSocket = new window.TrackingSocket(`/ws/tracking/booking/${bookingId}/`, {
+                    onOpen: () => { initial = true; if (currentTrackedBookingId === bookingId) schedulePolling(bookingId); },
+                    onClose: () => { if (currentTrackedBookingId === bookingId) schedulePolling(bookingId); },
+                    onChange: (state, changed) => {
+                        // The connect keyframe mirrors what updateAll just fetched
+                        if (initial) { initial = false; return; }
+                        handleTrackingChange(bookingId, state, changed);
+                    },
+                });
             }
 
             // Booking preview and tracking boot
@@ -818,8 +905,8 @@
                             if (previewCard) { previewCard.style.display = 'block'; previewCard.setAttribute('aria-hidden','false'); }
                             // hide booking panel
                             try { document.body.classList.add('booking-active'); const bookingPanel = document.querySelector('.dashboard-booking-card'); if (bookingPanel) bookingPanel.style.display = 'none'; } catch(e){}
-                            // draw preview route once
-                            try { updateAll(bookingId); } catch(e){}
+                            // draw preview route once; acceptance arrives over the tracking socket
+                            try { updateAll(bookingId); openTrackingSocket(bookingId); } catch(e){}
                         }
                     }
                 }
@@ -828,6 +915,8 @@
             // Automatic refresh: poll booking items for status/assignment changes so rider doesn't need to refresh
             try {
                 async function pollBookingItems() {
+                    // Status changes for the subscribed booking are pushed
+                    if (trackingSocketOpen()) return;
                     try {
                         const items = document.querySelectorAll('.booking-item');
                         if (!items || items.length === 0) return;
@@ -0,0 +1,101 @@
+// Tracking socket client for booking.consumers.TrackingConsumer.
+// Frames follow booking/tracking_protocol.py: a keyframe ("t":"k") with the full state, then
+// deltas ("t":"d") with only the changed fields. Sequence gaps trigger a resync ({"t":"r"}).
+(function(){
+    const POSITION_SCALE = 100000;
+
+    function sameValue(a, b) {
+        return JSON.stringify(a) === JSON.stringify(b);
+    }
+
+    class TrackingSocket {
+        // handlers: onChange(state, changedKeys), onOpen(), onClose()
+        constructor(path, handlers) {
+            this.path = path;
+            this.handlers = handlers || {};
+            this.state = {};
+            this.seq = null;
+            this.socket = null;
+            this.closed = false;
+            this.reconnectDelay = 1000;
+            this.open();
+        }
+
+        isOpen() {
+            return !!(this.socket && this.socket.readyState === WebSocket.OPEN);
+        }
+
+        open() {
+            if (!('WebSocket' in window) || this.closed) return;
+            const proto = window.location.protocol === 'https:' ? 'wss' : 'ws';
+            const socket = new WebSocket(`${proto}://${window.location.host}${this.path}`);
+            this.socket = socket;
+            socket.onopen = () => {
+                this.reconnectDelay = 1000;
+                if (this.handlers.onOpen) this.handlers.onOpen();
+            };
+            socket.onmessage = (ev) => {
+                let frame = null;
+                try { frame = JSON.parse(ev.data); } catch (e) { return; }
+                if (frame && frame.t) this.feed(frame);
+            };
+            socket.onclose = () => {
+                if (this.socket !== socket) return;
+                this.socket = null;
+                this.seq = null;
+                if (this.handlers.onClose) this.handlers.onClose();
+                if (this.closed) return;
+                setTimeout(() => { if (!this.socket) this.open(); }, this.reconnectDelay);
+                this.reconnectDelay = Math.min(this.reconnectDelay * 2, 30000);
+            };
+        }
+
+        close() {
+            this.closed = true;
+            if (this.socket) { try { this.socket.close(); } catch (e) {} }
+            this.socket = null;
+        }
+
+        resync() {
+            this.seq = null;
+            if (this.isOpen()) this.socket.send(JSON.stringify({ t: 'r' }));
+        }
+
+        feed(frame) {
+            const previous = this.state;
+            let next;
+            if (frame.t === 'k') {
+                next = {};
+                Object.keys(frame).forEach((k) => { if (k !== 't' && k !== 's') next[k] = frame[k]; });
+            } else if (frame.t === 'd') {
+                if (this.seq === null) return;  // waiting for the resync keyframe
+                if (frame.s !== this.seq + 1) { this.resync(); return; }
+                next = Object.assign({}, previous);
+                Object.keys(frame).forEach((k) => {
+                    if (k === 't' || k === 's') return;
+                    if (k === 'p' && Array.isArray(previous.p)) {
+                        next.p = [previous.p[0] + frame.p[0], previous.p[1] + frame.p[1]];
+                    } else if (k === 'x' && previous.x) {
+                        next.x = Object.assign({}, previous.x, frame.x);
+                    } else {
+                        next[k] = frame[k];
+                    }
+                });
+            } else {
+                return;
+            }
+            this.seq = frame.s;
+            this.state = next;
+            const keys = new Set(Object.keys(previous).concat(Object.keys(next)));
+            const changed = Array.from(keys).filter((k) => !sameValue(previous[k], next[k]));
+            if (changed.length && this.handlers.onChange) this.handlers.onChange(next, changed);
+        }
+
+        position() {
+            const p = this.state.p;
+            return Array.isArray(p) ? [p[0] / POSITION_SCALE, p[1] / POSITION_SCALE] : null;
+        }
+    }
+
+    window.TrackingSocket = TrackingSocket;
+})();
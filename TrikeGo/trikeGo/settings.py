@@ -137,10 +137,36 @@ if REDIS_URL:
     except Exception:
         # If channels_redis isn't available in the environment, do nothing.
         CHANNEL_LAYERS = {}
+else:
+    # Single-process development: tracking and chat pushes stay within this worker
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
 # Celery broker: prefer explicit env var, otherwise use Redis URL when available
 CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL') or REDIS_URL or 'redis://localhost:6379/0'
 
+# Drain the driver location and chat buffers on a fixed cadence when celery beat runs.
+# With Redis the buffers are shared and only the worker writes them; without Redis
+# (or without a broker) each process flushes its own buffer, so beat is optional in
+# development.
+CELERY_BEAT_SCHEDULE = {
+    'flush-driver-locations': {
+        'task': 'booking.tasks.flush_driver_locations',
+        'schedule': float(os.environ.get('LOCATION_FLUSH_INTERVAL', 5)),
+    },
+    'flush-chat-messages': {
+        'task': 'chat.tasks.flush_chat_messages',
+        'schedule': float(os.environ.get('CHAT_FLUSH_INTERVAL', 1)),
+    },
+    'prune-route-snapshots': {
+        'task': 'booking.tasks.prune_route_snapshots',
+        'schedule': float(os.environ.get('ROUTE_RETENTION_INTERVAL', 60 * 60)),
+    },
+}
+
 AUTH_USER_MODEL = "user.CustomUser"
 LOGIN_URL = 'user:landing'
 
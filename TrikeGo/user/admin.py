@@ -51,10 +51,6 @@ class DriverAdmin(admin.ModelAdmin):
         ('Employment', {
             'fields': ('date_hired', 'years_of_service')
         }),
-        ('Location', {
-            'fields': ('current_latitude', 'current_longitude'),
-            'classes': ('collapse',)
-        }),
     )
     
     def license_image_link(self, obj):
@@ -61,6 +61,8 @@ class Driver(models.Model):
     # longest choice value is 'In_trip' (7 chars) so max_length can be small but keep 16 for safety.
     status = models.CharField(max_length=16, choices=STATUS_CHOICES, default='Offline')
     is_verified = models.BooleanField(default=False)
+    # Legacy position columns, no longer written. Driver positions are served by
+    # booking.location_store (backed by booking.DriverLocation).
     current_latitude = models.DecimalField(max_digits=18, decimal_places=15, null=True, blank=True)
     current_longitude = models.DecimalField(max_digits=18, decimal_places=15, null=True, blank=True)
 
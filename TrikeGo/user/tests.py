@@ -1,3 +1,174 @@
+from datetime import date
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+
+from booking import cache_keys, itinerary, location_buffer, route_info
+from booking.models import Booking
+from booking.route_cache import route_cache
+from booking.tasks import compute_and_cache_route
+from booking.utils import ensure_booking_stops
+from user.models import CustomUser, Driver, Rider, Tricycle
+
+
+class RouteInfoQueryBudgetTest(TestCase):
+    # Session, user, booking with users and profiles, stops, tricycles, active route
+    QUERY_BUDGET = 6
+    # No driver yet, so no tricycle prefetch
+    PREVIEW_BUDGET = 5
+
+    def setUp(self):
+        location_buffer._dirty = None
+
+        self.driver = CustomUser.objects.create_user(username='drv-route', password='pass', trikego_user='D',
+                                                     first_name='Ben', last_name='Cruz')
+        profile = Driver.objects.create(user=self.driver, license_number='N01-23-4567', license_expiry=date(2030, 1, 1),
+                                        date_hired=date(2024, 1, 1), years_of_service=1, is_verified=True)
+        Tricycle.objects.create(driver=profile, plate_number='ABC 123', color='Blue', max_capacity=3)
+        self.riders = []
+        self.bookings = []
+        for i in range(3):
+            self._add_passenger(i)
+        self._warm()
+
+    def _warm(self):
+        cache.clear()
+        cache.set('celery_broker_unavailable', 1, timeout=None)
+        cache.add(location_buffer.FLUSH_LOCK_KEY, 1, timeout=60)
+        location_buffer.record_fix(self.driver.id, 10.2950, 123.8950)
+        # Warm itinerary, as after any booking event
+        version = itinerary.current_version(self.driver.id)
+        cache.set(itinerary._payload_key(self.driver.id, version), {'itinerary': {'version': version, 'stops': []}})
+
+    def _add_passenger(self, i, status='accepted', driver=True):
+        rider = CustomUser.objects.create_user(username=f'rdr-route-{i}', password='pass', trikego_user='R')
+        Rider.objects.create(user=rider, current_latitude=10.3, current_longitude=123.9)
+        booking = Booking.objects.create(
+            rider=rider, driver=self.driver if driver else None, status=status, fare=50,
+            pickup_address=f'Pickup {i}', pickup_latitude=10.3000 + i * 0.001, pickup_longitude=123.9000,
+            destination_address=f'Drop {i}', destination_latitude=10.3200, destination_longitude=123.9200 + i * 0.001,
+        )
+        self.riders.append(rider)
+        self.bookings.append(booking)
+        return booking
+
+    def _get(self, user, booking, budget=QUERY_BUDGET):
+        self.client.force_login(user)
+        with mock.patch('booking.services.RoutingService.calculate_route', side_effect=AssertionError('ORS call')):
+            with self.assertNumQueries(budget):
+                response = self.client.get(reverse('user:get_route_info', args=[booking.id]))
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_rider_on_shared_trip_within_budget(self):
+        # Stops exist, as they do once a booking is accepted
+        for booking in self.bookings:
+            ensure_booking_stops(booking)
+
+        data = self._get(self.riders[0], self.bookings[0])
+        self.assertEqual(data['driver']['name'], 'Ben Cruz')
+        self.assertEqual(data['driver']['plate'], 'ABC 123')
+        self.assertEqual(data['tricycle']['color'], 'Blue')
+        self.assertEqual([s['type'] for s in data['stops']], ['PICKUP', 'DROPOFF'])
+        self.assertEqual(data['itinerary']['stops'], [])
+        self.assertEqual(data['fare'], 50.0)
+
+        # More passengers on the trip don't add queries
+        for i in range(3, 8):
+            ensure_booking_stops(self._add_passenger(i))
+        self._warm()
+        self._get(self.riders[1], self.bookings[1])
+        self._get(self.driver, self.bookings[2])
+
+    def test_preview_route_comes_from_the_route_cache(self):
+        pending = self._add_passenger(9, status='pending', driver=False)
+        ensure_booking_stops(pending)
+        route_cache.set((123.9, 10.309), (123.929, 10.32), {
+            'route_data': None, 'distance': 3.4, 'duration': 480, 'too_close': False,
+        })
+
+        data = self._get(self.riders[-1], pending, budget=self.PREVIEW_BUDGET)
+        self.assertIsNone(data['driver'])
+        self.assertEqual(data['route_payload']['distance'], 3.4)
+        self.assertEqual(data['pickup_to_destination_km'], 3.4)
+
+    def test_other_riders_cannot_read_a_booking(self):
+        self.client.force_login(self.riders[1])
+        response = self.client.get(reverse('user:get_route_info', args=[self.bookings[0].id]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_cancel_is_visible_despite_cached_payload(self):
+        ensure_booking_stops(self.bookings[0])
+        self.client.force_login(self.riders[0])
+        url = reverse('user:get_route_info', args=[self.bookings[0].id])
+        self.assertEqual(self.client.get(url).json()['driver']['name'], 'Ben Cruz')
+        # Cached now
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('user:cancel_booking', args=[self.bookings[0].id]))
+        data = self.client.get(url).json()
+        self.assertEqual(data['booking_status'], 'pending')
+        self.assertIsNone(data['driver'])
+
+    def test_pings_keep_the_cache_and_update_the_position(self):
+        self.client.force_login(self.riders[0])
+        url = reverse('user:get_route_info', args=[self.bookings[0].id])
+        self.assertEqual(self.client.get(url).json()['driver_lat'], 10.295)
+
+        location_buffer.record_fix(self.driver.id, 10.2990, 123.8990)
+        with self.assertNumQueries(3):
+            data = self.client.get(url).json()
+        self.assertEqual((data['driver_lat'], data['driver_lon']), (10.299, 123.899))
+        self.assertEqual((data['driver']['lat'], data['driver']['lon']), (10.299, 123.899))
+
+    def test_expired_payload_is_served_stale_while_one_task_refreshes(self):
+        ensure_booking_stops(self.bookings[0])
+        self.client.force_login(self.riders[0])
+        url = reverse('user:get_route_info', args=[self.bookings[0].id])
+        self.client.get(url)
+        key = route_info.response_cache_key(self.bookings[0], self.riders[0])
+        entry = cache.get(key)
+        entry['fresh_until'] = 0
+        cache.set(key, entry)
+
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            for _ in range(3):
+                with self.assertNumQueries(3):
+                    self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(enqueue.call_count, 1)
+        self.assertEqual(enqueue.call_args.args[1:], (self.bookings[0].id, self.riders[0].id))
+
+        # What the queued task does
+        with mock.patch('booking.services.RoutingService.calculate_route', return_value=None):
+            self.assertTrue(compute_and_cache_route(self.bookings[0].id, self.riders[0].id))
+        self.assertGreater(cache.get(key)['fresh_until'], 0)
+
+    def test_previous_version_is_served_stale_after_a_driver_write(self):
+        ensure_booking_stops(self.bookings[0])
+        self.client.force_login(self.riders[0])
+        url = reverse('user:get_route_info', args=[self.bookings[0].id])
+        self.client.get(url)
+        cache_keys.bump_driver(self.driver.id)
+
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            for _ in range(3):
+                with self.assertNumQueries(3):
+                    self.assertEqual(self.client.get(url).json()['driver']['name'], 'Ben Cruz')
+        self.assertEqual(enqueue.call_count, 1)
+
+    def test_booking_write_is_never_served_stale(self):
+        self.client.force_login(self.riders[0])
+        url = reverse('user:get_route_info', args=[self.bookings[0].id])
+        self.assertEqual(self.client.get(url).json()['booking_status'], 'accepted')
 
-# Create your tests here.
+        booking = Booking.objects.get(pk=self.bookings[0].pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            booking.status = 'cancelled'
+            booking.save()
+        with mock.patch('booking.tasks.enqueue', return_value=True) as enqueue:
+            self.assertEqual(self.client.get(url).json()['booking_status'], 'cancelled')
+        enqueue.assert_not_called()
@@ -14,12 +14,11 @@ from datetime import date
 from booking.models import Booking
 import json
 from django.http import JsonResponse
-from django.core.cache import cache
 import os
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from booking.services import RoutingService
-from booking.models import DriverLocation
+from booking import location_store, quotes, route_info
 from datetime import timedelta
 from django.conf import settings
 from decimal import Decimal
@@ -30,10 +29,14 @@ from booking.utils import (
     seats_available,
     pickup_within_detour,
     ensure_booking_stops,
-    build_driver_itinerary,
 )
 from booking.forms import RatingForm
 from booking.models import RatingAndFeedback
+from booking.spatial_index import pending_bookings_near_driver
+from booking.location_buffer import record_fix
+
+# Pending pickups farther than this from the driver are left off their dashboard.
+DRIVER_DASHBOARD_RADIUS_KM = float(os.environ.get('DRIVER_DASHBOARD_RADIUS_KM', 5.0))
 
 try:
     from booking.tasks import compute_and_cache_route
@@ -135,6 +138,18 @@ class DriverDashboard(View):
             return redirect('user:landing')
         profile = Driver.objects.filter(user=request.user).first()
         available_rides = Booking.objects.filter(status='pending', driver__isnull=True)
+        # Only list pending pickups near the driver (via the spatial index) when
+        # we know where they are; otherwise fall back to the full listing.
+        try:
+            nearby_ids = pending_bookings_near_driver(request.user, DRIVER_DASHBOARD_RADIUS_KM)
+        except Exception:
+            nearby_ids = None
+        if nearby_ids is not None:
+            order = {booking_id: idx for idx, booking_id in enumerate(nearby_ids)}
+            available_rides = sorted(
+                available_rides.filter(id__in=nearby_ids).select_related('rider'),
+                key=lambda b: order.get(b.id, len(order)),
+            )
         active_booking = Booking.objects.filter(
             driver=request.user,
             status__in=['accepted', 'on_the_way', 'started']
@@ -259,11 +274,13 @@ def accept_ride(request, booking_id):
     
     # Calculate initial route
     try:
-        driver_location = DriverLocation.objects.get(driver=request.user)
+        driver_location = location_store.get_driver_location(request.user.id)
+        if driver_location is None:
+            raise LookupError('driver location unknown')
         routing_service = RoutingService()
         
         # Calculate route from driver to pickup
-        start_coords = (float(driver_location.longitude), float(driver_location.latitude))
+        start_coords = driver_location.lonlat
         pickup_coords = (float(booking.pickup_longitude), float(booking.pickup_latitude))
         
         route_info = routing_service.calculate_route(start_coords, pickup_coords)
@@ -276,7 +293,7 @@ def accept_ride(request, booking_id):
             booking.estimated_distance = Decimal(str(route_info['distance']))
             booking.estimated_duration = route_info['duration'] // 60  # minutes
             booking.estimated_arrival = timezone.now() + timedelta(seconds=route_info['duration'])
-    except DriverLocation.DoesNotExist:
+    except LookupError:
         messages.warning(request, "Please enable location sharing to see route information.")
     except Exception as e:
         messages.warning(request, f"Could not calculate route: {str(e)}")
@@ -349,7 +366,6 @@ def cancel_booking(request, booking_id):
     # but clears any driver assignment. This allows the rider to see the unaccepted booking card.
     if booking.status in ['pending', 'accepted', 'on_the_way']:
         old_status = booking.status
-        old_driver_id = booking.driver_id
         
         # If already pending with no driver, this is effectively a "delete" request
         # But we keep it as pending to maintain the booking in the system
@@ -364,21 +380,7 @@ def cancel_booking(request, booking_id):
             booking.start_time = None
             booking.save()
         
-        # Clear route info cache entries
-        from django.core.cache import cache
-        cache_keys = [
-            f'route_info_{booking_id}_{old_status}_{old_driver_id or "none"}',
-            f'route_info_{booking_id}_pending_none',
-            f'route_info_{booking_id}_accepted_{old_driver_id or "none"}',
-            f'route_info_{booking_id}_on_the_way_{old_driver_id or "none"}',
-        ]
-        for key in cache_keys:
-            try:
-                cache.delete(key)
-                print(f"[cancel_booking] Cleared cache: {key}")
-            except Exception as e:
-                print(f"[cancel_booking] Cache delete failed for {key}: {e}")
-        
+        # Cached route info is versioned; saving the booking invalidated it
         messages.success(request, 'Your booking has been cancelled.')
     else:
         messages.error(request, 'This booking cannot be cancelled at this stage.')
@@ -431,6 +433,9 @@ class RiderDashboard(View):
                         if computed is not None:
                             # Persist only the fare field to avoid touching other columns
                             _bk.save(update_fields=['fare'])
+                    elif _bk.fare is None:
+                        # Created without a quote and not priced yet (see booking.quotes)
+                        quotes.retry_pricing(_bk)
                 except Exception as e:
                     # Non-fatal: do not block dashboard rendering for logging/calculation issues
                     print(f"RiderDashboard: could not compute fare for booking {_bk.id}: {e}")
@@ -519,39 +524,23 @@ class RiderDashboard(View):
             booking = form.save(commit=False)
             booking.rider = request.user
 
-            pickup_lon = form.cleaned_data['pickup_longitude']
-            pickup_lat = form.cleaned_data['pickup_latitude']
-            dest_lon = form.cleaned_data['destination_longitude']
-            dest_lat = form.cleaned_data['destination_latitude']
-            
-            # 1. Prepare coordinates (RoutingService expects lon, lat)
-            start_coords = (float(pickup_lon), float(pickup_lat))
-            end_coords = (float(dest_lon), float(dest_lat))
-
+            # Estimates and fare come from the rider's quote (booking.quotes), so saving
+            # doesn't wait on ORS; without one, the booking is priced after it is saved
             try:
-                # 2. Get route estimates
-                routing_service = RoutingService()
-                # We use 'driving-car', which is the default in your RoutingService
-                route_info = routing_service.calculate_route(start_coords, end_coords) 
-                
-                if route_info and not route_info.get('too_close'):
-                    # 3. Store estimated values (distance in km, duration in minutes)
-                    booking.estimated_distance = Decimal(str(route_info['distance']))
-                    booking.estimated_duration = route_info['duration'] // 60 # Convert seconds to minutes
-                    
-                    # 4. Calculate and set the fare
-                    booking.calculate_fare() 
-                    
-                else:
+                priced = quotes.price_booking(booking, form.cleaned_data.get('quote_id'))
+                if priced is not None and priced.get('too_close'):
                     messages.warning(request, "Could not determine route estimates for fare calculation or points are too close.")
-
             except Exception as e:
-                # Log the error but proceed with booking (without fare) if possible
-                print(f"Routing/Fare calculation failed: {e}")
-                messages.warning(request, "An issue occurred with fare estimation. Booking pending approval.")
+                print(f"Quote lookup failed: {e}")
+                priced = None
 
             booking.save()
             print(f'Booking saved with id={booking.id} for rider={request.user.username}')
+            if priced is None:
+                try:
+                    quotes.schedule_pricing(booking)
+                except Exception as e:
+                    print(f"Fare estimate could not be scheduled for booking {booking.id}: {e}")
             messages.success(request, 'Your booking has been created successfully!')
             return redirect('user:rider_dashboard')
         except Exception as e:
@@ -619,24 +608,7 @@ def update_driver_location(request):
         lat, lon = data.get('lat'), data.get('lon')
         if lat is None or lon is None:
             return JsonResponse({'status': 'error', 'message': 'Missing lat/lon.'}, status=400)
-        Driver.objects.filter(user=request.user).update(current_latitude=lat, current_longitude=lon)
-        # Invalidate cached route info for any active booking assigned to this driver
-        try:
-            from booking.models import Booking as _Booking
-            active_bookings = _Booking.objects.filter(
-                driver=request.user,
-                status__in=['accepted', 'on_the_way', 'started']
-            ).values('id', 'status', 'driver_id')
-            for entry in active_bookings:
-                bid = entry.get('id')
-                try:
-                    cache.delete(f'route_info_{bid}')
-                    cache.delete(f"route_info_{bid}_{entry.get('status')}_{entry.get('driver_id') or 'none'}")
-                except Exception:
-                    pass
-        except Exception:
-            # If booking model unavailable or cache deletion fails, continue silently
-            pass
+        record_fix(request.user.id, lat, lon)
         return JsonResponse({'status': 'success'})
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -648,11 +620,10 @@ def get_driver_location(request, booking_id):
         return JsonResponse({'status': 'error', 'message': 'Permission denied.'}, status=403)
     if not booking.driver:
         return JsonResponse({'status': 'error', 'message': 'No driver assigned yet.'}, status=404)
-    try:
-        driver_profile = Driver.objects.get(user=booking.driver)
-        return JsonResponse({'status': 'success', 'lat': driver_profile.current_latitude, 'lon': driver_profile.current_longitude})
-    except Driver.DoesNotExist:
-        return JsonResponse({'status': 'error', 'message': 'Driver profile not found.'}, status=404)
+    location = location_store.get_driver_location(booking.driver_id)
+    if location is None:
+        return JsonResponse({'status': 'error', 'message': 'Driver location not available.'}, status=404)
+    return JsonResponse({'status': 'success', 'lat': location.latitude, 'lon': location.longitude})
 
 # --- NEW: VIEWS FOR RIDER LOCATION AND DRIVER MAP ---
 @csrf_exempt
@@ -682,266 +653,21 @@ def get_route_info(request, booking_id):
             return JsonResponse({'status': 'error', 'message': 'Authentication required'}, status=401)
         # otherwise redirect to login page (preserve next)
         return redirect_to_login(request.get_full_path())
-    booking = get_object_or_404(Booking, id=booking_id)
+    # The booking with both users and their profiles; build() prefetches the rest on a cache miss
+    booking = get_object_or_404(route_info.booking_queryset(), id=booking_id)
 
-    # Try to serve a cached route_info payload to reduce repeated ORS calls
-    cache_key = f'route_info_{booking_id}_{booking.status}_{booking.driver_id or "none"}'
-    try:
-        cached = cache.get(cache_key)
-        if cached:
-            return JsonResponse(cached)
-    except Exception:
-        # If cache is unavailable, continue and compute normally
-        cached = None
-    
     # Allow: drivers to preview using their own current location; riders to view for their own booking
-    
-    # Define booking_is_active first to determine if driver info should be exposed
-    accepted_statuses = {'accepted', 'on_the_way', 'started'}
-    booking_is_active = booking.status in accepted_statuses
-    
-    if request.user.trikego_user == 'D':
-        try:
-            driver_profile = Driver.objects.get(user=request.user)
-            rider_profile = Rider.objects.get(user=booking.rider)
-        except (Driver.DoesNotExist, Rider.DoesNotExist):
-            return JsonResponse({'status': 'error', 'message': 'Profile not found for driver or rider.'}, status=404)
-    elif request.user.trikego_user == 'R':
-        if request.user != booking.rider:
+    if request.user.trikego_user == 'R':
+        if request.user.id != booking.rider_id:
             return JsonResponse({'status': 'error', 'message': 'Permission denied.'}, status=403)
-        # Allow riders to preview the route (pickup -> destination) even when no driver has
-        # been assigned yet. In that case, we will compute a pickup->destination route
-        # and return it with driver coordinates set to null so the frontend draws only
-        # the preview route. If a driver exists, return driver info as before.
-        try:
-            rider_profile = Rider.objects.get(user=request.user)
-        except Rider.DoesNotExist:
-            return JsonResponse({'status': 'error', 'message': 'Rider profile not found.'}, status=404)
-
-        driver_profile = None
-        if booking_is_active and booking.driver:
-            try:
-                driver_profile = Driver.objects.get(user=booking.driver)
-            except Driver.DoesNotExist:
-                # If driver record is missing, continue without driver info
-                driver_profile = None
-    else:
+    elif request.user.trikego_user != 'D':
         return JsonResponse({'status': 'error', 'message': 'Unauthorized.'}, status=403)
-    # Try to include tricycle details if available. The Tricycle model or relation
-    # may not exist yet in the codebase, so handle gracefully.
-    tricycle_data = None
-    try:
-        # Prefer explicit Tricycle model if available
-        from user.models import Tricycle
-        try:
-            # Some implementations may link Tricycle to Driver (model instance) or to the CustomUser.
-            trike = Tricycle.objects.filter(driver=driver_profile).first()
-            if not trike:
-                # Try linking by user if different FK was used
-                trike = Tricycle.objects.filter(driver__user=driver_profile.user).first()
-        except Exception:
-            trike = None
-        if trike:
-            tricycle_data = {
-                'plate_number': getattr(trike, 'plate_number', None),
-                'color': getattr(trike, 'color', None),
-                'image_url': getattr(trike, 'image_url', None),
-            }
-    except Exception:
-        # No Tricycle model present — try to access a related attribute on the driver_profile
-        try:
-            trike = getattr(driver_profile, 'tricycle', None)
-            if trike:
-                tricycle_data = {
-                    'plate_number': getattr(trike, 'plate_number', None),
-                    'color': getattr(trike, 'color', None),
-                    'image_url': getattr(trike, 'image_url', None),
-                }
-        except Exception:
-            tricycle_data = None
-
-    # If there's no driver assigned (rider preview), compute pickup->destination route
-    route_payload = None
-    try:
-        if not booking_is_active or not booking.driver:
-            routing_service = RoutingService()
-            # Calculate route from pickup to destination (coords expected as lon,lat)
-            start = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-            end = (float(booking.destination_longitude), float(booking.destination_latitude))
-            route_info = routing_service.calculate_route(start, end)
-            if route_info:
-                route_payload = {
-                    'route_data': route_info.get('route_data'),
-                    'distance': route_info.get('distance'),
-                    'duration': route_info.get('duration'),
-                    'too_close': route_info.get('too_close', False)
-                }
-        else:
-            # If a driver exists, the frontend will fetch driver/pickup and pickup/destination as needed
-            route_payload = None
-    except Exception as e:
-        route_payload = None
-    # Compute distances for convenience to display in the UI
-    pickup_to_dest_km = None
-    driver_to_pickup_km = None
-    if route_payload:
-        try:
-            pickup_to_dest_km = route_payload.get('distance')
-        except Exception:
-            pickup_to_dest_km = None
-    else:
-        # If driver exists and routing can compute, try to compute distances
-        try:
-            routing_service = RoutingService()
-            if booking.pickup_latitude and booking.pickup_longitude and booking.destination_latitude and booking.destination_longitude:
-                pd_start = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-                pd_end = (float(booking.destination_longitude), float(booking.destination_latitude))
-                pd_info = routing_service.calculate_route(pd_start, pd_end)
-                if pd_info:
-                    pickup_to_dest_km = pd_info.get('distance')
-            if booking.driver and driver_profile and driver_profile.current_latitude and driver_profile.current_longitude and booking.pickup_latitude and booking.pickup_longitude:
-                dp_start = (float(driver_profile.current_longitude), float(driver_profile.current_latitude))
-                dp_end = (float(booking.pickup_longitude), float(booking.pickup_latitude))
-                dp_info = routing_service.calculate_route(dp_start, dp_end)
-                if dp_info:
-                    driver_to_pickup_km = dp_info.get('distance')
-        except Exception:
-            pass
-
-    # Driver/tricycle frontend-friendly details
-    driver_info = None
-    if driver_profile:
-        # If the Driver model doesn't have current coords, try to read the real-time
-        # DriverLocation (apps.booking.models.DriverLocation) as a fallback source.
-        try:
-            from booking.models import DriverLocation as _DriverLocation
-            dl = _DriverLocation.objects.filter(driver=driver_profile.user).first()
-            if dl:
-                # Only set if missing on the driver_profile
-                if not driver_profile.current_latitude and getattr(dl, 'latitude', None) is not None:
-                    driver_profile.current_latitude = dl.latitude
-                if not driver_profile.current_longitude and getattr(dl, 'longitude', None) is not None:
-                    driver_profile.current_longitude = dl.longitude
-        except Exception:
-            # Booking app or DriverLocation may not be present; ignore and continue
-            pass
-        try:
-            driver_name = f"{driver_profile.user.first_name} {driver_profile.user.last_name}".strip() or driver_profile.user.username
-        except Exception:
-            driver_name = getattr(driver_profile.user, 'username', 'Driver')
-        driver_info = {
-            'id': getattr(driver_profile, 'id', None),
-            'name': driver_name,
-            'lat': driver_profile.current_latitude,
-            'lon': driver_profile.current_longitude,
-        }
-        # Try to attach tricycle info if not yet included
-        if tricycle_data:
-            driver_info['plate'] = tricycle_data.get('plate_number')
-            driver_info['color'] = tricycle_data.get('color')
-
-    # Build stop payload (pickup/dropoff and any subsequent itinerary points) so the
-    # rider map can render numbered markers matching the driver's itinerary.
-    stops_payload = []
-    try:
-        ensure_booking_stops(booking)
-        booking_stops = booking.stops.order_by('sequence', 'created_at')
-        for idx, stop in enumerate(booking_stops, start=1):
-            lat_val = None
-            lon_val = None
-            try:
-                if stop.latitude is not None and stop.longitude is not None:
-                    lat_val = float(stop.latitude)
-                    lon_val = float(stop.longitude)
-            except Exception:
-                lat_val = None
-                lon_val = None
-
-            stops_payload.append({
-                'sequence': idx,
-                'type': stop.stop_type,
-                'status': stop.status,
-                'address': stop.address,
-                'lat': lat_val,
-                'lon': lon_val,
-                'passenger_count': stop.passenger_count,
-                'label': 'Pickup' if stop.stop_type == 'PICKUP' else 'Drop-off',
-                'booking_id': stop.booking_id,
-            })
-    except Exception:
-        stops_payload = []
-
-    shared_itinerary = None
-    if booking_is_active and booking.driver and driver_profile:
-        try:
-            itinerary_result = build_driver_itinerary(booking.driver)
-            if isinstance(itinerary_result, dict):
-                shared_itinerary = itinerary_result.get('itinerary')
-        except Exception:
-            shared_itinerary = None
-
-    fare_amount = None
-    fare_display = None
-    if booking.fare is not None:
-        try:
-            fare_amount = float(booking.fare)
-        except (TypeError, ValueError, OverflowError):
-            try:
-                fare_amount = float(Decimal(str(booking.fare)))
-            except Exception:
-                fare_amount = None
-        if fare_amount is not None:
-            fare_display = f"₱{booking.fare}"
 
-    estimated_distance_val = None
-    if booking.estimated_distance is not None:
-        try:
-            estimated_distance_val = float(booking.estimated_distance)
-        except (TypeError, ValueError, OverflowError):
-            estimated_distance_val = None
-
-    estimated_duration_val = booking.estimated_duration if booking.estimated_duration is not None else None
-
-    estimated_arrival_iso = None
-    if booking.estimated_arrival is not None:
-        try:
-            estimated_arrival_iso = booking.estimated_arrival.isoformat()
-        except Exception:
-            estimated_arrival_iso = None
-
-    response_data = {
-        'status': 'success',
-        'booking_status': booking.status,
-        'driver': driver_info if booking_is_active else None,
-        'driver_lat': driver_profile.current_latitude if (booking_is_active and driver_profile) else None,
-        'driver_lon': driver_profile.current_longitude if (booking_is_active and driver_profile) else None,
-        'driver_name': driver_info.get('name') if (booking_is_active and driver_info) else None,
-        'rider_lat': rider_profile.current_latitude if rider_profile else None,
-        'rider_lon': rider_profile.current_longitude if rider_profile else None,
-        'pickup_address': booking.pickup_address,
-        'pickup_lat': booking.pickup_latitude,
-        'pickup_lon': booking.pickup_longitude,
-        'destination_address': booking.destination_address,
-        'destination_lat': booking.destination_latitude,
-        'destination_lon': booking.destination_longitude,
-        'estimated_arrival': estimated_arrival_iso,
-        'estimated_distance_km': estimated_distance_val,
-        'estimated_duration_min': estimated_duration_val,
-        'fare': fare_amount,
-        'fare_display': fare_display,
-        'tricycle': tricycle_data,
-        'route_payload': route_payload,
-        'pickup_to_destination_km': pickup_to_dest_km,
-        'driver_to_pickup_km': driver_to_pickup_km,
-        'stops': stops_payload,
-        'itinerary': shared_itinerary,
-    }
-
-    # Cache the response briefly to reduce repeated ORS calls from many clients.
+    # Cached payload (stale-while-revalidate), or a fresh build on a miss
     try:
-        cache.set(cache_key, response_data, timeout=int(os.environ.get('ROUTE_CACHE_TTL', 15)))
-    except Exception:
-        pass
+        response_data = route_info.get_payload(booking, request.user)
+    except route_info.ProfileNotFound as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=404)
 
     return JsonResponse(response_data)
 